@@ -0,0 +1,458 @@
+"""
+asyncio versions of the socket connections so lots of peers can share one event loop instead of a thread each
+The protocol work itself lives in ds.UDPConnectionBase/ds.TCPConnectionBase, these only feed them bytes
+
+    conn = await AsyncConnectionUDP.open(src_port, ("127.0.0.1", dest_port))
+    await conn.wait_verified()
+    await conn.send(b"hi")
+    async for msg in conn:
+        ...
+"""
+import asyncio
+import os
+from collections import deque
+import time
+import antt.data_structures as ds
+from antt.cust_logging import *
+
+
+def new_future() -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    # Nobody has to await a send handle, so a connection closing under it shouldn't log unretrieved errors
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return future
+
+
+class AsyncEndpoint:
+    """
+    The awaitable side that both async connections share
+    Finished messages go into an asyncio.Queue, None in the queue means the connection is closed
+    """
+
+    def __init__(self):
+        self.transport: asyncio.BaseTransport = None
+        self.messages = asyncio.Queue()
+        self.verified = asyncio.Event()
+        self.verify_error: Exception = None
+        self.can_write = asyncio.Event()  # Cleared while the transport asks us to pause writing
+        self.can_write.set()
+
+    async def wait_verified(self, timeout: float = None):
+        await asyncio.wait_for(self.verified.wait(), timeout)
+        if self.verify_error:
+            raise self.verify_error
+
+    def verify_failed(self, error: Exception):
+        self.verify_error = error
+        self.verified.set()
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        msg = await self.messages.get()
+        if msg is None:
+            self.messages.put_nowait(None)  # Any other reader should stop too
+            raise StopAsyncIteration
+        return msg
+
+    async def recv(self, timeout: float = None) -> bytes:
+        """
+        Next message. Raises ConnectionIssue if the connection closed first
+        """
+        msg = await asyncio.wait_for(self.messages.get(), timeout)
+        if msg is None:
+            self.messages.put_nowait(None)
+            raise ds.ConnectionIssue("Connection closed")
+        return msg
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def connection_lost(self, exc):
+        self.alive = False
+        self.messages.put_nowait(None)
+        self.fail_handles()
+
+    def close(self):
+        self.alive = False
+        self.fail_handles()
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.close()
+
+
+class AsyncConnectionUDP(ds.UDPConnectionBase, AsyncEndpoint, asyncio.DatagramProtocol):
+    """
+    SocketConnectionUDP on an event loop. Timers are run with loop.call_later off the same TimerHeap
+    """
+
+    def __init__(self, src_port: int, target: tuple[str, int]):
+        ds.UDPConnectionBase.__init__(self, src_port, target)
+        AsyncEndpoint.__init__(self)
+        self.loop: asyncio.AbstractEventLoop = None
+        self.timer_handle: asyncio.TimerHandle = None
+        self.pump_scheduled = False
+        self.verify_tries = 0
+        self.store_space = asyncio.Event()  # Set while nothing is waiting on room in send_store
+        self.store_space.set()
+
+    @classmethod
+    async def open(cls, src_port: int, target: tuple[str, int]) -> "AsyncConnectionUDP":
+        conn = cls(src_port, target)
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: conn, local_addr=("0.0.0.0", src_port))
+        return conn
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.alive = True
+        self.resize_socket_buffers()
+        self.timers.set("buffers", time.time() + self.rtt_probe_interval)
+        log_txt(f"Setting up {self.src_port}\n", "verification")
+        self.verify_tick()
+
+    def resize_socket_buffers(self):
+        # The transport only hands out a wrapper, but setsockopt/getsockopt still go through. No drop counts here though
+        self.size_socket_buffers(self.transport.get_extra_info("socket"))
+
+    def verify_tick(self):
+        """
+        Same as the threaded setup, 0x03 every try until something answers
+        """
+        if self.verified_connection or not self.alive:
+            return
+        if self.verify_tries >= self.connect_try_limit:
+            log_txt(f"{self.src_port}: Giving up verification", "verification")
+            self.verify_failed(ds.ConnectionNoResponse("Failed to verify socket on other side"))
+            return
+        self.verify_tries += 1
+        self.send_bytes(b"\x03")
+        self.loop.call_later(self.connect_try_timeout / self.connect_try_limit, self.verify_tick)
+
+    def datagram_received(self, data: bytes, addr):
+        if not self.verified_connection:
+            if data == b"\x03":
+                log_txt(f"{self.src_port}: verify requested -> responding", "verification")
+                self.send_bytes(b"\x04")
+            elif data != b"\x04":
+                log_txt(f"{self.src_port}: recv {data} instead", "verification")
+                return
+            self.verified_connection = True
+            self.verified.set()
+            return
+        self.pre_parsed.append(data)
+        if not self.pump_scheduled:
+            # Let the rest of the datagrams that are ready come in first so they get handled (and acked) together
+            self.pump_scheduled = True
+            self.loop.call_soon(self.pump)
+
+    def error_received(self, exc: Exception):
+        log_txt(f"{self.src_port}: {exc}", "udp async")
+
+    def resume_writing(self):
+        super().resume_writing()
+        self.write_blocked = False
+        self.pump()
+
+    def pause_writing(self):
+        super().pause_writing()
+        self.write_blocked = True
+
+    def send_bytes(self, data: bytes, urgent: bool = False):
+        # The transport copies anything it has to hold on to so reused frame buffers are fine
+        self.transport.sendto(data, self.target)
+        self.last_action = time.time()
+
+    def reader_made_room(self):
+        if not self.pump_scheduled:
+            self.pump_scheduled = True
+            self.loop.call_soon(self.pump)
+
+    def pump(self):
+        """
+        The body of SocketConnectionUDP.run for one wakeup
+        """
+        self.pump_scheduled = False
+        if not self.alive:
+            return
+        for msg in self.process_incoming():
+            self.messages.put_nowait(msg)
+        self.admit_pending()
+        if not self.pending_messages:
+            self.store_space.set()
+        self.flush_send_buffer()
+
+        now = time.time()
+        self.schedule_timers(now)
+        timeout = self.timers.timeout(now)
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        if timeout is not None:
+            self.timer_handle = self.loop.call_later(timeout, self.pump)
+
+    def make_stream_queue(self):
+        return asyncio.Queue()
+
+    def make_future(self):
+        return new_future()
+
+    async def send_file(self, path, offset: int = 0, stream: int = 0) -> ds.SendHandle:
+        """
+        Sends the file from offset on as one message (so offset picks up a cut off download)
+        Frames are cut straight from an mmap of the file, it never gets read into memory as a whole
+        """
+        return await self.send(ds.map_file(path, offset), stream)
+
+    async def send(self, data: bytes, stream: int = 0, delivery: str = None) -> ds.SendHandle:
+        """
+        Queues a message to go out. Waits while send_store has no room for it
+        Unreliable messages come out of unreliable_queue (or on_unreliable) on the other side
+        Await the returned handle to wait until the other side has the whole message
+        """
+        handle = ds.SendHandle(self.make_future(), len(data))
+        self.queue_message(data, stream, delivery, handle)
+        self.pump()
+        while self.pending_messages and self.alive:
+            self.store_space.clear()
+            await self.store_space.wait()
+        return handle
+
+    def close(self):
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        super().close()
+
+
+class AsyncConnectionTCP(ds.TCPConnectionBase, AsyncEndpoint, asyncio.BufferedProtocol):
+    """
+    SocketConnectionTCP on an event loop. Acting as server it accepts the first client and stops listening
+    The transport reads straight into rx (BufferedProtocol) instead of handing over new bytes objects
+    """
+
+    def __init__(self, src_port: int, target: tuple[str, int], acts_as: str = "client"):
+        ds.TCPConnectionBase.__init__(self, src_port, target, acts_as)
+        AsyncEndpoint.__init__(self)
+        self.server: asyncio.AbstractServer = None
+        self.heartbeat_handle: asyncio.TimerHandle = None
+        self.batch_handle: asyncio.TimerHandle = None
+        self.read_paused = False  # Waiting on an IncomingMessage's reader
+        # loop.sendfile needs the transport to itself, so anything written meanwhile is held until it's done
+        self.file_lock = asyncio.Lock()
+        self.file_writing = False
+        self.held_writes = []
+        # Handles only finish once their bytes left the transport's buffer, like SendQueue does on the threaded side
+        self.written = 0  # Bytes handed to the transport so far
+        self.unwritten = deque()  # (written once the message is out, handle)
+        self.drain_check: asyncio.TimerHandle = None
+        self.drain_poll_interval = .002
+
+    @classmethod
+    async def open(cls, src_port: int, target: tuple[str, int], acts_as: str = "client") -> "AsyncConnectionTCP":
+        conn = cls(src_port, target, acts_as)
+        loop = asyncio.get_running_loop()
+        if acts_as == "client":
+            tries = conn.connect_try_limit
+            try_delay = conn.connect_try_timeout / tries
+            for count in range(tries):
+                try:
+                    await loop.create_connection(lambda: conn, target[0], target[1], local_addr=("0.0.0.0", src_port))
+                    break
+                except (ConnectionResetError, ConnectionRefusedError):
+                    if count == tries - 1:
+                        raise ds.ConnectionNoResponse("Failed to connect to server")
+                    await asyncio.sleep(try_delay)
+        else:
+            conn.server = await loop.create_server(lambda: conn, "0.0.0.0", src_port)
+        return conn
+
+    def connection_made(self, transport: asyncio.Transport):
+        log_txt(f"{self.src_port}: connected", "tcp socket setup")
+        if self.server is not None:
+            self.server.close()  # Only the one client, same as the threaded version
+        self.transport = transport
+        self.alive = True
+        self.last_action = time.time()
+        if self.acts_as == "client":
+            transport.write(b"\x01")
+        self.heartbeat_handle = asyncio.get_running_loop().call_later(self.max_no_action_delay, self.heartbeat_tick)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.rx.space()
+
+    def buffer_updated(self, nbytes: int):
+        self.rx.wrote(nbytes)
+        if not self.verified_connection:
+            expected = 2 if self.acts_as == "client" else 1
+            if self.rx.buffer[self.rx.start] != expected:
+                self.verify_failed(ds.ConnectionIssue("Unable to verify other side is correct class"))
+                return
+            if self.acts_as != "client":
+                self.transport.write(b"\x02")
+            log_txt(f"{self.src_port}: Verification done", "tcp socket setup")
+            self.verified_connection = True
+            self.verified.set()
+            self.rx.consume(1)
+        self.last_updated = time.time()
+        self.read_messages()
+
+    def read_messages(self):
+        for msg in self.pop_finished_messages():
+            self.messages.put_nowait(msg)
+        if self.reading_paused and not self.read_paused and not self.transport.is_closing():
+            self.read_paused = True
+            self.transport.pause_reading()
+
+    def reader_made_room(self):
+        # An on_chunk callback gets here from inside read_messages, so the rest waits for the next loop turn
+        asyncio.get_running_loop().call_soon(self.resume_after_reader)
+
+    def resume_after_reader(self):
+        if not self.alive:
+            return
+        self.read_messages()  # Some of what is waiting in rx first
+        if self.read_paused and not self.reading_paused and not self.transport.is_closing():
+            self.read_paused = False
+            self.transport.resume_reading()
+
+    def make_stream_queue(self):
+        return asyncio.Queue()
+
+    def make_future(self):
+        return new_future()
+
+    async def send(self, data: bytes, stream: int = 0, delivery: str = None, *, m_type: bytes = b"\x05") -> ds.SendHandle:
+        """
+        Writes the message (or adds it to the batch) and waits until the transport wants more
+        Stream messages get written in chunks whenever the transport has room, taking turns with other streams
+        The returned handle finishes once the transport wrote all of the message to the socket, and fails if the
+        connection closes first
+        m_type is keyword only so the arguments line up with every other send()
+        """
+        handle = ds.SendHandle(self.make_future(), len(data))
+        self.queue_message(data, stream, delivery, handle, m_type)
+        if stream:
+            self.pump_streams()
+        elif self.write_batch and self.batch_handle is None:
+            self.batch_handle = asyncio.get_running_loop().call_later(self.batch_delay, self.flush_batch)
+        await self.can_write.wait()
+        return handle
+
+    async def send_file(self, path, offset: int = 0, stream: int = 0) -> ds.SendHandle:
+        """
+        Sends the file from offset on as one message without reading it in (so offset picks up a cut off download)
+        Regular messages go out with loop.sendfile (os.sendfile where the loop can). Stream messages are cut from an
+        mmap of the file instead. The returned handle is already finished (or failed)
+        """
+        if stream:
+            return await self.send(ds.map_file(path, offset), stream=stream)
+        async with self.file_lock:
+            with open(path, "rb") as f:
+                size = max(os.fstat(f.fileno()).st_size - offset, 0)
+                handle = ds.SendHandle(self.make_future(), size)
+                self.flush_batch()
+                self.write_parts((self.message_header(size),))
+                self.file_writing = True
+                try:
+                    sent = await asyncio.get_running_loop().sendfile(self.transport, f, offset, size) if size else 0
+                except (OSError, RuntimeError) as e:
+                    log_txt(f"{self.src_port}: sendfile failed {e}", "tcp async")
+                    handle.finish(ds.ConnectionIssue("Connection closed before the file was written"))
+                    return handle
+                finally:
+                    self.file_writing = False
+                    held = self.held_writes
+                    self.held_writes = []
+                    for parts, handles in held:
+                        self.write_parts(parts, handles)
+                    self.pump_streams()
+        if sent != size:
+            handle.finish(ds.InvalidData("File got shorter while it was being sent"))
+            self.close()  # The other side is still waiting on the rest of the message
+        else:
+            handle.finish()
+        return handle
+
+    def write_parts(self, parts, handles=()):
+        """
+        Writes to the transport, unless send_file has it right now
+        """
+        if self.file_writing:
+            self.held_writes.append((parts, handles))
+            return
+        self.transport.writelines(parts)
+        self.written += sum(memoryview(a).nbytes for a in parts)
+        self.last_action = time.time()
+        for a in handles:
+            self.unwritten.append((self.written, a))
+        if handles:
+            self.finish_written()
+
+    def finish_written(self):
+        """
+        Finishes the handles whose messages the transport fully wrote to the socket
+        The transport doesn't say when its buffer runs empty (resume_writing only comes after a pause), so while
+        some are still waiting this checks again shortly
+        """
+        if self.drain_check is not None:
+            self.drain_check.cancel()
+            self.drain_check = None
+        taken = self.written - self.transport.get_write_buffer_size()
+        while self.unwritten and self.unwritten[0][0] <= taken:
+            self.unwritten.popleft()[1].finish()
+        if self.unwritten and not self.transport.is_closing():
+            self.drain_check = asyncio.get_running_loop().call_later(self.drain_poll_interval, self.finish_written)
+
+    def pump_streams(self):
+        while self.can_write.is_set() and not self.file_writing and self.transport is not None and not self.transport.is_closing():
+            chunk = self.next_stream_chunk()
+            if chunk is None:
+                break
+            self.write_parts(chunk)
+
+    def resume_writing(self):
+        super().resume_writing()
+        self.finish_written()
+        self.pump_streams()
+
+    def flush_batch(self):
+        if self.batch_handle is not None:
+            self.batch_handle.cancel()
+            self.batch_handle = None
+        if self.write_batch and self.transport is not None and not self.transport.is_closing():
+            super().flush_batch()
+
+    def heartbeat_tick(self):
+        if not self.alive:
+            return
+        now = time.time()
+        if now > self.last_action + self.max_no_action_delay:
+            self.write_parts((b"\x00",))
+            self.last_action = now  # Even if it's held behind a send_file
+        self.heartbeat_handle = asyncio.get_running_loop().call_later(self.last_action + self.max_no_action_delay - now, self.heartbeat_tick)
+
+    def fail_handles(self):
+        super().fail_handles()
+        if self.drain_check is not None:
+            self.drain_check.cancel()
+            self.drain_check = None
+        error = ds.ConnectionIssue("Connection closed before the message was written")
+        while self.unwritten:
+            self.unwritten.popleft()[1].finish(error)
+        for parts, handles in self.held_writes:
+            for a in handles:
+                a.finish(error)
+
+    def close(self):
+        self.flush_batch()
+        if self.heartbeat_handle is not None:
+            self.heartbeat_handle.cancel()
+        if self.server is not None:
+            self.server.close()
+        super().close()
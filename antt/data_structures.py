@@ -3,17 +3,30 @@ This file contains data structures and additional helpers needed for network com
 """
 import json
 import enum
-import random
+import mmap
+import os
+import re
 import socket
+import struct
+import sys
 import time
 import traceback
 import pprint
 
 import psutil
 import threading
+import selectors
+import heapq
+from abc import ABC, abstractmethod
 from queue import Queue, Empty
+from concurrent.futures import Future
+import asyncio
+from collections import deque
+from itertools import islice
+from array import array
 import math
 from antt.cust_logging import *
+from antt.datagram_io import DatagramIO, best_datagram_io
 
 
 
@@ -25,17 +38,42 @@ Just for some packet notation:
 0x02 = ack alive keep alive
 0x03 = conn only syn
 0x04 = conn only ack
-0x05 = small + single packet message (currently acts like \x06 and is wrapped as a multi-packet)
+0x05 = small + single packet message (currently acts like \x06 and is wrapped as a multi-packet, see 0x0d)
 0x06 = multi-packet message
-0x07 = resend packets
-0x08 = done sending message
+0x07 = resend packets (one 5 byte number per part, only kept for older peers)
+0x08 = done sending message (or everything the receiver has room for, when it streams the message to its reader)
 0x09 = message fully built
+0x0a = resend packets as compressed part ranges or a bitmap of missing parts
+0x0b = ack for the parts of a message received so far (also carries the receiver's kernel drop count, and for a message
+       being streamed to the reader the part it has room up to)
+0x0c = xor parity of a group of frames (forward error correction)
+0x0d = whole message in one datagram as <id><data>. No 0x08/0x09, it's done as soon as it arrives
+0x0e = acks for 0x0d messages, any number of <id>s in one datagram
+0x0f = several small messages batched into one datagram as <id>(<length (2)><data>)*. Otherwise the same as 0x0d
+0x10 = container of other datagrams as (<length (2)><datagram>)*, so control datagrams ride along with data frames
+UDP messages on a stream (see Stream) use message id <stream id (2)><sequence number (3)> so nothing else changes
+0x11 = (TCP) chunk of a stream message as <0x11><length><stream id (2)><last chunk (1)><data>
+0x12 = unreliable message as <id><only newest (1)><data>, the id is laid out like a stream id but counts separately. Never acked or resent
 """
 
 
 # We are assuming entire packet fits in recv size. May need to add proper data buffering/loading otherwise
 # It is not super optimised for readability
 class Packet:
+    """
+    There are two wire formats for a packet:
+    json    The original one. Bytes fields get hex encoded so the output is about 2x the size of any binary data
+    binary  <magic (1)><version (1)> followed by TYPE, VALUE, DATA, EXTRA as <field tag (1)><field len (8)><field>
+            Bytes fields are passed through as is and parse into memoryview slices of the received buffer
+    parse() checks the leading magic byte so either format can be received (json always starts with "{")
+    """
+    binary_magic = b"\xab"
+    binary_version = 1
+    field_header = struct.Struct(">BQ")
+    # Field tags for the binary format
+    field_bytes = 0
+    field_str = 1
+    field_json = 2
 
     def __init__(self, data_type=None, value=None, data=None, extra=None):
         if not data_type:
@@ -103,29 +141,33 @@ class Packet:
     def extra(self, val):
         self.storage["EXTRA"] = val
 
-    def generate(self):
+    def generate(self, binary: bool = False):
+        if binary:
+            return self.generate_binary()
         temp = self.storage.copy()
 
         # using hex encoding basically 2x the memory size but is fast and safe in a json context
-        if isinstance(temp["TYPE"], bytes):
+        if isinstance(temp["TYPE"], (bytes, bytearray, memoryview)):
             temp["TYPE"] = temp["TYPE"].hex()
             temp["type bytes"] = True
 
-        if isinstance(temp["VALUE"], bytes):
+        if isinstance(temp["VALUE"], (bytes, bytearray, memoryview)):
             temp["VALUE"] = temp["VALUE"].hex()
             temp["value bytes"] = True
 
-        if isinstance(temp["DATA"], bytes):
+        if isinstance(temp["DATA"], (bytes, bytearray, memoryview)):
             temp["DATA"] = temp["DATA"].hex()
             temp["data bytes"] = True
 
-        if isinstance(temp["EXTRA"], bytes):
+        if isinstance(temp["EXTRA"], (bytes, bytearray, memoryview)):
             temp["EXTRA"] = temp["EXTRA"].hex()
             temp["extra bytes"] = True
 
         return json.dumps(temp).encode()
 
     def parse(self, data):
+        if data[:1] == self.binary_magic:
+            return self.parse_binary(data)
         check = str(data, "utf-8")
         if check == "":
             self.storage = Packet().storage  # use empty default
@@ -150,6 +192,89 @@ class Packet:
         log_txt(str(data, "utf-8"), "Parse packet")
         return self
 
+    def binary_parts(self) -> list:
+        """
+        The pieces of the binary format in order. Joining them gives the full packet
+        Kept as a list so generate_many can build everything with a single join
+        """
+        parts = [self.binary_magic + bytes((self.binary_version,))]
+        for key in ("TYPE", "VALUE", "DATA", "EXTRA"):
+            val = self.storage[key]
+            if isinstance(val, (bytes, bytearray, memoryview)):
+                tag = self.field_bytes
+            elif isinstance(val, str):
+                tag = self.field_str
+                val = val.encode()
+            else:
+                tag = self.field_json
+                val = json.dumps(val).encode()
+            length = val.nbytes if isinstance(val, memoryview) else len(val)
+            parts.append(self.field_header.pack(tag, length))
+            parts.append(val)
+        return parts
+
+    def generate_binary(self) -> bytes:
+        return b"".join(self.binary_parts())
+
+    def parse_binary(self, data):
+        view = memoryview(data)
+        end = self.load_binary(view, 0)
+        if end != len(view):
+            raise InvalidData(f"Found {len(view) - end} extra bytes after binary packet")
+        return self
+
+    def load_binary(self, view: memoryview, offset: int) -> int:
+        """
+        Loads the binary packet starting at offset and returns the offset right after it
+        Bytes fields are left as memoryview slices of view so nothing gets copied
+        """
+        if view[offset:offset + 1] != self.binary_magic:
+            raise InvalidData("Binary packet magic byte not found")
+        if len(view) < offset + 2 or view[offset + 1] != self.binary_version:
+            raise InvalidData("Unknown binary packet version")
+        offset += 2
+        storage = {}
+        for key in ("TYPE", "VALUE", "DATA", "EXTRA"):
+            if len(view) < offset + self.field_header.size:
+                raise InvalidData(f"Binary packet cut off before {key} field")
+            tag, length = self.field_header.unpack_from(view, offset)
+            offset += self.field_header.size
+            if len(view) < offset + length:
+                raise InvalidData(f"Binary packet cut off inside {key} field")
+            field = view[offset:offset + length]
+            offset += length
+            if tag == self.field_bytes:
+                storage[key] = field
+            elif tag == self.field_str:
+                storage[key] = str(field, "utf-8")
+            elif tag == self.field_json:
+                storage[key] = json.loads(bytes(field))
+            else:
+                raise InvalidData(f"Unknown binary field tag {tag}")
+        self.storage = storage
+        return offset
+
+    @staticmethod
+    def generate_many(packets) -> bytes:
+        """
+        Binary packets are self delimiting so a batch is just all of them back to back
+        """
+        parts = []
+        for a in packets:
+            parts.extend(a.binary_parts())
+        return b"".join(parts)
+
+    @staticmethod
+    def parse_many(data) -> list:
+        view = memoryview(data)
+        out = []
+        offset = 0
+        while offset < len(view):
+            temp = Packet()
+            offset = temp.load_binary(view, offset)
+            out.append(temp)
+        return out
+
 
 class ConnectionIssue(Exception):
     pass
@@ -173,6 +298,39 @@ def itob_format(number: int, length: int):
     return number.to_bytes(length, 'big')
 
 
+def bit_ranges(bitmap, bit_count: int, value: int = 1) -> list[tuple[int, int]]:
+    """
+    Runs of bits equal to value within the first bit_count bits of bitmap as (start, end) ranges with end excluded
+    Bit n is bit (n % 8) of byte n // 8. The scanning is left to int/str/re so this stays fast for big bitmaps
+    """
+    bits = format(int.from_bytes(bitmap, "little"), f"0{bit_count}b")[::-1][:bit_count]
+    return [(a.start(), a.end()) for a in re.finditer("1+" if value else "0+", bits)]
+
+
+def ranges_to_bitmap(ranges, base: int, bit_count: int) -> bytes:
+    """
+    Opposite of bit_ranges (with value=1). Only the part of the ranges within [base, base + bit_count) is kept
+    """
+    mask = 0
+    for start, end in ranges:
+        start = max(start, base)
+        end = min(end, base + bit_count)
+        if start < end:
+            mask |= ((1 << (end - start)) - 1) << (start - base)
+    return mask.to_bytes((bit_count + 7) // 8, "little")
+
+
+def map_file(path, offset: int = 0) -> memoryview:
+    """
+    Read only view of the file from offset on, backed by an mmap so nothing is read until a slice of it is used
+    The mapping goes away once nothing holds a view of it anymore
+    """
+    with open(path, "rb") as f:
+        if offset >= os.fstat(f.fileno()).st_size:
+            return memoryview(b"")  # Empty files can't be mapped
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))[offset:]
+
+
 class Frame:
     """
     One frame extracted from the stream for future processing
@@ -200,7 +358,7 @@ class Frame:
         header_len = self._type_len + self._id_len + 2 * self._msg_part_len
         if len(data) > header_len:
             offset = 0
-            self.type = data[:self._type_len]
+            self.type = bytes(data[:self._type_len])
             offset += self._type_len
             self.id = int.from_bytes(data[offset:offset + self._id_len], 'big')
             offset += self._id_len
@@ -216,7 +374,7 @@ class Frame:
                 # self.data = data[offset:]
                 return data
 
-            self.data = data[offset:]
+            self.data = data[offset:]  # A view if data was one, nothing gets copied here
             self.built = True
 
             return self.data
@@ -263,23 +421,35 @@ class FrameGenerator:
         self.buffer_size = buffer_size
         self.id_len = 5
         self.msg_part_len = 5
-        self.message_space = self.buffer_size - 1 - self.id_len - 2 * self.msg_part_len  # We probably don't want to hard code the 11
         self.ids_in_use = set()
         self.latest_id = 0  # It would probably be better to randomly generate these
         # We are assuming type info will always be 1 long
+        # struct has no 5 byte ints so the part number is packed as a high byte + low 4 bytes
+        self.part_struct = struct.Struct(">BI")
+        self.part_offset = 1 + self.id_len
+        self.header_len = 1 + self.id_len + 2 * self.msg_part_len
+        # <type + id><part><total parts>
+        self.header_struct = struct.Struct(f">{self.part_offset}sBI{self.msg_part_len}s")
+
+    @property
+    def message_space(self):
+        # Worked out on the fly so it stays right after set_buffer_size
+        return self.buffer_size - self.header_len
+
+    @property
+    def single_space(self):
+        # Biggest message that fits in a single 0x0d datagram
+        return self.buffer_size - 1 - self.id_len
 
     def new_id(self):
         """
         Generate a new id value.
-        This should (but dosesn't rn) wrap and remove old values
+        Counts up and wraps around at STREAM_SEQ_MASK (ids above that are stream messages), skipping ids still in use
         """
-        new_id = random.randint(0, 99999)
-
-        # This method organizes packets, but requires full restarts to avoid collisions
-        new_id = self.latest_id + 1
+        new_id = (self.latest_id + 1) & STREAM_SEQ_MASK
         while new_id in self.ids_in_use:
             self.latest_id = new_id
-            new_id = self.latest_id + 1
+            new_id = (self.latest_id + 1) & STREAM_SEQ_MASK
         self.latest_id = new_id
 
         return new_id
@@ -287,6 +457,7 @@ class FrameGenerator:
     def prep(self, obj: bytes, m_type: bytes = b'\x05') -> list[Frame]:
         """
         This takes the type and whole base object and prepares a list of sendable byte strings
+        Makes a Frame object per chunk. pack_frames/iter_frames build the raw frames directly and are much faster
         """
         out = []
         if m_type == b'\x05':  # this means regular data
@@ -297,10 +468,8 @@ class FrameGenerator:
             log_txt(f"starting chunking", "frame prep")
             if "frame prep" in TOPICS:
                 timer = time.time()
-            index = 0
-            while index < len(obj):
-                pre_chunks.append(obj[index:index + self.message_space])
-                index += self.message_space
+            space = self.message_space
+            pre_chunks = [obj[a:a + space] for a in range(0, len(obj), space)]
             if "frame prep" in TOPICS:
                 log_txt(f"{m_id} built {len(pre_chunks)} chunks in {time.time() - timer}s", "frame prep")
                 timer = time.time()
@@ -325,376 +494,2161 @@ class FrameGenerator:
         temp._msg_part_len = self.msg_part_len
         return temp
 
+    def part_count(self, length: int) -> int:
+        # An empty message still needs one (empty) frame to exist
+        return max(1, math.ceil(length / self.message_space))
 
-class SocketConnectionUDP(threading.Thread):
-    """
-    You are _looking at_ the thread. You are putting into and taking out of the thread/socket itself
-    I guess this has kinda evolved to try to do tcp things
-    """
+    def header_template(self, m_type: bytes, m_id: int, total_parts: int) -> bytearray:
+        """
+        A frame header with everything but the part number filled in
+        """
+        return bytearray(m_type + itob_format(m_id, self.id_len) + itob_format(0, self.msg_part_len) + itob_format(total_parts, self.msg_part_len))
 
-    def __init__(self, src_port: int, target: tuple[str, int], in_queue: Queue = None, out_queue: Queue = None):
-        # What if we could inherit a socket if it already exists?
-        super().__init__()
-        self.daemon = True  # Self terminating
-        # Dest info
-        self.src_port = src_port
-        self.target = target
-        # Init queue objects if needed
-        if in_queue:
-            self.in_queue = in_queue
-        else:
-            self.in_queue = Queue()
-        if out_queue:
-            self.out_queue = out_queue
-        else:
-            self.out_queue = Queue()
+    def fill_frame(self, frame: bytearray, payload: memoryview, part: int) -> int:
+        """
+        frame has to already start with this message's header_template (only the part number changes between frames)
+        Packs the part number, copies that part's chunk of payload in after the header and returns the frame length
+        """
+        start = part * self.message_space
+        chunk = payload[start:start + self.message_space]
+        self.part_struct.pack_into(frame, self.part_offset, part >> 32, part & 0xFFFFFFFF)
+        end = self.header_len + len(chunk)
+        frame[self.header_len:end] = chunk
+        return end
+
+    def pack_frames(self, obj, m_type: bytes = b'\x05', m_id: int = None) -> bytes:
+        """
+        Builds every frame of a message into one contiguous byte string in a single pass
+        Frame n starts at n * buffer_size and only the last frame can be short (see split_frames)
+        """
+        payload = memoryview(obj).cast("B")
+        if m_id is None:
+            m_id = self.new_id()
+        space = self.message_space
+        total_parts = self.part_count(len(payload))
+        prefix = m_type + itob_format(m_id, self.id_len)
+        total = itob_format(total_parts, self.msg_part_len)
+        pack = self.header_struct.pack
+        pieces = []
+        for part in range(total_parts):
+            pieces.append(pack(prefix, part >> 32, part & 0xFFFFFFFF, total))
+            pieces.append(payload[part * space:(part + 1) * space])
+        return b"".join(pieces)
 
-        self.last_action = 0
-        self.max_no_action_delay = 20
-        self.max_unrequited_love = 3  # We may not care to check if incoming doesn't happen
-        # noinspection PyTypeChecker
-        self.socket: socket.socket = None
-        self.on_message = None  # pass message to callback if set
+    @staticmethod
+    def pack_batch(messages) -> bytes:
+        """
+        Body of a 0x0f, each message as <length (2)><data>
+        """
+        return b"".join(len(a).to_bytes(2, "big") + a for a in messages)
 
-        self.alive = False
-        self.verified_connection = False
+    @staticmethod
+    def split_batch(data, copy: bool = True) -> list:
+        out = []
+        offset = 0
+        while offset + 2 <= len(data):
+            length = int.from_bytes(data[offset:offset + 2], "big")
+            piece = data[offset + 2:offset + 2 + length]
+            out.append(bytes(piece) if copy else piece)
+            offset += 2 + length
+        return out
 
-        self.connect_try_limit = 100
-        self.connect_try_timeout = 2
+    def resend_requests(self, m_id: int, ranges: list[tuple[int, int]]) -> list[bytes]:
+        """
+        Packs the missing part ranges of a message into as few 0x0a (selective resend) datagrams as possible
+        <0x0a><id><mode> followed by
+        mode 0: (<first part><part count>) pairs
+        mode 1: <base part><bitmap where bit n set means base + n is missing>
+        Each datagram uses whichever mode gets further through the missing list
+        """
+        out = []
+        prefix = b"\x0a" + itob_format(m_id, self.id_len)
+        space = self.buffer_size - len(prefix) - 1
+        pair_count = space // (2 * self.msg_part_len)
+        bitmap_bits = (space - self.msg_part_len) * 8
+        ranges = list(ranges)
+        index = 0
+        while index < len(ranges):
+            base = ranges[index][0]
+            last_end = ranges[-1][1]
+            ranges_reach = last_end if index + pair_count >= len(ranges) else ranges[index + pair_count - 1][1]
+            bitmap_reach = min(base + bitmap_bits, last_end)
+            if ranges_reach == bitmap_reach:  # Both get everything, so pick the smaller one
+                pair_size = 2 * self.msg_part_len * (len(ranges) - index)
+                use_ranges = pair_size <= self.msg_part_len + (last_end - base + 7) // 8
+            else:
+                use_ranges = ranges_reach > bitmap_reach
+
+            if use_ranges:
+                body = [prefix, b"\x00"]
+                for start, end in ranges[index:index + pair_count]:
+                    body.append(itob_format(start, self.msg_part_len))
+                    body.append(itob_format(end - start, self.msg_part_len))
+                index += pair_count
+            else:
+                covered = index
+                while covered < len(ranges) and ranges[covered][0] < bitmap_reach:
+                    covered += 1
+                body = [prefix, b"\x01", itob_format(base, self.msg_part_len)]
+                body.append(ranges_to_bitmap(ranges[index:covered], base, bitmap_reach - base))
+                while index < len(ranges) and ranges[index][1] <= bitmap_reach:
+                    index += 1
+                if index < len(ranges) and ranges[index][0] < bitmap_reach:  # Range got split by the bitmap end
+                    ranges[index] = (bitmap_reach, ranges[index][1])
+            out.append(b"".join(body))
+        return out
 
-        self.debug = []  # NEED TO REMOVE LATER
+    def read_resend_request(self, data) -> tuple[int, list[tuple[int, int]]]:
+        """
+        Opposite of resend_requests. Gives back the message id and its missing (start, end) ranges
+        """
+        m_id = int.from_bytes(data[1:1 + self.id_len], "big")
+        mode = data[1 + self.id_len]
+        body = data[2 + self.id_len:]
+        size = self.msg_part_len
+        if mode == 0:
+            ranges = []
+            for a in range(0, len(body) - 2 * size + 1, 2 * size):
+                start = int.from_bytes(body[a:a + size], "big")
+                ranges.append((start, start + int.from_bytes(body[a + size:a + 2 * size], "big")))
+            return m_id, ranges
+        base = int.from_bytes(body[:size], "big")
+        bitmap = body[size:]
+        return m_id, [(base + a, base + b) for a, b in bit_ranges(bitmap, len(bitmap) * 8)]
+
+    def split_frames(self, packed) -> list[memoryview]:
+        view = memoryview(packed)
+        return [view[a:a + self.buffer_size] for a in range(0, len(view), self.buffer_size)]
+
+    def iter_frames(self, obj, m_type: bytes = b'\x05', m_id: int = None):
+        """
+        Lazily yields the frames of a message as memoryviews of one reused scratch buffer
+        Each frame is only valid until the next one is requested, so send it (or copy it) right away
+        """
+        payload = memoryview(obj).cast("B")
+        if m_id is None:
+            m_id = self.new_id()
+        total_parts = self.part_count(len(payload))
+        scratch = self.header_template(m_type, m_id, total_parts) + bytes(self.message_space)
+        scratch_view = memoryview(scratch)
+        for part in range(total_parts):
+            yield scratch_view[:self.fill_frame(scratch, payload, part)]
 
-        self.buffer_size = 1024
-        self.dest_socket_buffer_size = 40_000  # I think this should be a fair size
-        self.dest_socket_buffer_filled = 0
-        self.send_buffer = Queue()
-        self.awaiting_space = False
-        self.pre_parsed = []
-        self.building_blocks = {}
-        self.send_memory = {}
-        self.request_missing_latency = 1
-        self.partial_msg_max_count_bytes = int(math.log(self.buffer_size, 256) // 1 + 1)  # Used for splitting up internal messages (unused)
-        self.frame_generator = FrameGenerator(self.buffer_size)
-        self.todo = Queue()  # What if we built a tdo list on what we need to do. We could even use priority queue. Not in use rn
-        self.last_updated: int = None
 
-    def run(self) -> None:
+class StoredMessage:
+    """
+    Everything needed to (re)build any frame of one sent message
+    Only a view of the original payload is kept so nothing is copied until a frame is actually built
+    """
+    def __init__(self, frame_generator: FrameGenerator, m_id: int, payload, m_type: bytes = b'\x05', single: bool = False):
+        self.id = m_id
+        self.payload = memoryview(payload).cast("B")
+        self.single = single  # Goes out as one 0x0d (or 0x0f for a batch) datagram instead of 0x05 frames
+        self.m_type = m_type
+        self.space = frame_generator.message_space
+        self.total_parts = frame_generator.part_count(len(self.payload))
+        self.header = frame_generator.header_template(m_type, m_id, self.total_parts)
+        self.frame_generator = frame_generator
+        self.scratch: bytearray = None  # Starts with header so only the part number and data change per frame
+        self.last_update = 0
+        # Send window bookkeeping
+        self.next_part = 0  # First part that was never sent
+        self.acked = 0  # How many distinct parts the other side says it has
+        self.in_flight = 0  # Frames sent but not yet acked or reported missing
+        self.sent_at = array("d", bytes(8 * self.total_parts))  # First send time per part (0 once resent) for rtt samples
+        self.fec_start = 0  # First part of the current parity group
+        self.fec_size = 0  # Parts in the current parity group (0 means no parity)
+        self.repaired = 0  # Parts the other side rebuilt from parity so far
+        self.weight = 1  # Frames per turn when sharing the connection with other messages (see SendScheduler)
+        self.handles: list[SendHandle] = []  # Several when it's a batch
+        self.window_end: int = None  # Parts from here on wait until the other side has room (see IncomingMessage)
+
+    def window_stalled(self) -> bool:
         """
-        Starts the mainloop of the thread
+        Everything the other side has room for went out, so the rest waits on it (see IncomingMessage)
         """
-        # This will wait until both prove they are connected
-        self._setup_socket()
+        return self.window_end is not None and self.next_part >= self.window_end
 
-        while self.alive:
-            # Fixme we still have a bug where every 40th frame gets dropped
-            self.store_incoming()  # may want to call this multiple times to prioritize not losing data
+    def frame_len(self, part: int) -> int:
+        return len(self.header) + min(self.space, len(self.payload) - part * self.space)
 
-            # Parse all available frames in the partial
-            self.distribute_stored()
-
-            # Check all "In progress" messages to see if anything is past it's latency and needs to re-request frames
-            current_time = time.time()
-            for k, v in self.building_blocks.items():
-                if not v["meta"]["done"] and v["meta"]["last update"] + self.request_missing_latency < current_time:
-                    log_txt(f"{self.src_port}: found [{k}] is missing frames", "udp run")
-                    self.request_missing_frames(k)
-                    v["meta"]["last update"] = current_time
-
-            # Send anything that is ready in the send buffer given there is space in dest buffer
-            while not self.send_buffer.empty():
-                val = self.send_buffer.get()
-                if len(val) + self.dest_socket_buffer_filled < self.dest_socket_buffer_size:
-                    log_txt(f"{self.src_port}: sending len({len(val)}) {val if len(val) < 100 else f'{val[:20]}...{val[-15:]}'}", "udp run")
-                    self.send_bytes(val)
-                    self.dest_socket_buffer_filled += len(val)
-                    # self.debug.append("send_buffer")
-                    # self.debug.append(val)
-                    self.send_buffer.task_done()
-                else:
-                    if not self.awaiting_space:
-                        log_txt(f"{self.src_port}: sending awaiting space", "udp run")
-                        self.send_bytes(b'\x01')
-                        self.awaiting_space = True
-                    break
+    def frame(self, part: int) -> memoryview:
+        """
+        Builds the frame in a reused scratch buffer. Copying the payload slice in there is the only copy made
+        The returned view is only valid until the next call
+        """
+        if self.single:
+            if self.scratch is None:
+                m_type = b"\x0d" if self.m_type == b"\x05" else self.m_type
+                self.scratch = bytearray(m_type + itob_format(self.id, self.frame_generator.id_len) + self.payload)
+            return memoryview(self.scratch)
+        if self.scratch is None:
+            self.scratch = self.header + bytes(self.space)
+        length = self.frame_generator.fill_frame(self.scratch, self.payload, part)
+        return memoryview(self.scratch)[:length]
+
+    def parity_frame(self, first: int, count: int) -> bytes:
+        """
+        0x0c frame holding the xor of parts first to first + count (each zero padded to a full chunk)
+        The part field is packed as <count (high byte)><first part (low 4 bytes)>
+        """
+        acc = 0
+        for part in range(first, first + count):
+            chunk = self.payload[part * self.space:(part + 1) * self.space]
+            acc ^= int.from_bytes(chunk, "big") << (8 * (self.space - len(chunk)))
+        header = self.frame_generator.header_struct.pack(b"\x0c" + self.header[1:self.frame_generator.part_offset], count, first, self.header[-self.frame_generator.msg_part_len:])
+        return header + acc.to_bytes(self.space, "big")
 
-            # Send out any read messages
-            for a in self.pop_finished_messages():
-                log_txt(f"{self.src_port}: popping finished messages into out_queue", "udp run")
-                self.out_queue.put(a)
-            # Execute any incoming commands
-            # pprint.pprint(self.__dict__)
-            while not self.in_queue.empty():
-                val = self.in_queue.get()
-                log_txt(f"{self.src_port}: reading in_queue input [{val if len(val) < 100 else 'too long'}]", "udp run")
-                if isinstance(val, str):
-                    if val == "kill":
-                        self.alive = False
-                        self._shutdown_socket()
-                        return
-                    self.out_queue.put((val, eval(val)))  # FIXME PROBABLY A MASSIVE SECURITY RISK
 
-                elif isinstance(val, bytes):
-                    self.send_msg(val)
-                # It's probably better to make as done sooner, but this lets us see when we have parsed the message
-                self.in_queue.task_done()
-                log_txt(f"{self.src_port}: in_queue emptied", "udp run")
+class RetransmissionStore:
+    """
+    Holds the in-flight messages of a connection until the other side says they are fully built
+    max_bytes bounds how much payload we keep around. A single message bigger than it is still allowed on its own
+    """
+    def __init__(self, frame_generator: FrameGenerator, max_bytes: int = 256_000_000):
+        self.frame_generator = frame_generator
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.messages: dict[int, StoredMessage] = {}
 
-            while self.on_message and not self.out_queue.empty():
-                log_txt(f"{self.src_port}: executing on_message callback", "udp run")
-                self.on_message(self.out_queue.get())
-                self.out_queue.task_done()
+    def __contains__(self, m_id: int):
+        return m_id in self.messages
 
-            # Check if we need to send a heartbeat
-            if time.time() > self.last_action + self.max_no_action_delay:
-                log_txt(f"{self.src_port}: sending idle heartbeat", "udp run")
-                self.send_heartbeat()
-            # time.sleep(.1)
+    def __getitem__(self, m_id: int) -> StoredMessage:
+        return self.messages[m_id]
 
-        time.sleep(1)
-        self._shutdown_socket()
-        time.sleep(1)
+    def __len__(self):
+        return len(self.messages)
 
-    def _setup_socket(self):
+    def has_space(self, length: int) -> bool:
+        return not self.messages or self.used_bytes + length <= self.max_bytes
+
+    def add(self, payload, m_type: bytes = b'\x05', single: bool = False, m_id: int = None) -> StoredMessage:
+        if m_id is None:
+            m_id = self.frame_generator.new_id()
+        stored = StoredMessage(self.frame_generator, m_id, payload, m_type, single)
+        self.messages[stored.id] = stored
+        self.used_bytes += len(stored.payload)
+        return stored
+
+    def remove(self, m_id: int):
+        stored = self.messages.pop(m_id, None)
+        if stored:
+            self.used_bytes -= len(stored.payload)
+
+    def frame(self, m_id: int, part: int) -> bytes:
+        return self.messages[m_id].frame(part)
+
+
+class MessageAssembler:
+    """
+    Rebuilds one multi-frame message in place.
+    Frame data is written straight into a preallocated bytearray at part * part_space and arrivals are tracked
+    with one bit per part, so an in-flight message costs about its own size in memory.
+    """
+    def __init__(self, total_parts: int, part_space: int):
+        self.total_parts = total_parts
+        self.part_space = part_space
+        self.buffer = bytearray(total_parts * part_space)
+        self.bitmap = bytearray((total_parts + 7) // 8)
+        self.received = 0
+        self.contiguous = 0  # Every part before this one is here
+        self.highest = 0  # Highest part seen so far
+        self.requested_until = 0  # Gaps before this were already asked for
+        self.length = None  # Only known once the last part shows up
+        self.done = False
+        self.done_requests = 0  # How many 0x08s came in for this message
+        self.retries = 0  # Missing frame requests in a row that didn't bring anything new
+        self.parity = {}  # first part of a parity group -> (part count, xor of the group)
+        self.repaired = 0  # Parts rebuilt from parity
+        self.last_update = 0
+
+    def has(self, part: int) -> bool:
+        return bool(self.bitmap[part >> 3] & (1 << (part & 7)))
+
+    def insert(self, part: int, data) -> bool:
         """
-        Little abstraction/modulation for which was used in testing
-        FIXME We have got to use a better flow
+        Copy the frame data into place. Returns False if the part was a duplicate or didn't fit the message
         """
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(("", self.src_port))
-        time_limit = self.connect_try_timeout
-        limit = self.connect_try_limit
-        timeout_len = time_limit / limit
-        count = 0
-        self.socket.settimeout(timeout_len)
-        log_txt(f"Setting up {self.src_port}\n", "verification")
-        while count < limit and not self.verified_connection:
-            try:
-                data = self.socket.recv(self.buffer_size)
-                if data == b"\x04":
-                    log_txt(f"{self.src_port}: verify confirmed -> marking", "verification")
-                    self.verified_connection = True
-                elif data == b"\x03":
-                    log_txt(f"{self.src_port}: verify requested -> responding", "verification")
-                    self.socket.sendto(b"\x04", self.target)
-                    self.verified_connection = True
-                else:
-                    log_txt(f"{self.src_port}: recv {data} instead", "verification")
-            except TimeoutError:
-                log_txt(f"{self.src_port}: con_error 1; send request", "verification")
-                self.socket.sendto(b"\x03", self.target)
-                count += 1
-            except socket.timeout:
-                log_txt(f"{self.src_port}: con_error 2; send request", "verification")
-                self.socket.sendto(b"\x03", self.target)
-                count += 1
-            except ConnectionResetError:
-                log_txt(f"{self.src_port}: con_error 3; send request", "verification")
-                self.socket.sendto(b"\x03", self.target)
-                count += 1
-            time.sleep(timeout_len)
+        if self.done or part >= self.total_parts or self.has(part):
+            return False
+        start = part * self.part_space
+        if part == self.total_parts - 1:
+            if len(data) > self.part_space:
+                return False
+            self.length = start + len(data)
+        elif len(data) != self.part_space:
+            return False
+        self.buffer[start:start + len(data)] = data
+        self.bitmap[part >> 3] |= 1 << (part & 7)
+        self.received += 1
+        self.highest = max(self.highest, part)
+        while self.contiguous < self.total_parts and self.has(self.contiguous):
+            self.contiguous += 1
+        if self.received == self.total_parts:
+            self.done = True
+            self.parity.clear()
+            del self.buffer[self.length:]  # Only the last part can be short
+        return True
+
+    def add_parity(self, first: int, count: int, data) -> bool:
+        """
+        Stores a parity group and rebuilds its one missing part if that's all it's missing
+        The last part of the message can't be rebuilt since its real length is unknown
+        Returns True if a part was rebuilt
+        """
+        if self.done or first + count > self.total_parts or len(data) != self.part_space:
+            return False
+        missing = [a for a in range(first, first + count) if not self.has(a)]
+        if len(missing) != 1 or missing[0] == self.total_parts - 1:
+            if missing:
+                self.parity[first] = (count, bytes(data))  # Might still help if a resend fills one of the gaps. Copied since data can be a reused buffer
+            return False
+        self.parity.pop(first, None)
+        acc = int.from_bytes(data, "big")
+        for a in range(first, first + count):
+            if a != missing[0]:
+                # Last part is zero padded in the buffer until the message is done, same as on the sending side
+                acc ^= int.from_bytes(self.buffer[a * self.part_space:(a + 1) * self.part_space], "big")
+        if self.insert(missing[0], acc.to_bytes(self.part_space, "big")):
+            self.repaired += 1
+            return True
+        return False
+
+    def retry_parity(self, part: int) -> bool:
+        """
+        A part arrived late; any stored group it belongs to might be fixable now
+        """
+        for first, (count, data) in list(self.parity.items()):
+            if first <= part < first + count:
+                return self.add_parity(first, count, data)
+        return False
 
-        if count == limit:
-            log_txt(f"{self.src_port}: Giving up verification", "verification")
-            raise ConnectionNoResponse("Failed to verify socket on other side")
+    def missing_ranges(self, start: int = 0, end: int = None) -> list[tuple[int, int]]:
+        """
+        Missing parts (between start and end if given) as (start, end) ranges with end excluded
+        """
+        if end is None or end > self.total_parts:
+            end = self.total_parts
+        if self.done or start >= end:
+            return []
+        first_byte = start >> 3
+        base = first_byte * 8
+        ranges = bit_ranges(self.bitmap[first_byte:(end + 7) >> 3], end - base, 0)
+        return [(max(a + base, start), b + base) for a, b in ranges if b + base > start]
+
+    def missing_parts(self):
+        for start, end in self.missing_ranges():
+            yield from range(start, end)
+
+    def pop(self) -> bytes:
+        """
+        Hand out the finished message and forget about the buffer
+        It's copied into bytes once so every message comes out the same (hashable) type as the 0x0d ones
+        """
+        out = bytes(self.buffer)
+        self.buffer = None
+        return out
 
-        log_txt(f"{self.src_port}: almost done with verification", "verification")
-        self.socket.settimeout(0)
-        self.socket.setblocking(False)
-        self.alive = True
-        log_txt(f"{self.src_port}: Done with verification", "verification")
+    def status(self) -> dict:
+        return {"len": self.total_parts, "received": self.received, "done": self.done, "last update": self.last_update}
 
-    def _shutdown_socket(self):
-        # todo send a kill message/byte because the other side thinks we're still alive
-        self.socket.close()
 
-    def distribute_stored(self):
-        for a in self.pre_parsed:
-            if len(a) == 0:
-                continue
-            elif a == b'\x00':
-                # Not sure if this should be commented out or not
-                # This message also means the buffer is empty
-                # self.dest_socket_buffer_filled = 0
-                pass
-            elif a == b"\x02" or a == b"\x04":  # If we care for the acks, we just need to split up this line
-                log_txt(f"{self.src_port}: ack/resetting space flag", "udp distribute")
-                self.dest_socket_buffer_filled = 0
-                self.awaiting_space = False
-            elif a == b'\x01':
-                self.socket.sendto(b"\x02", self.target)
-            elif a == b'\x03':
-                self.socket.sendto(b'\04', self.target)
-            elif a[0] == 5 or a[0] == 6:  # I guess this op turns it into an int
-                temp = self.frame_generator.frame_template()
-                temp.parse(a)
-                self.incoming_organizer(temp)
-            elif a[0] == 9:
-                # We can now delete from saved
-                done_id = int.from_bytes(a[1:], "big")
-                del self.send_memory[done_id]
-                log_txt(f"{self.src_port}: del [{done_id}] after completion flag", "udp distribute")
-            elif a[0] == 8:
-                # Right now we are assuming that nothing will arrive after the \x08
-                # This lets us start requesting for missing information as quick as possible before waiting for the latency timeout
-                done_id = int.from_bytes(a[1:], "big")
-                # FIXME every 40th frame is missing when sending burst of packets
-                self.request_missing_frames(done_id)
-                log_txt(f"{self.src_port}: Done requesting missing", "udp distribute")
-            elif a[0] == 7:
-                log_txt(f"{self.src_port}: starting to resend", "udp distribute")
-                missing_id = int.from_bytes(a[1: 1 + self.frame_generator.id_len], "big")
-                temp = a[1 + self.frame_generator.id_len:]
-                parts = []
-                while temp:
-                    parts.append(int.from_bytes(temp[:self.frame_generator.msg_part_len], "big"))
-                    temp = temp[self.frame_generator.msg_part_len:]
-                log_txt(f"{self.src_port}: [{missing_id}] will resend {parts}", "udp distribute")
-                if missing_id in self.send_memory:
-                    for b in parts:
-                        self.send_buffer.put(self.send_memory[missing_id][b].generate())
+class StreamingAssembler(MessageAssembler):
+    """
+    MessageAssembler for a message handed to the reader as it comes in (an IncomingMessage)
+    Parts go into a ring of about incoming.window bytes and are passed on as soon as they are contiguous.
+    Parts past what the reader has room for are dropped, and asked for again once it caught up
+    Parity isn't used since the parts it would need are already gone
+    """
+    def __init__(self, total_parts: int, part_space: int, incoming: "IncomingMessage"):
+        super().__init__(0, part_space)
+        self.total_parts = total_parts
+        self.bitmap = bytearray((total_parts + 7) // 8)
+        self.buffer = None  # Nothing for pop_finished_messages to pick up
+        self.incoming = incoming
+        self.ring_parts = incoming.window // part_space + 1
+        self.ring = bytearray(self.ring_parts * part_space)
+        self.advertised_end = 0  # Window end in the last ack we sent, and when
+        self.advertised_at = 0
+
+    def window_end(self) -> int:
+        """
+        First part there is no room for yet
+        """
+        end = max((self.incoming.read + self.incoming.window) // self.part_space, self.contiguous + 1)
+        return min(end, self.contiguous + self.ring_parts, self.total_parts)
+
+    def insert(self, part: int, data) -> bool:
+        if self.done or part >= self.window_end() or self.has(part):
+            return False
+        if part == self.total_parts - 1:
+            if len(data) > self.part_space:
+                return False
+            self.length = part * self.part_space + len(data)
+            self.incoming.length = self.length
+        elif len(data) != self.part_space:
+            return False
+        slot = part % self.ring_parts * self.part_space
+        self.ring[slot:slot + len(data)] = data
+        self.bitmap[part >> 3] |= 1 << (part & 7)
+        self.received += 1
+        self.highest = max(self.highest, part)
+        start = self.contiguous
+        while self.contiguous < self.total_parts and self.has(self.contiguous):
+            self.contiguous += 1
+        if self.contiguous > start:
+            self.hand_out(start, self.contiguous)
+        if self.received == self.total_parts:
+            self.done = True
+            self.ring = None
+            self.incoming.finish()
+        return True
+
+    def hand_out(self, start: int, end: int):
+        first = start % self.ring_parts
+        last = (end - 1) % self.ring_parts + 1
+        view = memoryview(self.ring)
+        if first < last:
+            chunk = bytes(view[first * self.part_space:last * self.part_space])
+        else:  # Wrapped around the ring
+            chunk = b"".join((view[first * self.part_space:], view[:last * self.part_space]))
+        if end == self.total_parts:
+            chunk = chunk[:len(chunk) - (end * self.part_space - self.length)]  # Last part's padding
+        view.release()
+        self.incoming.put(chunk)
+
+    def add_parity(self, first: int, count: int, data) -> bool:
+        return False
+
+    def missing_ranges(self, start: int = 0, end: int = None) -> list[tuple[int, int]]:
+        """
+        Same as MessageAssembler's but only up to the part the reader has room for
+        """
+        window_end = self.window_end()
+        return super().missing_ranges(start, window_end if end is None else min(end, window_end))
 
-        self.pre_parsed.clear()
+    def pop(self):
+        return None
 
-    def send_bytes(self, data: bytes):
-        # This is the last time we see the bytes
-        self.socket.sendto(data, self.target)
-        self.last_action = time.time()
-        # print(data.decode())
 
-    def send_msg(self, data: bytes):
+class RttEstimator:
+    """
+    Smoothed rtt and rtt variance (same weights as TCP) with a retransmission timeout worked out from them
+    Every timeout doubles the rto until a fresh sample comes in
+    """
+    def __init__(self, initial_rto: float = 1, min_rto: float = .05, max_rto: float = 30):
+        self.srtt: float = None
+        self.rttvar: float = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.base_rto = initial_rto
+        self.backoff = 1
+        self.samples = 0
+        self.last_sample = 0
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.samples += 1
+        self.last_sample = time.time()
+        self.backoff = 1
+        self.base_rto = self.srtt + 4 * self.rttvar
+
+    def on_timeout(self):
+        if self.rto < self.max_rto:
+            self.backoff *= 2
+
+    @property
+    def rto(self) -> float:
+        return min(self.max_rto, max(self.min_rto, self.base_rto) * self.backoff)
+
+    @property
+    def smoothed(self) -> float:
         """
-        We are sending a normal client/content message
+        srtt, or a guess from the initial rto before the first sample
         """
-        log_txt(f"{self.src_port}: prepping send_msg data", "udp send msg")
-        prep = self.frame_generator.prep(data)
+        return self.srtt if self.srtt is not None else self.base_rto / 3
 
-        # Add missing dict to send memory (We know at least one frame exists)
-        log_txt(f"{self.src_port}: prep send_memory for {prep[0].id}", "udp send msg")
-        if prep[0].id not in self.send_memory:
-            self.send_memory[prep[0].id] = {"meta": {"len": prep[0].total_parts, "done": False, "last update": 0}}
 
-        log_txt(f"{self.src_port}: putting [{prep[0].id}] into send buffer", "udp send msg")
-        for a in prep:
-            self.send_buffer.put(a.generate())
+class CongestionController:
+    """
+    Decides how many frames a connection can have in flight and paces how fast they go out
+    Subclasses only need to change window in the on_ methods; the pacing is shared
+    """
+    def __init__(self, initial_window: int = 32, min_window: int = 4, max_window: int = 1_000_000):
+        self.window = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        # Frames are paced to spread one window over one rtt (a bit faster so the window can actually fill)
+        self.pacing_gain = 1.25
+        self.pacing_burst = 16  # Frames that can go out back to back
+        self.tokens = self.pacing_burst
+        self.last_refill = time.time()
+
+    def on_ack(self, count: int):
+        pass
+
+    def on_loss(self, rtt: float):
+        pass
+
+    def on_timeout(self):
+        self.window = self.min_window
+
+    def pacing_rate(self, rtt: float) -> float:
+        """
+        Frames per second
+        """
+        return self.pacing_gain * self.window / max(rtt, 1e-6)
 
-            # Add messages to sent memory
-            self.send_memory[a.id][a.part] = a
+    def can_send(self, rtt: float, now: float) -> bool:
+        self.tokens = min(self.pacing_burst, self.tokens + (now - self.last_refill) * self.pacing_rate(rtt))
+        self.last_refill = now
+        return self.tokens >= 1
 
-        log_txt(f"{self.src_port}: putting closing remarks into send buffer", "udp send msg")
-        self.send_memory[prep[0].id]["meta"]["last update"] = time.time()
-        self.send_buffer.put(b"\x08" + itob_format(prep[0].id, self.frame_generator.id_len))
+    def on_send(self):
+        self.tokens -= 1
 
-    def send_heartbeat(self):
-        key = b"\x00"  # first byte = 0 means heartbeat
-        self.send_bytes(key)
+    def next_send_delay(self, rtt: float) -> float:
+        """
+        How long until can_send will be True again
+        """
+        return max(0.0, (1 - self.tokens) / self.pacing_rate(rtt))
+
+
+class AIMDController(CongestionController):
+    """
+    Slow start up to ssthresh, then additive increase of one frame per window and a halved window on loss
+    Losses are only counted once per rtt since a single burst usually takes out several frames
+    """
+    def __init__(self, initial_window: int = 32, min_window: int = 4, max_window: int = 1_000_000):
+        super().__init__(initial_window, min_window, max_window)
+        self.ssthresh = max_window
+        self.recovery_until = 0
+
+    def on_ack(self, count: int):
+        if self.window < self.ssthresh:
+            self.window += count
+        else:
+            self.window += count / self.window
+        self.window = min(self.window, self.max_window)
+
+    def on_loss(self, rtt: float):
+        now = time.time()
+        if now < self.recovery_until:
+            return
+        self.recovery_until = now + rtt
+        self.ssthresh = max(self.min_window, self.window / 2)
+        self.window = self.ssthresh
+
+    def on_timeout(self):
+        self.ssthresh = max(self.min_window, self.window / 2)
+        self.window = self.min_window
+
+
+class WakeupQueue(Queue):
+    """
+    Queue that pokes one end of a socket pair on every put
+    A thread blocked in select on fileno() wakes up as soon as something is queued
+    The pair only gets made once something asks for fileno() so unused queues don't hold sockets
+    """
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.reader: socket.socket = None
+        self.writer: socket.socket = None
+
+    def _put(self, item):
+        super()._put(item)
+        self._wakeup()
+
+    def _wakeup(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.send(b"\x00")
+        except OSError:
+            pass  # Already plenty of wakeups waiting (or closed)
+
+    def fileno(self) -> int:
+        with self.mutex:
+            if self.reader is None:
+                self.reader, self.writer = socket.socketpair()  # Works with select on windows unlike os.pipe
+                self.reader.setblocking(False)
+                self.writer.setblocking(False)
+                if self._qsize():
+                    self._wakeup()
+            return self.reader.fileno()
+
+    def drain(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def poke(self):
+        """
+        Wakes up whoever is waiting on fileno() without queueing anything
+        """
+        self._wakeup()
+
+    def close(self):
+        with self.mutex:
+            if self.reader is not None:
+                self.reader.close()
+                self.writer.close()
+                self.reader = self.writer = None
+
+
+class TimerHeap:
+    """
+    Named deadlines in a heap. Setting a name again replaces its old deadline, stale heap entries get skipped
+    """
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.count = 0  # Tie breaker so names never get compared
+
+    def set(self, name, when: float):
+        if self.deadlines.get(name) == when:
+            return
+        self.deadlines[name] = when
+        self.count += 1
+        heapq.heappush(self.heap, (when, self.count, name))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(b, self.count + a, c) for a, (b, _, c) in enumerate(self.heap) if self.deadlines.get(c) == b]
+            self.count += len(self.heap)
+            heapq.heapify(self.heap)
+
+    def cancel(self, name):
+        self.deadlines.pop(name, None)
+
+    def pop_due(self, now: float) -> list:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, name = heapq.heappop(self.heap)
+            if self.deadlines.get(name) == when:
+                del self.deadlines[name]
+                due.append(name)
+        return due
+
+    def timeout(self, now: float):
+        """
+        Seconds until the next deadline or None if there are none
+        """
+        while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - now)
+
+
+STREAM_SEQ_BITS = 24  # Low bits of a UDP stream message id, the stream id goes above them
+STREAM_SEQ_MASK = (1 << STREAM_SEQ_BITS) - 1
+DELIVERY_MODES = ("reliable", "unreliable", "unreliable-latest")
+
+
+class Stream:
+    """
+    One lane of messages inside a connection. Messages on a stream come out in the order they were sent and
+    don't wait on anything sent on other streams, so a big transfer doesn't hold up everything else
+    Stream 0 is the connection itself (out_queue, no ordering on UDP)
+    """
+    def __init__(self, connection, stream_id: int, weight: int = 1):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.weight = weight  # Frames (UDP) or chunks (TCP) per turn while other streams are sending
+        self.delivery = "reliable"  # Default for messages sent on this stream (UDP only), see DELIVERY_MODES
+        self.out_queue = connection.make_stream_queue()
+        self.next_send = 0  # Sequence number for the next message sent
+        self.next_deliver = 0  # Sequence number the next message handed out has to have
+        self.held = {}  # seq -> messages that finished ahead of an earlier one
+        self.chunks = []  # TCP chunks of the message coming in
+        self.sending = deque()  # TCP [message view, offset] still being written
+
+    def send(self, data):
+        """
+        Same as the connection's send with this stream. Needs awaiting on the async connections
+        """
+        return self.connection.send(data, stream=self.stream_id)
+
+    def arrived(self, seq: int, data):
+        """
+        A whole message came in. It's handed out once everything sent before it on this stream was
+        """
+        ahead = (seq - self.next_deliver) & STREAM_SEQ_MASK
+        if ahead >= 1 << (STREAM_SEQ_BITS - 1):  # Behind us, so an old repeat
+            return
+        self.held[seq] = data
+        while self.next_deliver in self.held:
+            self.out_queue.put_nowait(self.held.pop(self.next_deliver))
+            self.next_deliver = (self.next_deliver + 1) & STREAM_SEQ_MASK
+
+
+class StreamHost:
+    """
+    The streams of a connection, shared by the UDP and TCP bases
+    """
+    def stream(self, stream_id: int, weight: int = None, delivery: str = None) -> Stream:
+        """
+        Opens (or finds) a stream. Streams the other side sends on are opened by themselves
+        """
+        if not 0 < stream_id < 1 << 16:
+            raise ValueError("Stream ids go from 1 to 65535")
+        if delivery is not None and delivery not in DELIVERY_MODES:
+            raise ValueError(f"delivery has to be one of {DELIVERY_MODES}")
+        found = self.streams.get(stream_id)
+        if found is None:
+            found = self.streams[stream_id] = Stream(self, stream_id)
+        if weight is not None:
+            found.weight = weight
+        if delivery is not None:
+            found.delivery = delivery
+        return found
+
+    def make_stream_queue(self):
+        return Queue()
+
+    def make_future(self):
+        return Future()
+
+
+class SendHandle:
+    """
+    What send() gives back. Finishes once the other side confirmed the whole message (0x09/0x0e on UDP, on TCP
+    once it was handed to the socket since there is nothing to confirm it with), or fails with ConnectionIssue
+    if the connection closes first. Can be awaited, or waited on with result() for the thread versions
+    on_progress is called with the handle on the connection's thread (or loop) as acks come in
+    """
+    def __init__(self, future, size: int):
+        self.future = future
+        self.size = size
+        self.acked_bytes = 0  # Bytes the other side says it has (bytes written for TCP)
+        self.resends = 0  # Frames that had to go out again
+        self.on_progress = None
+
+    def progress(self, acked_bytes: int = None, resends: int = 0):
+        if acked_bytes is not None:
+            self.acked_bytes = min(acked_bytes, self.size)
+        self.resends += resends
+        if self.on_progress:
+            self.on_progress(self)
+
+    def finish(self, error: Exception = None):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+            return
+        self.progress(self.size)
+        self.future.set_result(self)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: float = None) -> "SendHandle":
+        return self.future.result(timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+
+class IncomingMessage:
+    """
+    A big message (at least stream_threshold bytes) handed out as soon as it starts coming in, instead of the bytes
+    Its data comes in order in chunks: iterate over it (async for on the async connections) or set on_chunk, which
+    gets called with each chunk (and None at the end) on the connection's thread. Set it from the connection's
+    on_incoming callback so no chunk is missed. At most about window bytes that weren't read yet are held at once,
+    the other side has to wait for the rest
+    """
+    def __init__(self, connection, m_id: int, max_length: int, length: int = None, window: int = 4 * 1024 * 1024):
+        self.id = m_id
+        self.length = length  # Exact length. Known up front on TCP, and once the last frame is in on UDP
+        self.max_length = max_length
+        self.window = window
+        self.chunks = connection.make_stream_queue()
+        self.on_chunk = None
+        self.on_read = None  # Set by the connection so it notices the room the reader made
+        self.delivered = 0  # Bytes handed out
+        self.read = 0  # Bytes the reader took
+        self.reported = 0  # read as of the last on_read, which only goes off every quarter window
+        self.done = False
+        self.error: Exception = None
+
+    @property
+    def room(self) -> int:
+        """
+        How much more can be handed out before the reader has to catch up
+        """
+        return self.read + self.window - self.delivered
+
+    def put(self, chunk: bytes):
+        self.delivered += len(chunk)
+        if self.on_chunk:
+            self.on_chunk(chunk)
+            self.took(chunk)  # The callback is done with it, so that's the reader's room back
+        else:
+            self.chunks.put_nowait(chunk)
+
+    def finish(self, error: Exception = None):
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        if self.on_chunk:
+            self.on_chunk(None)
+        else:
+            self.chunks.put_nowait(None)
+
+    def took(self, chunk: bytes):
+        self.read += len(chunk)
+        if self.on_read and self.read >= self.reported + self.window // 4:
+            self.reported = self.read
+            self.on_read()
+
+    def end(self):
+        self.chunks.put_nowait(None)  # For anyone else iterating
+        if self.error:
+            raise self.error
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.end()
+                return
+            self.took(chunk)
+            yield chunk
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self.chunks.get()
+            if chunk is None:
+                self.end()
+                return
+            self.took(chunk)
+            yield chunk
+
+
+class SendScheduler:
+    """
+    Picks what a UDP connection sends next. A class is only looked at once the ones before it are empty
+    control     datagrams that skip the send window (acks, nacks, 0x08/0x09, probe replies)
+    unreliable  0x12 datagrams. Paced like data but never acked, so they don't take up room in the send window
+    resend      (id, first part, end part) ranges the other side asked for again
+    data        never sent parts. Messages take turns, each sending its weight in frames per turn
+    """
+    def __init__(self):
+        self.control = deque()
+        self.unreliable = deque()  # [stream id, datagram], datagram is None once it was sent or dropped
+        self.unreliable_latest = {}  # stream id -> its queued "unreliable-latest" entry
+        self.unreliable_limit = 256  # The oldest waiting ones are dropped past this
+        self.unreliable_dropped = 0
+        self.resend = deque()
+        self.data: deque[StoredMessage] = deque()  # The front one is taking its turn
+        self.turn_left = 0  # Frames the front message can still send this turn
+
+    def add(self, stored: StoredMessage):
+        self.data.append(stored)
+
+    def add_unreliable(self, stream_id: int, datagram: bytes, latest: bool = False):
+        """
+        With latest a newer datagram takes the place of the stream's one that is still waiting
+        (the other side would drop the older one as stale anyways)
+        """
+        if latest:
+            entry = self.unreliable_latest.get(stream_id)
+            if entry is not None and entry[1] is not None:
+                entry[1] = datagram
+                self.unreliable_dropped += 1
+                return
+            entry = self.unreliable_latest[stream_id] = [stream_id, datagram]
+        else:
+            entry = [stream_id, datagram]
+        if len(self.unreliable) >= self.unreliable_limit:
+            self.unreliable.popleft()[1] = None
+            self.unreliable_dropped += 1
+        self.unreliable.append(entry)
+
+    def next_unreliable(self) -> bytes:
+        entry = self.unreliable.popleft()
+        datagram = entry[1]
+        entry[1] = None
+        return datagram
+
+    def has_frames(self) -> bool:
+        return bool(self.unreliable or self.resend) or any(a.window_end is None or a.next_part < a.window_end for a in self.data)
+
+    def next_frame(self, send_store: RetransmissionStore):
+        """
+        Returns (stored message, part, is a resend) or None. The part counts as sent from here on
+        """
+        while self.resend:
+            m_id, part, end = self.resend[0]
+            if m_id not in send_store:  # Finished while it was waiting
+                self.resend.popleft()
+                continue
+            if part + 1 < end:
+                self.resend[0] = (m_id, part + 1, end)
+            else:
+                self.resend.popleft()
+            return send_store[m_id], part, True
+
+        waiting = 0
+        while self.data:
+            stored = self.data[0]
+            if stored.id not in send_store or stored.next_part >= stored.total_parts:
+                self.data.popleft()
+                self.turn_left = 0
+                continue
+            if stored.window_end is not None and stored.next_part >= stored.window_end:
+                # The other side's reader has to catch up first, let the rest go
+                waiting += 1
+                if waiting >= len(self.data):
+                    return None
+                self.data.rotate(-1)
+                self.turn_left = 0
+                continue
+            if self.turn_left <= 0:
+                self.turn_left = stored.weight
+            part = stored.next_part
+            stored.next_part += 1
+            self.turn_left -= 1
+            if stored.next_part == stored.total_parts:
+                # Everything went out at least once
+                self.data.popleft()
+                self.turn_left = 0
+                stored.last_update = time.time()
+                if not stored.single:
+                    self.control.append(b"\x08" + itob_format(stored.id, send_store.frame_generator.id_len))
+            elif self.turn_left <= 0:
+                self.data.rotate(-1)
+            return stored, part, False
+        return None
+
+    def depths(self) -> dict:
+        """
+        Queued datagrams for control and unreliable, frames for the other two
+        """
+        return {
+            "control": len(self.control),
+            "unreliable": len(self.unreliable),
+            "resend": sum(end - start for m_id, start, end in self.resend),
+            "data": sum(a.total_parts - a.next_part for a in self.data),  # Including what waits on a window
+        }
+
+
+class UDPConnectionBase(StreamHost, ABC):
+    """
+    Everything a UDP connection does with datagrams that doesn't depend on how they get read or written
+    SocketConnectionUDP drives this from its own thread and AsyncConnectionUDP (antt.async_connections) from an asyncio loop
+    Subclasses provide send_bytes and put received datagrams into pre_parsed before calling process_incoming
+    """
+
+    def __init__(self, src_port: int, target: tuple[str, int]):
+        # Dest info
+        self.src_port = src_port
+        self.target = target
+
+        self.last_action = 0
+        self.max_no_action_delay = 20
+        self.max_unrequited_love = 3  # We may not care to check if incoming doesn't happen
+        self.timers = TimerHeap()
+        self.write_blocked = False  # OS send buffer was full, so also wait for the socket to be writable
+
+        self.alive = False
+        self.verified_connection = False
+
+        self.connect_try_limit = 100
+        self.connect_try_timeout = 2
+
+        self.buffer_size = 1024
+        self.scheduler = SendScheduler()  # Control, then resends, then new data shared between messages
+        self.send_buffer = self.scheduler.control  # Control datagrams. These skip the send window
+        self.resend_buffer = self.scheduler.resend  # (id, first part, end part) ranges to rebuild from send_store
+        self.congestion: CongestionController = AIMDController()
+        self.in_flight = 0  # Frames sent but not yet acked or reported missing
+        self.rtt_estimator = RttEstimator()  # Sampled from ack and 0x01/0x02 probe round trips
+        self.probe_sent_at = 0  # When the 0x01 we are still waiting on went out
+        self.unanswered_probes = 0
+        self.peer_responsive = True
+        self.rtt_probe_interval = 5  # Receiving side probes this often since it gets no samples from acks
+        self.last_frame_at = 0
+        self.last_ack = 0
+        self.pending_acks = {}  # id -> latest part received since the last ack went out
+        # Delayed acks. They go out after ack_every frames, with data going the other way, or ack_delay after the
+        # first frame they cover, whichever is first. Out of order frames are acked right away (like tcp)
+        self.ack_delay = .01
+        self.ack_every = 4  # The smallest window the sender can have, so it never waits on ack_delay
+        self.ack_due = 0
+        self.unacked_frames = 0
+        self.container_size = 1400  # Biggest 0x10 container. Leaves room for ip/udp headers in a 1500 mtu
+        self.single_datagram = True  # Messages that fit go out as one 0x0d datagram
+        self.single_acks = []  # 0x0d ids to ack in the next 0x0e
+        self.single_done = {}  # Recent 0x0d ids so resends aren't delivered twice (used as an ordered set)
+        self.single_done_limit = 4096
+        self.single_messages = []  # (id, message) from 0x0d/0x0f waiting for pop_finished_messages
+        # Small messages can wait up to batch_delay seconds for others to share a 0x0f datagram with.
+        # None turns batching off, 0 only batches what was already queued together
+        self.batch_delay: float = None
+        self.batch_max_bytes = 1024  # Packed batch size, never more than fits in one datagram
+        self.batch_waiting_since = 0
+        self.reorder_margin = 8  # How far behind the newest frame a missing part has to be before it's assumed lost
+        # Forward error correction. Every fec_group_size data frames get an xor parity frame so one loss per group
+        # can be rebuilt without asking. fec_adaptive picks the group size from the loss rate we see instead
+        self.fec_group_size = 0
+        self.fec_adaptive = False
+        self.loss_rate = 0  # Smoothed share of sent data frames that got lost
+        self.sent_count = 0
+        self.lost_count = 0
+        self.peer_fec_span = 0  # Biggest parity group the other side has sent us
+        # Kernel buffers are sized for target_bandwidth * rtt (within the min/max) so a burst fits while we are busy
+        self.target_bandwidth = 50_000_000
+        self.min_socket_buffer = 256 * 1024
+        self.max_socket_buffer = 16 * 1024 * 1024
+        self.socket_buffers = (0, 0)  # (receive, send) sizes the os actually gave us
+        self.socket_buffer_request = 0  # What size_socket_buffers last asked for
+        self.drain_every = 128  # Datagrams handled between socket drains while working through a big batch
+        self.local_drops = 0  # Datagrams our kernel dropped because we didn't read fast enough
+        self.peer_drops = 0  # Same thing on the other side, from its acks
+        self.pre_parsed = []
+        self.building_blocks = {}
+        self.max_message_size = 1 << 30  # Incoming messages that claim to be bigger are dropped
+        self.built = []  # Ids that finished building this round
+        self.done_markers = {}  # Ids of done messages still in building_blocks, oldest first (used as an ordered set)
+        self.done_marker_limit = 4096
+        self.partial_msg_max_count_bytes = int(math.log(self.buffer_size, 256) // 1 + 1)  # Used for splitting up internal messages (unused)
+        self.frame_generator = FrameGenerator(self.buffer_size)
+        self.rx_frame = self.frame_generator.frame_template()  # Reused for parsing every incoming frame
+        self.send_store = RetransmissionStore(self.frame_generator)
+        self.pending_messages = deque()  # Messages (or (stream id, message) pairs) waiting for space in send_store
+        self.streams: dict[int, Stream] = {}
+        # Unreliable messages (see queue_message) skip send_store and are never acked or resent
+        self.unreliable_sent = {}  # stream id -> sequence number of the last one sent
+        self.unreliable_newest = {}  # stream id -> newest sequence number that came in, to drop stale "unreliable-latest" ones
+        self.unreliable_queue = self.make_stream_queue()  # (stream id, message) for the unreliable messages that came in
+        self.on_unreliable = None  # Called with (stream id, message) as soon as one is read, instead of unreliable_queue
+        self.on_receive_progress = None  # Called with (message id, parts received, total parts) after a round brought some
+        self.receive_progress = set()  # Message ids that got parts this round
+        self.stale_dropped = 0
+        # Messages of at least stream_threshold bytes come out as an IncomingMessage as soon as their first frame is in,
+        # and only about stream_window bytes of one are held for the reader at a time. None turns it off
+        self.stream_threshold: int = None
+        self.stream_window = 4 * 1024 * 1024
+        self.on_incoming = None  # Called with each IncomingMessage as it starts, instead of it coming out like a message
+        self.incoming_windows = set()  # Ids of the IncomingMessages still coming in
+        self.last_updated: int = None
+
+    def process_incoming(self) -> list:
+        """
+        One round of work after new datagrams were put in pre_parsed (or a timer came due)
+        Returns the messages that finished building
+        """
+        # Parse all available frames in the partial
+        self.distribute_stored()
+        for a in self.receive_progress:
+            assembler = self.building_blocks[a]
+            self.on_receive_progress(a, assembler.received, assembler.total_parts)
+        self.receive_progress.clear()
+
+        current_time = time.time()
+        if self.incoming_windows:
+            self.check_windows(current_time)
+
+        # Let the other side know what arrived
+        self.queue_acks()
+
+        for name in self.timers.pop_due(current_time):
+            self.on_timer(name, current_time)
+
+        # Send whatever the window and pacing allow
+        self.flush_send_buffer()
+
+        return self.pop_finished_messages()
+
+    def queue_message(self, data, stream: int = 0, delivery: str = None, handle: SendHandle = None):
+        """
+        Where sent messages start. delivery is one of DELIVERY_MODES, by default the stream's (reliable for stream 0)
+        Unreliable ones go out right away as one 0x12 datagram, so bigger ones are sent reliably instead
+        handle finishes once the other side confirmed the message (right away for unreliable ones)
+        """
+        if delivery is None:
+            delivery = self.streams[stream].delivery if stream in self.streams else "reliable"
+        elif delivery not in DELIVERY_MODES:
+            raise ValueError(f"delivery has to be one of {DELIVERY_MODES}")
+        if delivery != "reliable":
+            if len(data) < self.frame_generator.single_space:
+                self.send_unreliable(data, stream, delivery == "unreliable-latest")
+                if handle:
+                    handle.finish()
+                return
+            log_txt(f"{self.src_port}: {len(data)} bytes is too big to send unreliably", "udp send msg")
+        self.pending_messages.append((stream, data, handle) if stream or handle else data)
+
+    def send_unreliable(self, data, stream: int = 0, latest: bool = False):
+        seq = (self.unreliable_sent.get(stream, -1) + 1) & STREAM_SEQ_MASK
+        self.unreliable_sent[stream] = seq
+        m_id = itob_format(stream << STREAM_SEQ_BITS | seq, self.frame_generator.id_len)
+        # Doesn't wait behind reliable data, but still goes through the pacing (see flush_send_buffer)
+        self.scheduler.add_unreliable(stream, b"\x12" + m_id + (b"\x01" if latest else b"\x00") + data, latest)
+
+    def incoming_unreliable(self, data):
+        size = self.frame_generator.id_len
+        m_id = int.from_bytes(data[1:1 + size], "big")
+        stream, seq = m_id >> STREAM_SEQ_BITS, m_id & STREAM_SEQ_MASK
+        if data[1 + size]:  # Only newer than what we already handed out counts
+            newest = self.unreliable_newest.get(stream)
+            if newest is not None and not 0 < (seq - newest) & STREAM_SEQ_MASK < 1 << (STREAM_SEQ_BITS - 1):
+                log_txt(f"{self.src_port}: dropping stale unreliable {stream}/{seq}", "udp distribute")
+                self.stale_dropped += 1
+                return
+            self.unreliable_newest[stream] = seq
+        msg = bytes(data[2 + size:])  # data can be a reused receive buffer
+        if self.on_unreliable:
+            self.on_unreliable(stream, msg)
+        else:
+            self.unreliable_queue.put_nowait((stream, msg))
+
+    def admit_pending(self):
+        """
+        Only start sending messages we have room to remember
+        """
+        while self.pending_messages:
+            entry = self.pending_messages[0]
+            stream_id, data, handle = entry if isinstance(entry, tuple) else (0, entry, None)
+            if not self.send_store.has_space(len(data)):
+                break
+            if not stream_id and self.batch_delay is not None and len(data) + 2 <= self.batch_space:
+                if not self.admit_batch():
+                    break
+                continue
+            self.pending_messages.popleft()
+            self.send_msg(data, stream=stream_id, handle=handle)
+
+    @property
+    def batch_space(self) -> int:
+        return min(self.batch_max_bytes, self.frame_generator.single_space)
+
+    def admit_batch(self) -> bool:
+        """
+        Packs the small messages at the front of pending_messages into one 0x0f
+        Returns False if they are being held back for more to show up
+        """
+        now = time.time()
+        if not self.batch_waiting_since:
+            self.batch_waiting_since = now
+        messages = []
+        handles = []
+        size = 0
+        for a in self.pending_messages:
+            stream_id, data, handle = a if isinstance(a, tuple) else (0, a, None)
+            if stream_id or size + len(data) + 2 > self.batch_space:  # Stream messages need their own ids
+                break
+            size += len(data) + 2
+            messages.append(data)
+            if handle:
+                handles.append(handle)
+        full = len(messages) < len(self.pending_messages)  # Stopped on something that didn't fit
+        if not full and now < self.batch_waiting_since + self.batch_delay:
+            self.timers.set("batch", self.batch_waiting_since + self.batch_delay)
+            return False
+        self.batch_waiting_since = 0
+        for a in messages:
+            self.pending_messages.popleft()
+        if len(messages) == 1:
+            self.send_msg(messages[0], handle=handles[0] if handles else None)
+            return True
+        stored = self.send_store.add(self.frame_generator.pack_batch(messages), m_type=b"\x0f", single=True)
+        log_txt(f"{self.src_port}: batched {len(messages)} messages into [{stored.id}]", "udp send msg")
+        stored.last_update = now
+        stored.handles = handles
+        self.scheduler.add(stored)
+        return True
+
+    @abstractmethod
+    def send_bytes(self, data: bytes, urgent: bool = False):
+        """
+        Hands one datagram to the socket. data can be a reused buffer, so anything that holds on to it has to copy it
+        urgent datagrams go ahead of anything still waiting to be written
+        """
+
+    def drain(self):
+        """
+        Moves whatever the socket has into pre_parsed. Called in between other work so the kernel buffer doesn't fill up
+        """
+        pass
+
+    def release_received(self):
+        """
+        Everything in pre_parsed has been handled. Anything that was kept from it was copied
+        """
+        pass
+
+    def resize_socket_buffers(self):
+        """
+        Redoes size_socket_buffers once the rtt is known better. Needs the subclass to know its socket
+        """
+        pass
+
+    def size_socket_buffers(self, sock):
+        """
+        Asks for 2x bandwidth * rtt to leave room for a burst. Only redone once that moved by a quarter since
+        the last time we asked. Linux hands back double what was set (it counts its own overhead), so that's halved
+        again for socket_buffers
+        """
+        want = int(min(self.max_socket_buffer, max(self.min_socket_buffer, 2 * self.target_bandwidth * self.rtt)))
+        if abs(want - self.socket_buffer_request) < want / 4:
+            return
+        self.socket_buffer_request = want
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, want)
+            except OSError:
+                pass
+        scale = 2 if sys.platform.startswith("linux") else 1
+        self.socket_buffers = (sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // scale, sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // scale)
+        log_txt(f"{self.src_port}: socket buffers set to {self.socket_buffers}", "udp buffers")
+
+    def connection_stats(self) -> dict:
+        return {
+            "rtt": self.rtt,
+            "rto": self.rto,
+            "window": self.congestion.window,
+            "in_flight": self.in_flight,
+            "loss_rate": self.loss_rate,
+            "local_drops": self.local_drops,
+            "peer_drops": self.peer_drops,
+            "socket_buffers": self.socket_buffers,
+            "queues": self.scheduler.depths(),
+            "stale_dropped": self.stale_dropped,
+            "unreliable_dropped": self.scheduler.unreliable_dropped,
+            "sending": len(self.send_store),
+            "receiving": sum(1 for a in self.building_blocks.values() if not a.done),
+        }
+
+    def on_timer(self, name, now: float):
+        """
+        Timers are only checked once they are due, and reschedule themselves if what they track moved on since
+        """
+        if name == "heartbeat":
+            self.check_heartbeat(now)
+        elif name == "send timeout":
+            self.check_send_timeouts(now)
+        elif name == "buffers":
+            self.resize_socket_buffers()
+            self.timers.set("buffers", now + self.rtt_probe_interval)
+        elif name == "ack":
+            self.queue_acks()
+        elif name[0] == "window":
+            pass  # check_windows already ran this round
+        elif name[0] == "missing":
+            # Check an "In progress" message to see if anything is past it's latency and needs to re-request frames
+            k = name[1]
+            v = self.building_blocks.get(k)
+            if v is None or v.done:
+                return
+            if v.last_update + self.rto * 2 ** v.retries <= now:
+                log_txt(f"{self.src_port}: found [{k}] is missing frames", "udp run")
+                self.request_missing_frames(k)
+                v.last_update = now
+                v.retries = min(v.retries + 1, 5)  # Back off until something new shows up
+            self.timers.set(name, v.last_update + self.rto * 2 ** v.retries)
+        # "pacing" and "batch" just need the loop to run again
+
+    def schedule_timers(self, now: float):
+        """
+        Works out when the loop next has to wake up on its own
+        """
+        if self.probe_sent_at:
+            heartbeat = self.probe_sent_at + self.rto
+        else:
+            heartbeat = self.last_action + self.max_no_action_delay
+            if self.last_frame_at + self.rtt_probe_interval > now:
+                heartbeat = min(heartbeat, self.rtt_estimator.last_sample + self.rtt_probe_interval)
+        self.timers.set("heartbeat", max(heartbeat, now))
+
+        send_timeout = self.last_ack + self.rto if self.in_flight else None
+        for stored in self.send_store.messages.values():
+            if stored.next_part == stored.total_parts or stored.window_stalled():
+                poke = stored.last_update + self.rto
+                send_timeout = poke if send_timeout is None else min(send_timeout, poke)
+        if send_timeout is None:
+            self.timers.cancel("send timeout")
+        else:
+            self.timers.set("send timeout", max(send_timeout, now))
+
+        # Data is waiting on pacing rather than on acks
+        waiting = self.scheduler.unreliable or self.scheduler.has_frames() and self.in_flight < self.congestion.window
+        if waiting and not self.write_blocked:
+            self.timers.set("pacing", now + self.congestion.next_send_delay(self.rtt))
+
+    def distribute_stored(self):
+        for index, a in enumerate(self.pre_parsed):  # drain() can add to the list while we go
+            if index % self.drain_every == self.drain_every - 1:
+                self.drain()
+            if len(a) == 0:
+                continue
+            elif a == b'\x00':
+                # Not sure if this should be commented out or not
+                # This message also means the buffer is empty
+                # self.dest_socket_buffer_filled = 0
+                pass
+            elif a == b"\x02":
+                self.probe_answered()
+            elif a == b"\x04":
+                log_txt(f"{self.src_port}: late verify ack", "udp distribute")
+            elif a == b'\x01':
+                self.send_buffer.append(b"\x02")
+            elif a == b'\x03':
+                self.send_buffer.append(b'\04')
+            elif a[0] == 16:
+                # Unpacked onto the end of the list so they get handled in this same loop
+                self.pre_parsed.extend(self.frame_generator.split_batch(a[1:], copy=False))
+            elif a[0] == 5 or a[0] == 6:  # I guess this op turns it into an int
+                self.rx_frame.parse(a)
+                self.incoming_organizer(self.rx_frame)
+            elif a[0] == 12:
+                self.rx_frame.parse(a)
+                self.incoming_parity(self.rx_frame)
+            elif a[0] == 13 or a[0] == 15:
+                self.incoming_single(a)
+            elif a[0] == 14:
+                self.read_single_acks(a)
+            elif a[0] == 18:
+                self.incoming_unreliable(a)
+            elif a[0] == 11:
+                self.read_ack(a)
+            elif a[0] == 9:
+                # We can now delete from saved
+                done_id = int.from_bytes(a[1:], "big")
+                self.message_completed(done_id)
+                log_txt(f"{self.src_port}: del [{done_id}] after completion flag", "udp distribute")
+            elif a[0] == 8:
+                # Right now we are assuming that nothing will arrive after the \x08
+                # This lets us start requesting for missing information as quick as possible before waiting for the latency timeout
+                done_id = int.from_bytes(a[1:], "big")
+                if done_id in self.building_blocks:
+                    assembler = self.building_blocks[done_id]
+                    assembler.done_requests += 1
+                    if assembler.done and assembler.done_requests > 1:
+                        # The other side is still asking after its first 0x08 so our 0x09 probably got lost
+                        self.send_buffer.append(b"\x09" + itob_format(done_id, self.frame_generator.id_len))
+                self.request_missing_frames(done_id)
+                log_txt(f"{self.src_port}: Done requesting missing", "udp distribute")
+            elif a[0] == 10:
+                missing_id, ranges = self.frame_generator.read_resend_request(a)
+                log_txt(f"{self.src_port}: [{missing_id}] will resend ranges {ranges}", "udp distribute")
+                self.queue_resend(missing_id, ranges)
+            elif a[0] == 7:  # Older per part version of 0x0a
+                log_txt(f"{self.src_port}: starting to resend", "udp distribute")
+                missing_id = int.from_bytes(a[1: 1 + self.frame_generator.id_len], "big")
+                temp = a[1 + self.frame_generator.id_len:]
+                parts = []
+                while temp:
+                    parts.append(int.from_bytes(temp[:self.frame_generator.msg_part_len], "big"))
+                    temp = temp[self.frame_generator.msg_part_len:]
+                log_txt(f"{self.src_port}: [{missing_id}] will resend {parts}", "udp distribute")
+                self.queue_resend(missing_id, [(b, b + 1) for b in parts])
+
+        self.pre_parsed.clear()
+        self.release_received()
+
+    def send_msg(self, data: bytes, weight: int = None, stream: int = 0, handle: SendHandle = None) -> StoredMessage:
+        """
+        We are sending a normal client/content message
+        Frames are built from send_store as the window lets them go out so the payload is never copied up front
+        weight is how many frames it sends per turn while other messages are sending too (the stream's by default)
+        """
+        m_id = None
+        if stream:
+            lane = self.stream(stream)
+            m_id = stream << STREAM_SEQ_BITS | lane.next_send
+            lane.next_send = (lane.next_send + 1) & STREAM_SEQ_MASK
+            if weight is None:
+                weight = lane.weight
+        stored = self.send_store.add(data, single=self.single_datagram and len(data) <= self.frame_generator.single_space, m_id=m_id)
+        log_txt(f"{self.src_port}: queueing [{stored.id}] to send", "udp send msg")
+        stored.last_update = time.time()
+        stored.weight = weight or 1
+        if handle:
+            stored.handles.append(handle)
+        self.scheduler.add(stored)
+        return stored
+
+    def next_data_frame(self):
+        """
+        Picks the next frame to go out. Resends come before parts that were never sent
+        Returns (stored message, part, is a resend) or None
+        """
+        return self.scheduler.next_frame(self.send_store)
+
+    def flush_send_buffer(self):
+        """
+        Control datagrams always go out. Unreliable datagrams and data frames only go out while the pacing allows it,
+        and data frames also need room in the congestion window
+        """
+        now = time.time()
+        while not self.write_blocked and self.congestion.can_send(self.rtt, now):
+            if self.scheduler.unreliable:
+                datagram = self.scheduler.next_unreliable()
+                if datagram is None:  # Dropped while it waited
+                    continue
+                try:
+                    self.send_with_control(datagram)
+                except BlockingIOError:
+                    self.scheduler.unreliable.appendleft([None, datagram])
+                    self.write_blocked = True
+                    break
+                self.congestion.on_send()
+                continue
+            if self.in_flight >= self.congestion.window:
+                break
+            found = self.next_data_frame()
+            if found is None:
+                break
+            stored, part, resend = found
+            try:
+                self.send_with_control(stored.frame(part))
+            except BlockingIOError:
+                # OS send buffer is full so try again once the socket is writable
+                self.resend_buffer.appendleft((stored.id, part, part + 1))
+                self.write_blocked = True
+                break
+            stored.sent_at[part] = 0 if resend else now
+            stored.in_flight += 1
+            self.in_flight += 1
+            self.congestion.on_send()
+            self.count_sent(1)
+            if not resend and not stored.single:
+                self.send_parity(stored, part)
+        # Whatever didn't fit in with data frames
+        self.send_with_control()
+
+    def send_with_control(self, data=None):
+        """
+        Sends data (a data frame) with as much of send_buffer as fits after it in one 0x10 container
+        Without data the whole send_buffer goes out, packed into as few containers as it takes
+        """
+        while data is not None or self.send_buffer:
+            batch = [] if data is None else [data]
+            size = 1 if data is None else 3 + len(data)
+            while self.send_buffer and size + 2 + len(self.send_buffer[0]) <= self.container_size:
+                size += 2 + len(self.send_buffer[0])
+                batch.append(self.send_buffer.popleft())
+            if not batch:  # Too big to go in a container
+                batch.append(self.send_buffer.popleft())
+            # Control only datagrams can skip ahead of data the io still has queued
+            if len(batch) == 1:
+                self.send_bytes(batch[0], urgent=data is None)
+            else:
+                self.send_bytes(b"\x10" + self.frame_generator.pack_batch(batch), urgent=data is None)
+            if data is not None:
+                return  # The rest can ride along with the next frame
+
+    def send_parity(self, stored: StoredMessage, part: int):
+        """
+        Called after each new data frame. Picks the parity group size when a group starts and sends the
+        parity frame once the last part of the group went out. Parity frames are never acked or resent
+        so they don't count as in flight
+        """
+        if part == stored.fec_start:
+            size = self.next_fec_group_size()
+            stored.fec_size = min(size, stored.total_parts - part) if size else 0
+        if not stored.fec_size:
+            stored.fec_start = part + 1
+            return
+        if part == stored.fec_start + stored.fec_size - 1:
+            self.send_bytes(stored.parity_frame(stored.fec_start, stored.fec_size))
+            self.congestion.on_send()
+            stored.fec_start = part + 1
+
+    def next_fec_group_size(self) -> int:
+        if not self.fec_adaptive:
+            return min(self.fec_group_size, 255)
+        if self.loss_rate < .001:
+            return 0
+        # Aim for about 10x the loss rate in redundancy
+        return int(min(64, max(4, .1 / self.loss_rate)))
+
+    def count_sent(self, sent: int = 0, lost: int = 0):
+        """
+        Keeps loss_rate up to date. Lost counts both frames asked for again and frames rebuilt from parity
+        """
+        self.sent_count += sent
+        self.lost_count += lost
+        if self.sent_count >= 256:
+            self.loss_rate += (self.lost_count / self.sent_count - self.loss_rate) / 4
+            self.sent_count = 0
+            self.lost_count = 0
+
+    def new_assembler(self, m_id: int, total_parts: int) -> MessageAssembler:
+        """
+        Sets up building a message we just got the first frame of. Big ones (see stream_threshold) are handed out
+        as an IncomingMessage right away, through on_incoming or like a finished message
+        Returns None for messages over max_message_size
+        """
+        space = self.frame_generator.message_space
+        if total_parts * space > self.max_message_size:
+            # total_parts comes straight from the other side, so check it before allocating anything for it
+            log_txt(f"{self.src_port}: [{m_id}] refusing a {total_parts} part message", "udp organizer")
+            return None
+        if self.stream_threshold is None or total_parts * space < self.stream_threshold:
+            assembler = MessageAssembler(total_parts, space)
+        else:
+            log_txt(f"{self.src_port}: [{m_id}] streaming to the reader", "udp organizer")
+            incoming = IncomingMessage(self, m_id, total_parts * space, window=self.stream_window)
+            incoming.on_read = self.reader_made_room
+            assembler = StreamingAssembler(total_parts, space, incoming)
+            self.incoming_windows.add(m_id)
+            if self.on_incoming:
+                self.on_incoming(incoming)
+            else:
+                self.single_messages.append((m_id, incoming))
+        self.building_blocks[m_id] = assembler
+        self.timers.set(("missing", m_id), time.time() + self.rto)
+        return assembler
+
+    def reader_made_room(self):
+        """
+        Called from the reader's thread once it took a good part of an IncomingMessage's window
+        The loop picks it up in check_windows, subclasses just have to make sure it runs soon
+        """
+        pass
+
+    def check_windows(self, now: float):
+        """
+        Acks streamed messages again once their reader made room. Also when the other side stopped sending but there
+        is room, in case the ack that would have told it got lost
+        """
+        for m_id in list(self.incoming_windows):
+            assembler = self.building_blocks.get(m_id)
+            if assembler is None or assembler.done:
+                self.incoming_windows.discard(m_id)
+                continue
+            end = assembler.window_end()
+            stalled = end > assembler.highest + 1 and max(assembler.last_update, assembler.advertised_at) + self.rto < now
+            if end >= assembler.advertised_end + assembler.ring_parts // 4 or stalled:
+                self.pending_acks.setdefault(m_id, assembler.highest)
+                self.ack_due = now
+
+    def incoming_parity(self, frame: Frame):
+        assembler = self.building_blocks.get(frame.id)
+        if assembler is None:
+            assembler = self.new_assembler(frame.id, frame.total_parts)
+            if assembler is None:
+                return
+        count, first = frame.part >> 32, frame.part & 0xFFFFFFFF
+        self.peer_fec_span = max(self.peer_fec_span, count)
+        if assembler.add_parity(first, count, frame.data):
+            log_txt(f"{self.src_port}: [{frame.id}] rebuilt a part from parity", "udp organizer")
+            assembler.last_update = time.time()
+            self.pending_acks[frame.id] = first + count - 1
+            if assembler.done:
+                self.message_built(frame.id)
+
+    def queue_resend(self, m_id: int, ranges: list[tuple[int, int]]):
+        """
+        The other side is missing these parts. They stop counting as in flight and are queued to go out again
+        """
+        if m_id not in self.send_store:
+            return
+        stored = self.send_store[m_id]
+        count = 0
+        for start, end in ranges:
+            end = min(end, stored.next_part)  # Never sent parts are still coming anyways
+            if start < end:
+                # Ranges go straight into the resend buffer and get expanded from send_store as they are sent
+                self.resend_buffer.append((m_id, start, end))
+                count += end - start
+        if count:
+            self.count_sent(lost=count)
+            for a in stored.handles:
+                a.progress(resends=count)
+            count = min(count, stored.in_flight)
+            stored.in_flight -= count
+            self.in_flight -= count
+            self.congestion.on_loss(self.rtt)
+        stored.last_update = time.time()
+
+    def read_ack(self, data):
+        """
+        <0x0b><id><first missing part><received count><latest part><parts rebuilt from parity><kernel drops>[<window end>]
+        The window end is only there when the other side streams the message to its reader
+        """
+        size = self.frame_generator.msg_part_len
+        offset = 1 + self.frame_generator.id_len
+        m_id = int.from_bytes(data[1:offset], "big")
+        received = int.from_bytes(data[offset + size:offset + 2 * size], "big")
+        latest = int.from_bytes(data[offset + 2 * size:offset + 3 * size], "big")
+        repaired = int.from_bytes(data[offset + 3 * size:offset + 4 * size], "big")
+        drops = int.from_bytes(data[offset + 4 * size:offset + 5 * size], "big")
+        if drops > self.peer_drops:
+            # The other side can't keep up, which isn't the network's fault. Slow down, but don't count it
+            # as loss or fec would just add more datagrams for it to drop
+            log_txt(f"{self.src_port}: other side dropped {drops - self.peer_drops} datagrams locally", "udp ack")
+            self.lost_count = max(0, self.lost_count - (drops - self.peer_drops))
+            self.peer_drops = drops
+            self.congestion.on_loss(self.rtt)
+        if m_id not in self.send_store:
+            return
+        stored = self.send_store[m_id]
+        if repaired > stored.repaired:
+            # Still lost frames even if we didn't have to resend them
+            self.count_sent(lost=repaired - stored.repaired)
+            stored.repaired = repaired
+        now = time.time()
+        self.last_ack = now
+        stored.last_update = now
+        if latest < stored.total_parts and stored.sent_at[latest]:
+            self.rtt_estimator.sample(now - stored.sent_at[latest])
+            stored.sent_at[latest] = 0  # Only one sample per send
+        self.acked_frames(stored, received - stored.acked)
+        if len(data) >= offset + 6 * size:
+            self.window_update(stored, int.from_bytes(data[offset + 5 * size:offset + 6 * size], "big"))
+
+    def window_update(self, stored: StoredMessage, end: int):
+        """
+        The other side has room up to part end. Acks can come out of order so the window only ever grows
+        """
+        if stored.window_end is not None:
+            stored.window_end = max(stored.window_end, end)
+            return
+        stored.window_end = end
+        if stored.next_part > end:
+            # Whatever already went out past the window got dropped on the other side, so it goes out again later
+            log_txt(f"{self.src_port}: [{stored.id}] other side only has room up to part {end}", "udp ack")
+            count = min(stored.next_part - end, stored.in_flight)
+            stored.in_flight -= count
+            self.in_flight -= count
+            if stored.next_part == stored.total_parts:
+                self.scheduler.add(stored)
+            stored.next_part = end
+
+    def acked_frames(self, stored: StoredMessage, count: int):
+        if count <= 0:
+            return
+        stored.acked += count
+        for a in stored.handles:
+            a.progress(stored.acked * stored.space)
+        self.congestion.on_ack(count)
+        count = min(count, stored.in_flight)
+        stored.in_flight -= count
+        self.in_flight -= count
+
+    def read_single_acks(self, data):
+        """
+        <0x0e><id><id>... every 0x0d message that came in since the other side last acked
+        """
+        size = self.frame_generator.id_len
+        now = time.time()
+        for a in range(1, len(data) - size + 1, size):
+            m_id = int.from_bytes(data[a:a + size], "big")
+            stored = self.send_store.messages.get(m_id)
+            if stored is None:
+                continue
+            if stored.sent_at[0]:
+                self.rtt_estimator.sample(now - stored.sent_at[0])
+            self.message_completed(m_id)
+
+    def incoming_single(self, data):
+        """
+        <0x0d><id><data> or a 0x0f batch. Always acked, even repeats, since the repeat probably means our ack got lost
+        """
+        size = self.frame_generator.id_len
+        m_id = int.from_bytes(data[1:1 + size], "big")
+        self.single_acks.append(m_id)
+        self.unacked_frames += 1
+        self.last_frame_at = time.time()
+        if m_id in self.single_done:
+            return
+        self.single_done[m_id] = None
+        if len(self.single_done) > self.single_done_limit:
+            del self.single_done[next(iter(self.single_done))]
+        if data[0] == 15:
+            self.single_messages.extend((m_id, a) for a in self.frame_generator.split_batch(data[1 + size:]))
+        else:
+            self.single_messages.append((m_id, bytes(data[1 + size:])))  # data can be a reused receive buffer
+
+    def message_completed(self, m_id: int):
+        if m_id not in self.send_store:
+            return
+        stored = self.send_store[m_id]
+        self.last_ack = time.time()
+        self.acked_frames(stored, stored.total_parts - stored.acked)
+        self.in_flight -= stored.in_flight  # Anything left was a duplicate
+        stored.in_flight = 0
+        self.send_store.remove(m_id)
+        for a in stored.handles:
+            a.finish()
+
+    def fail_handles(self):
+        """
+        The connection is done so nothing still waiting on the other side will be confirmed
+        """
+        error = ConnectionIssue("Connection closed before the message was confirmed")
+        for stored in self.send_store.messages.values():
+            for a in stored.handles:
+                a.finish(error)
+        for a in self.pending_messages:
+            if isinstance(a, tuple) and a[2]:
+                a[2].finish(error)
+        for m_id in self.incoming_windows:
+            assembler = self.building_blocks.get(m_id)
+            if assembler is not None:
+                assembler.incoming.finish(ConnectionIssue("Connection closed before the whole message came in"))
+        self.incoming_windows.clear()
+
+    def check_send_timeouts(self, now: float):
+        """
+        If acks stop coming back everything in flight is assumed lost. Messages that were fully sent but never
+        confirmed get their last part and 0x08 sent again so the other side can ask for whatever it is missing
+        """
+        if self.in_flight and self.last_ack + self.rto < now:
+            log_txt(f"{self.src_port}: no acks in time, dropping window", "udp send timeout")
+            for stored in self.send_store.messages.values():
+                stored.in_flight = 0
+            self.in_flight = 0
+            self.congestion.on_timeout()
+            self.rtt_estimator.on_timeout()
+            self.last_ack = now
+        for stored in self.send_store.messages.values():
+            if stored.last_update + self.rto >= now:
+                continue
+            if stored.next_part == stored.total_parts:
+                log_txt(f"{self.src_port}: [{stored.id}] not confirmed, poking", "udp send timeout")
+                self.resend_buffer.append((stored.id, stored.total_parts - 1, stored.total_parts))
+                if not stored.single:  # A resent 0x0d is the whole message again
+                    self.send_buffer.append(b"\x08" + itob_format(stored.id, self.frame_generator.id_len))
+                stored.last_update = now
+                self.rtt_estimator.on_timeout()
+            elif stored.window_stalled():
+                # Nothing past the window can go out, so the other side won't see a newer part and ask for the gaps
+                # on its own. Its rto is often still the initial guess since it mostly just acks
+                log_txt(f"{self.src_port}: [{stored.id}] stuck on the other side's window, poking", "udp send timeout")
+                self.send_buffer.append(b"\x08" + itob_format(stored.id, self.frame_generator.id_len))
+                stored.last_update = now
+
+    def queue_acks(self):
+        """
+        One ack per message that got frames since the last ack, and 0x0d messages get all theirs packed together
+        Gaps that are more than reorder_margin parts behind the newest part are asked for right away
+        instead of waiting for the 0x08 or the missing frame timer
+        Acks are delayed (see ack_delay) unless they are needed right away or can ride along with outgoing data
+        """
+        if not self.pending_acks and not self.single_acks:
+            return
+        now = time.time()
+        gap = False
+        for m_id in self.pending_acks:
+            assembler = self.building_blocks.get(m_id)
+            if assembler is None or assembler.done:
+                continue
+            gap = gap or assembler.contiguous <= assembler.highest
+            # Leave time for a parity frame to fix things before asking
+            limit = assembler.highest - max(self.reorder_margin, self.peer_fec_span + 1)
+            if m_id in self.incoming_windows and assembler.highest + 1 >= assembler.advertised_end:
+                # Nothing newer can come in past the window's end, so waiting for the margin would only stall it
+                limit = assembler.highest + 1
+            if limit > assembler.requested_until:
+                missing = assembler.missing_ranges(max(assembler.requested_until, assembler.contiguous), limit)
+                self.send_buffer.extend(self.frame_generator.resend_requests(m_id, missing))
+                assembler.requested_until = limit
+
+        if not self.ack_due:
+            self.ack_due = now + self.ack_delay
+        data_waiting = self.scheduler.has_frames() and self.in_flight < self.congestion.window
+        if not (gap or data_waiting or self.unacked_frames >= self.ack_every or now >= self.ack_due):
+            self.timers.set("ack", self.ack_due)
+            return
+        self.ack_due = 0
+        self.unacked_frames = 0
+        self.timers.cancel("ack")
+
+        for m_id, latest in self.pending_acks.items():
+            assembler = self.building_blocks.get(m_id)
+            if assembler is None or assembler.done:  # 0x09 covers it
+                continue
+            fields = [
+                b"\x0b",
+                itob_format(m_id, self.frame_generator.id_len),
+                itob_format(assembler.contiguous, self.frame_generator.msg_part_len),
+                itob_format(assembler.received, self.frame_generator.msg_part_len),
+                itob_format(latest, self.frame_generator.msg_part_len),
+                itob_format(assembler.repaired, self.frame_generator.msg_part_len),
+                itob_format(self.local_drops, self.frame_generator.msg_part_len),
+            ]
+            if m_id in self.incoming_windows:
+                assembler.advertised_end = assembler.window_end()
+                assembler.advertised_at = now
+                fields.append(itob_format(assembler.advertised_end, self.frame_generator.msg_part_len))
+                self.timers.set(("window", m_id), now + self.rto)  # See check_windows
+            self.send_buffer.append(b"".join(fields))
+        self.pending_acks.clear()
+
+        # All the 0x0d acks since last time share datagrams
+        per_datagram = (self.buffer_size - 1) // self.frame_generator.id_len
+        for a in range(0, len(self.single_acks), per_datagram):
+            self.send_buffer.append(b"\x0e" + b"".join(itob_format(b, self.frame_generator.id_len) for b in self.single_acks[a:a + per_datagram]))
+        self.single_acks.clear()
+
+    def send_heartbeat(self):
+        key = b"\x00"  # first byte = 0 means heartbeat
+        self.send_bytes(key)
         self.last_action = time.time()
 
-    @staticmethod
-    def prep_packet(packet: Packet):
-        val = packet.generate()
-        length = len(val)
-        byte_size = length.to_bytes((length.bit_length() + 7) // 8, 'big')
-        return byte_size + val
+    def send_probe(self):
+        """
+        An 0x01 heartbeat that the other side answers with 0x02, which gives us an rtt sample
+        """
+        self.send_bytes(b"\x01")
+        self.probe_sent_at = self.last_action
+        self.unanswered_probes += 1
+
+    def probe_answered(self):
+        if self.probe_sent_at and self.unanswered_probes == 1:  # Can't tell which probe a reply is for after a retry
+            self.rtt_estimator.sample(time.time() - self.probe_sent_at)
+        self.probe_sent_at = 0
+        self.unanswered_probes = 0
+        self.peer_responsive = True
+
+    def check_heartbeat(self, now: float):
+        """
+        Idle connections send a probe, and so do connections that are receiving frames without fresh rtt samples.
+        Unanswered probes get retried every rto (with backoff) until max_unrequited_love of them went unanswered
+        """
+        if self.probe_sent_at:
+            if now > self.probe_sent_at + self.rto:
+                if self.unanswered_probes >= self.max_unrequited_love:
+                    log_txt(f"{self.src_port}: other side stopped answering probes", "udp heartbeat")
+                    self.peer_responsive = False
+                    self.probe_sent_at = 0
+                    self.unanswered_probes = 0
+                else:
+                    self.rtt_estimator.on_timeout()
+                    self.send_probe()
+        elif now > self.last_action + self.max_no_action_delay:
+            log_txt(f"{self.src_port}: sending idle heartbeat", "udp heartbeat")
+            self.send_probe()
+        elif self.last_frame_at + self.rtt_probe_interval > now and self.rtt_estimator.last_sample + self.rtt_probe_interval < now:
+            self.send_probe()
+
+    @property
+    def rtt(self) -> float:
+        return self.rtt_estimator.smoothed
+
+    @property
+    def rtt_var(self) -> float:
+        return self.rtt_estimator.rttvar
+
+    @property
+    def rto(self) -> float:
+        return self.rtt_estimator.rto
+
+    @staticmethod
+    def prep_packet(packet: Packet):
+        val = packet.generate()
+        length = len(val)
+        byte_size = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+        return byte_size + val
+
+    def incoming_organizer(self, frame: Frame):
+        """
+        Copies the frame data into the message's reassembly buffer. Duplicate parts are ignored
+        """
+        # Do message setup
+        assembler = self.building_blocks.get(frame.id)
+        if assembler is None:
+            assembler = self.new_assembler(frame.id, frame.total_parts)
+            if assembler is None:
+                return
+
+        # Don't insert anything if we don't need to
+        if assembler.done:
+            return
+
+        if assembler.insert(frame.part, frame.data):
+            assembler.retries = 0
+            if assembler.parity:
+                assembler.retry_parity(frame.part)
+        assembler.last_update = self.last_frame_at = time.time()
+        self.pending_acks[frame.id] = frame.part
+        self.unacked_frames += 1
+        if self.on_receive_progress:
+            self.receive_progress.add(frame.id)
+
+        if assembler.done:
+            log_txt(f"{self.src_port}: [{frame.id}] detected as done", "udp organizer")
+            self.message_built(frame.id)
+        self.last_updated = frame.id
+
+    def message_built(self, m_id: int):
+        self.send_buffer.append(b"\x09" + itob_format(m_id, self.frame_generator.id_len))
+        self.built.append(m_id)
+
+    def request_missing_frames(self, id_num: int):
+        if id_num not in self.building_blocks:
+            return
+        assembler = self.building_blocks[id_num]
+        if assembler.done:  # Don't request anything if we already have everything
+            log_txt(f"{self.src_port}: message marked as done", "udp request missing")
+            return
+        missing = assembler.missing_ranges()
+        log_txt(f"{self.src_port}: [{id_num}] requesting missing {missing}", "udp request missing")
+        self.send_buffer.extend(self.frame_generator.resend_requests(id_num, missing))
+
+    def pop_finished_messages(self):
+        """
+        Finished messages for stream 0. The ones on other streams go to their stream's out_queue
+        """
+        finished = self.single_messages
+        self.single_messages = []
+        for k in self.built:
+            v = self.building_blocks[k]
+            if v.buffer is not None:  # Streamed ones were handed out already
+                log_txt(f"{self.src_port}: popping [{k}] as done", "udp pop messages")
+                finished.append((k, v.pop()))
+            v.last_update = time.time()
+            # The assembler is kept as a marker that the message is done, so late frames don't start it again.
+            # Only the newest done_marker_limit are kept since ids wrap around and get used again
+            self.done_markers.pop(k, None)
+            self.done_markers[k] = None
+        self.built.clear()
+        while len(self.done_markers) > self.done_marker_limit:
+            old = next(iter(self.done_markers))
+            del self.done_markers[old]
+            self.building_blocks.pop(old, None)
+        out = []
+        for m_id, msg in finished:
+            if m_id >> STREAM_SEQ_BITS:
+                self.stream(m_id >> STREAM_SEQ_BITS).arrived(m_id & STREAM_SEQ_MASK, msg)
+            else:
+                out.append(msg)
+        return out
+
+    def set_buffer_size(self, size: int):
+        self.buffer_size = size
+        self.frame_generator.buffer_size = size
+        return self
+
+    def get_message_status(self, m_id: int):
+        if m_id in self.building_blocks:
+            status = self.building_blocks[m_id].status()
+            return status["received"], status
+        return None
+
+
+class SocketConnectionUDP(UDPConnectionBase, threading.Thread):
+    """
+    You are _looking at_ the thread. You are putting into and taking out of the thread/socket itself
+    I guess this has kinda evolved to try to do tcp things
+    """
+
+    def __init__(self, src_port: int, target: tuple[str, int], in_queue: Queue = None, out_queue: Queue = None):
+        # What if we could inherit a socket if it already exists?
+        threading.Thread.__init__(self)
+        UDPConnectionBase.__init__(self, src_port, target)
+        self.daemon = True  # Self terminating
+        # Init queue objects if needed
+        if in_queue:
+            self.in_queue = in_queue
+        else:
+            self.in_queue = WakeupQueue()
+        if out_queue:
+            self.out_queue = out_queue
+        else:
+            self.out_queue = Queue()
+
+        # noinspection PyTypeChecker
+        self.socket: socket.socket = None
+        self.io: DatagramIO = None  # Reads and writes datagrams, batched where the os allows it
+        self.io_backend = None  # DatagramIO class to use instead of the best available one
+        self.on_message = None  # pass message to callback if set
+        # The mainloop sleeps in select on the socket and the in_queue wakeup until one of the timers is due
+        self.selector: selectors.BaseSelector = None
+        self.queue_poll_interval = .05  # How often a plain Queue (that can't wake us up) passed in as in_queue gets checked
+
+        self.debug = []  # NEED TO REMOVE LATER
+
+    def run(self) -> None:
+        """
+        Starts the mainloop of the thread
+        """
+        # This will wait until both prove they are connected
+        self._setup_socket()
+
+        while self.alive:
+            # Sleep until there is something to read, something queued or a timer is due
+            self.wait_for_events()
+
+            # Fixme we still have a bug where every 40th frame gets dropped
+            self.store_incoming()  # may want to call this multiple times to prioritize not losing data
+
+            # Send out any read messages
+            for a in self.process_incoming():
+                log_txt(f"{self.src_port}: popping finished messages into out_queue", "udp run")
+                self.out_queue.put(a)
+            # Execute any incoming commands
+            # pprint.pprint(self.__dict__)
+            while not self.in_queue.empty():
+                val = self.in_queue.get()
+                log_txt(f"{self.src_port}: reading in_queue input [{val if len(val) < 100 else 'too long'}]", "udp run")
+                if isinstance(val, str):
+                    if val == "kill":
+                        self.alive = False
+                        self._shutdown_socket()
+                        return
+                    self.out_queue.put((val, eval(val)))  # FIXME PROBABLY A MASSIVE SECURITY RISK
+
+                elif isinstance(val, (bytes, bytearray, memoryview)):
+                    self.queue_message(val)
+                elif isinstance(val, tuple):  # (stream id, message[, delivery, handle]) from send()
+                    self.queue_message(val[1], val[0], *val[2:])
+                # It's probably better to make as done sooner, but this lets us see when we have parsed the message
+                self.in_queue.task_done()
+                log_txt(f"{self.src_port}: in_queue emptied", "udp run")
+            self.admit_pending()
+
+            while self.on_message and not self.out_queue.empty():
+                log_txt(f"{self.src_port}: executing on_message callback", "udp run")
+                self.on_message(self.out_queue.get())
+                self.out_queue.task_done()
+                self.drain()  # Callbacks can take a while
+
+            self.schedule_timers(time.time())
+
+        time.sleep(1)
+        self._shutdown_socket()
+        time.sleep(1)
+
+    def wait_for_events(self):
+        # Whatever the io batched up this round goes out before we sleep
+        if not self.io.flush():
+            self.write_blocked = True
+        timeout = self.timers.timeout(time.time())
+        if not isinstance(self.in_queue, WakeupQueue) and (timeout is None or timeout > self.queue_poll_interval):
+            timeout = self.queue_poll_interval
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if self.write_blocked else selectors.EVENT_READ
+        if self.selector.get_key(self.socket).events != events:
+            self.selector.modify(self.socket, events)
+        for key, mask in self.selector.select(timeout):
+            if key.fileobj is self.in_queue:
+                self.in_queue.drain()
+            elif mask & selectors.EVENT_WRITE:
+                self.write_blocked = False
 
-    def store_incoming(self):
+    def _setup_socket(self):
         """
-        No authentication is done here because we assume nat is taking care of it rn
-        This can be optimized because we use len checking and exceptions
+        Little abstraction/modulation for which was used in testing
+        FIXME We have got to use a better flow
         """
-        first = True
-        current = 0
-        start_len = len(self.pre_parsed)
-        while len(self.pre_parsed) > current or first:
-            first = False
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("", self.src_port))
+        self.size_socket_buffers(self.socket)
+        time_limit = self.connect_try_timeout
+        limit = self.connect_try_limit
+        timeout_len = time_limit / limit
+        count = 0
+        self.socket.settimeout(timeout_len)
+        log_txt(f"Setting up {self.src_port}\n", "verification")
+        while count < limit and not self.verified_connection:
             try:
-                current = len(self.pre_parsed)
-                self.pre_parsed.append(self.socket.recv(self.buffer_size))  # I probably need to try for exceptions here; I forgot how non-blocking works
-                if len(self.pre_parsed) < 10:
-                    # Keep the logging reasonable
-                    log_txt(f"{self.src_port}: preparsed -> {self.pre_parsed}", "udp store")
+                data = self.socket.recv(self.buffer_size)
+                if data == b"\x04":
+                    log_txt(f"{self.src_port}: verify confirmed -> marking", "verification")
+                    self.verified_connection = True
+                elif data == b"\x03":
+                    log_txt(f"{self.src_port}: verify requested -> responding", "verification")
+                    self.socket.sendto(b"\x04", self.target)
+                    self.verified_connection = True
                 else:
-                    log_txt(f"{self.src_port}: parsed extended (too long already)", "udp store")
-            except BlockingIOError:
-                pass
+                    log_txt(f"{self.src_port}: recv {data} instead", "verification")
+            except TimeoutError:
+                log_txt(f"{self.src_port}: con_error 1; send request", "verification")
+                self.socket.sendto(b"\x03", self.target)
+                count += 1
+            except socket.timeout:
+                log_txt(f"{self.src_port}: con_error 2; send request", "verification")
+                self.socket.sendto(b"\x03", self.target)
+                count += 1
             except ConnectionResetError:
-                # TODO do we care about this?
-                # print("connection reset error")
-                # self.alive = False
-                pass
-        if len(self.pre_parsed) != start_len and not (len(self.pre_parsed) == 1 and self.pre_parsed[0] == b"\x00"):  # We should count this better so that we don't send way too many beats
-            self.send_heartbeat()
+                log_txt(f"{self.src_port}: con_error 3; send request", "verification")
+                self.socket.sendto(b"\x03", self.target)
+                count += 1
+            time.sleep(timeout_len)
 
-    def incoming_organizer(self, frame: Frame):
-        """
-        This is designed to overwrite old packets if the identification is the same
-        """
-        # Do packet setup
-        if frame.id not in self.building_blocks:
-            self.building_blocks[frame.id] = {}
-            self.building_blocks[frame.id]["meta"] = {"len": frame.total_parts, "done": False, "last update": 0}
+        if count == limit:
+            log_txt(f"{self.src_port}: Giving up verification", "verification")
+            raise ConnectionNoResponse("Failed to verify socket on other side")
 
-        # Don't insert anything if we don't need to
-        if self.building_blocks[frame.id]["meta"]["done"]:
-            return
+        log_txt(f"{self.src_port}: almost done with verification", "verification")
+        self.socket.settimeout(0)
+        self.socket.setblocking(False)
+        io_buffer_size = max(2048, self.buffer_size)
+        self.io = self.io_backend(self.socket, buffer_size=io_buffer_size) if self.io_backend else best_datagram_io(self.socket, buffer_size=io_buffer_size)
+        self.io.track_drops()
+        self.timers.set("buffers", time.time() + self.rtt_probe_interval)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        if isinstance(self.in_queue, WakeupQueue):
+            self.selector.register(self.in_queue, selectors.EVENT_READ)
+        self.alive = True
+        log_txt(f"{self.src_port}: Done with verification", "verification")
 
-        self.building_blocks[frame.id][frame.part] = frame
-        self.building_blocks[frame.id]["meta"]["last update"] = time.time()
+    def _shutdown_socket(self):
+        # todo send a kill message/byte because the other side thinks we're still alive
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if isinstance(self.in_queue, WakeupQueue):
+            self.in_queue.close()
+        self.socket.close()
+        self.fail_handles()
 
-        if self.building_blocks[frame.id]["meta"]["len"] == len(self.building_blocks[frame.id]) - 1:  # -1 for meta key
-            log_txt(f"{self.src_port}: [{frame.id}] detected as done", "udp organizer")
-            self.building_blocks[frame.id]["meta"]['done'] = True
-            self.send_buffer.put(b"\x09" + itob_format(frame.id, self.frame_generator.id_len))
-        self.last_updated = frame.id
+    def send_bytes(self, data: bytes, urgent: bool = False):
+        # This is the last time we see the bytes (the io copies them if it has to hold on to them)
+        self.io.send(data, self.target, urgent)
+        self.last_action = time.time()
+        if self.io.pending >= self.io.batch_size:
+            # Stop making data frames until the socket takes these, or control would end up queued behind lots of them
+            self.write_blocked = True
+        # print(data.decode())
 
-    def request_missing_frames(self, id_num: int):
-        if id_num in self.building_blocks:
-            if self.building_blocks[id_num]["meta"]["done"]:  # Don't request anything if we already have everything
-                log_txt(f"{self.src_port}: message marked as done", "udp request missing")
-                return
-            total_nums = self.building_blocks[id_num]["meta"]["len"]
+    def store_incoming(self):
+        """
+        No authentication is done here because we assume nat is taking care of it rn
+        This can be optimized because we use len checking and exceptions
+        """
+        self.drain()
+        if len(self.pre_parsed) < 10:
+            # Keep the logging reasonable
+            log_txt(f"{self.src_port}: preparsed -> {self.pre_parsed}", "udp store")
         else:
-            total_nums = 0
-        missing = []  # What messages are missing packets
-        for a in range(total_nums):
-            if a not in self.building_blocks[id_num]:
-                missing.append(a)
-        log_txt(f"{self.src_port}: [{id_num}] requesting missing {missing}", "udp request missing")
+            log_txt(f"{self.src_port}: parsed extended (too long already)", "udp store")
+        # No heartbeat back for every read anymore. Acks (delayed, and packed in with data when there is some) do that job
 
-        buffer_space = int((self.buffer_size - (1 + self.frame_generator.id_len)) / self.frame_generator.msg_part_len)
-        while missing:
-            chunk = missing[:buffer_space]
-            missing = missing[buffer_space:]
-            temp_b = b"\x07" + itob_format(id_num, self.frame_generator.id_len)
-            for a in chunk:
-                temp_b += itob_format(a, self.frame_generator.msg_part_len)
-            self.send_buffer.put(temp_b)
-
-    def pop_finished_messages(self):
-        out = []
-        completed_parts = {}
-        for k, v in list(self.building_blocks.items()):
-            if v['meta']['done'] and len(v) > v['meta']['len']:  # Done and still holding all parts
-                log_txt(f"{self.src_port}: {k} is ready for popping", "udp pop messages")
-                # buffer = b''
-                # for a in range(0, v['meta']['len']):
-                #     buffer += v[a].data
-                buffer = b"".join([v[a].data for a in range(0, v["meta"]["len"])])
-                out.append(buffer)
-                log_txt(f"{self.src_port}: popping [{k}] as done", "udp pop messages")
-                # fixme we want to delete only the data when done
-                completed_parts[k] = {"meta": v['meta']}
-                completed_parts[k]['meta']['last update'] = time.time()
-                del self.building_blocks[k]
+    def drain(self):
+        while True:
+            batch = self.io.recv_views()  # Views into pooled slabs, recycled in release_received
+            self.pre_parsed.extend(batch)
+            if len(batch) < self.io.batch_size:  # A short batch means the socket is empty
+                break
+        if self.io.kernel_drops is not None and self.io.kernel_drops > self.local_drops:
+            log_txt(f"{self.src_port}: kernel dropped {self.io.kernel_drops - self.local_drops} datagrams", "udp store")
+            self.local_drops = self.io.kernel_drops
 
-        # Merge the dictionaries
-        self.building_blocks = {**self.building_blocks, **completed_parts}
+    def release_received(self):
+        self.io.release()
 
-        return out
+    def resize_socket_buffers(self):
+        self.size_socket_buffers(self.socket)
 
-    def set_buffer_size(self, size: int):
-        self.buffer_size = size
-        self.frame_generator.buffer_size = size
-        return self
+    def reader_made_room(self):
+        if isinstance(self.in_queue, WakeupQueue):
+            self.in_queue.poke()  # Otherwise the queue_poll_interval wakeup has to do
 
     def block_until_verify(self, timeout: int = 2):
         start = time.time()
@@ -707,6 +2661,24 @@ class SocketConnectionUDP(threading.Thread):
     def block_until_message(self, timeout: int = 1) -> bytes:
         return self.out_queue.get(timeout=timeout)
 
+    def send(self, data: bytes, stream: int = 0, delivery: str = None) -> SendHandle:
+        """
+        Same as putting (stream, message, delivery, handle) in in_queue (a plain message works too)
+        The handle finishes once the other side has the whole message
+        """
+        if delivery is not None and delivery not in DELIVERY_MODES:
+            raise ValueError(f"delivery has to be one of {DELIVERY_MODES}")
+        handle = SendHandle(self.make_future(), len(data))
+        self.in_queue.put((stream, data, delivery, handle))
+        return handle
+
+    def send_file(self, path, offset: int = 0, stream: int = 0) -> SendHandle:
+        """
+        Sends the file from offset on as one message (so offset picks up a cut off download)
+        Frames are cut straight from an mmap of the file, it never gets read into memory as a whole
+        """
+        return self.send(map_file(path, offset), stream)
+
     def block_until_shutdown(self, timeout: int = 1):
         start = time.time()
         while not self.in_queue.empty():
@@ -715,13 +2687,427 @@ class SocketConnectionUDP(threading.Thread):
             time.sleep(.01)
         self._shutdown_socket()
 
-    def get_message_status(self, m_id: int):
-        if m_id in self.building_blocks:
-            return self.building_blocks[m_id].keys(), self.building_blocks[m_id]["meta"]
-        return None
+
+class ReceiveBuffer:
+    """
+    Where TCP reads go, straight from recv_into (or asyncio's get_buffer). buffer[start:end] is what hasn't been parsed yet
+    Parsing only moves start forward. The leftover (at most one partial message) is moved back to the front once
+    there is no room after it, and the buffer grows when a message bigger than it is coming so it's read in place
+    """
+    def __init__(self, size: int = 256 * 1024, min_free: int = 64 * 1024):
+        self.size = size
+        self.min_free = min_free  # Smallest read we ask for
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.wanted = 0  # Length of the partial message at start, once its header is in
+
+    def __len__(self):
+        return self.end - self.start
+
+    def space(self) -> memoryview:
+        """
+        The free space after the data, to read into. Has to be let go of before the next call (it can resize the buffer)
+        """
+        needed = max(self.min_free, self.wanted - len(self))
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size and needed <= self.size:
+                self.buffer = bytearray(self.size)  # Done with whatever big message made it grow
+        if len(self.buffer) - self.end < needed:
+            if self.start:
+                length = self.end - self.start
+                self.buffer[:length] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, length
+            if len(self.buffer) - self.end < needed:
+                self.buffer.extend(bytes(needed - (len(self.buffer) - self.end)))
+        return memoryview(self.buffer)[self.end:]
+
+    def wrote(self, count: int):
+        self.end += count
+
+    def extend(self, data):
+        wanted = self.wanted
+        self.wanted = max(wanted, len(self) + len(data))
+        with self.space() as free:
+            free[:len(data)] = data
+        self.wanted = wanted
+        self.end += len(data)
+
+    def view(self) -> memoryview:
+        return memoryview(self.buffer)[self.start:self.end]
+
+    def consume(self, count: int):
+        self.start += count
+        self.wanted = 0
+
+
+class FileRange:
+    """
+    count bytes of an open file from offset on, for SendQueue to write with os.sendfile instead of reading them in
+    Slicing (only [n:] is needed) gives the rest of the range. SendQueue closes the file once the range is written
+    """
+    def __init__(self, file, offset: int, count: int):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    @classmethod
+    def open(cls, path, offset: int = 0) -> "FileRange":
+        file = open(path, "rb")
+        size = os.fstat(file.fileno()).st_size
+        return cls(file, min(offset, size), max(size - offset, 0))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key: slice) -> "FileRange":
+        return FileRange(self.file, self.offset + key.start, self.count - key.start)
+
+
+class SendQueue:
+    """
+    Bytes waiting to be written to a TCP socket, kept as the views they were queued as so nothing gets joined
+    write() hands as many as it can to one sendmsg (scatter/gather) and picks up where a partial write stopped
+    Sockets without sendmsg (windows) get one send per view. FileRanges go out with os.sendfile on their own
+    """
+    max_parts = 64  # Views per sendmsg, well under IOV_MAX
+
+    def __init__(self):
+        self.parts = deque()
+        self.pending = 0  # Bytes queued but not written yet
+        self.written = 0  # Bytes written so far
+        self.handles = deque()  # [write count the message is done at, handle]
+        self.files = 0  # FileRanges in parts
+
+    def __len__(self):
+        return self.pending
+
+    def add(self, parts, handles=()):
+        """
+        handles finish once everything in parts was written
+        """
+        for a in parts:
+            if not len(a):
+                if isinstance(a, FileRange):
+                    a.file.close()
+                continue
+            if isinstance(a, FileRange):
+                self.files += 1
+                self.parts.append(a)
+            else:
+                self.parts.append(memoryview(a).cast("B"))
+            self.pending += len(a)
+        for a in handles:
+            self.handles.append([self.written + self.pending, a])
+
+    def write(self, sock: socket.socket) -> int:
+        """
+        Writes until everything is out or the socket can't take more. Returns how many bytes went out
+        """
+        total = 0
+        while self.parts:
+            first = self.parts[0]
+            try:
+                if isinstance(first, FileRange):
+                    sent = os.sendfile(sock.fileno(), first.file.fileno(), first.offset, len(first))
+                    if not sent and len(first):
+                        raise InvalidData("File got shorter while it was being sent")
+                elif hasattr(sock, "sendmsg"):
+                    sent = sock.sendmsg(self.parts if len(self.parts) <= self.max_parts and not self.files else islice(self.parts, self.views_ahead()))
+                else:
+                    sent = sock.send(first)
+            except (BlockingIOError, InterruptedError):
+                break  # The socket is full, the rest goes once it has room
+            total += sent
+            self.consume(sent)
+        if total:
+            self.finish_handles()
+        return total
+
+    def views_ahead(self) -> int:
+        """
+        How many parts from the front one sendmsg can take, which stops at max_parts or the next FileRange
+        """
+        count = 0
+        for a in islice(self.parts, self.max_parts):
+            if isinstance(a, FileRange):
+                break
+            count += 1
+        return count
+
+    def consume(self, sent: int):
+        self.pending -= sent
+        self.written += sent
+        while sent:
+            first = self.parts[0]
+            if len(first) <= sent:
+                sent -= len(first)
+                self.parts.popleft()
+                if isinstance(first, FileRange):
+                    self.files -= 1
+                    first.file.close()
+            else:
+                self.parts[0] = first[sent:]
+                sent = 0
+
+    def finish_handles(self):
+        while self.handles and self.handles[0][0] <= self.written:
+            self.handles.popleft()[1].finish()
+        for done_at, handle in self.handles:
+            if done_at - handle.size < self.written:  # Partly written
+                handle.progress(self.written - (done_at - handle.size))
+
+    def fail_handles(self, error: Exception):
+        while self.handles:
+            self.handles.popleft()[1].finish(error)
+        for a in self.parts:
+            if isinstance(a, FileRange):
+                a.file.close()
+
+
+class TCPConnectionBase(StreamHost, ABC):
+    """
+    The stream framing shared by SocketConnectionTCP and AsyncConnectionTCP (antt.async_connections)
+    <type><length (msg_size_len bytes)><data>, with 0x00 bytes between messages as heartbeats
+    Messages on streams other than 0 are cut into 0x11 chunks so streams can take turns writing
+    Subclasses provide write_parts and feed what they read into rx before calling pop_finished_messages
+    """
+
+    def __init__(self, src_port: int, target: tuple[str, int], acts_as: str = "client"):
+        # Dest info
+        self.src_port = src_port
+        self.target = target
+        self.acts_as = acts_as
+
+        self.last_action = 0
+        self.last_updated = 0
+        self.max_no_action_delay = 20
+        self.msg_size_len = 5
+
+        self.alive = False
+        self.verified_connection = False
+        self.buffer_size = 1024
+        self.rx = ReceiveBuffer()  # Bytes read but not parsed yet
+
+        self.connect_try_limit = 100
+        self.connect_try_timeout = 2
+
+        # Messages can be held up to batch_delay seconds so several go out in one write. None turns it off
+        self.batch_delay: float = None
+        self.batch_max_bytes = 64 * 1024  # Write the batch right away once it gets this big
+        self.write_batch = []
+        self.batch_bytes = 0
+        self.batch_started = 0
+
+        self.streams: dict[int, Stream] = {}
+        self.stream_chunk_size = 64 * 1024
+        self.stream_turns = deque()  # Streams with something to write, the front one is taking its turn
+        self.stream_turn_left = 0
+        self.batch_handles: list[SendHandle] = []
+        # Regular messages of at least stream_threshold bytes come out as an IncomingMessage once their header is in,
+        # and reading stops while stream_window bytes of one wait on the reader. None turns it off.
+        # Stream chunks (0x11) are still put back together whole
+        self.stream_threshold: int = None
+        self.stream_window = 4 * 1024 * 1024
+        self.on_incoming = None  # Called with each IncomingMessage as it starts, instead of it coming out like a message
+        self.incoming: IncomingMessage = None  # The one coming in right now
+        self.incoming_left = 0
+
+    def message_header(self, length: int, m_type: bytes = b"\x05") -> bytes:  # 05 has been designated the standard message type byte
+        return m_type + length.to_bytes(self.msg_size_len, "big")
+
+    def add_to_batch(self, data: bytes, m_type: bytes = b"\x05") -> bool:
+        """
+        The stream framing already separates messages so a batch is just the messages back to back
+        Returns True once the batch is big enough to write
+        """
+        if not self.write_batch:
+            self.batch_started = time.time()
+        self.write_batch.append(self.message_header(len(data), m_type))
+        self.write_batch.append(data)
+        self.batch_bytes += 1 + self.msg_size_len + len(data)
+        return self.batch_bytes >= self.batch_max_bytes
+
+    def batch_due(self, now: float) -> bool:
+        return bool(self.write_batch) and (self.batch_bytes >= self.batch_max_bytes or now >= self.batch_started + self.batch_delay)
+
+    def take_batch(self) -> list:
+        """
+        The batch to write, which starts a new one. batch_handles are left alone, they have to go to write_parts
+        with it (see flush_batch) so they only finish once it was actually written
+        """
+        out = self.write_batch
+        self.write_batch = []
+        self.batch_bytes = 0
+        return out
+
+    @abstractmethod
+    def write_parts(self, parts, handles=()):
+        """
+        Writes parts (bytes-like, or a FileRange on SocketConnectionTCP) in order behind anything written before
+        handles finish once the last of the parts was taken by the socket, or fail if the connection closes first
+        """
+
+    def send_msg(self, val: bytes, m_type: bytes = b"\x05", handle: SendHandle = None):  # 05 has been designated the standard message type byte
+        """
+        Writes one message. handle finishes once it was handed to the socket
+        """
+        log_txt(f"{self.src_port}: sending message")
+        self.write_parts((self.message_header(len(val), m_type), val), (handle,) if handle else ())
+
+    def flush_batch(self):
+        """
+        Writes out the batch. Its handles finish once write_parts got it out
+        """
+        handles, self.batch_handles = self.batch_handles, []
+        self.write_parts(self.take_batch(), handles)
+
+    def queue_message(self, data, stream: int = 0, delivery: str = None, handle: SendHandle = None, m_type: bytes = b"\x05"):
+        """
+        Where sent messages start. TCP is always reliable so delivery doesn't change anything
+        handle finishes once the message was handed to the socket
+        """
+        if stream:
+            self.queue_stream_message(stream, data, handle)
+        elif self.batch_delay is None:
+            self.send_msg(data, m_type, handle)
+        elif isinstance(data, FileRange):  # Can't be joined into a batch, but has to stay behind it
+            if self.write_batch:
+                self.flush_batch()
+            self.send_msg(data, m_type, handle)
+        else:
+            if handle:
+                self.batch_handles.append(handle)
+            if self.add_to_batch(data, m_type):
+                self.flush_batch()
+
+    def queue_stream_message(self, stream_id: int, data, handle: SendHandle = None):
+        lane = self.stream(stream_id)
+        if not lane.sending:
+            self.stream_turns.append(lane)
+        lane.sending.append([memoryview(data).cast("B"), 0, handle])
+
+    def fail_handles(self):
+        error = ConnectionIssue("Connection closed before the message was written")
+        for a in self.batch_handles:
+            a.finish(error)
+        for lane in self.streams.values():
+            for entry in lane.sending:
+                if entry[2]:
+                    entry[2].finish(error)
+        if self.incoming is not None:
+            self.incoming.finish(ConnectionIssue("Connection closed before the whole message came in"))
+            self.incoming = None
+
+    @property
+    def reading_paused(self) -> bool:
+        """
+        An IncomingMessage's reader is behind, so nothing more should be read until it makes room
+        """
+        return self.incoming is not None and len(self.rx) >= self.incoming.room
+
+    def reader_made_room(self):
+        """
+        Called from the reader's thread once it took a good part of the IncomingMessage's window
+        """
+        pass
+
+    def next_stream_chunk(self) -> tuple[bytes, memoryview]:
+        """
+        (header, data) of the next 0x11 chunk to write, or None. Streams take turns writing weight chunks each
+        """
+        if not self.stream_turns:
+            return None
+        lane = self.stream_turns[0]
+        entry = lane.sending[0]
+        data, offset, handle = entry
+        if self.stream_turn_left <= 0:
+            self.stream_turn_left = lane.weight
+        self.stream_turn_left -= 1
+        chunk = data[offset:offset + self.stream_chunk_size]
+        entry[1] = offset + len(chunk)
+        last = entry[1] >= len(data)
+        if handle:
+            handle.progress(entry[1])
+        if last:
+            lane.sending.popleft()
+            if handle:
+                handle.finish()
+        if not lane.sending:
+            self.stream_turns.popleft()
+            self.stream_turn_left = 0
+        elif self.stream_turn_left <= 0:
+            self.stream_turns.rotate(-1)
+        header = self.message_header(len(chunk) + 3, b"\x11") + lane.stream_id.to_bytes(2, "big") + (b"\x01" if last else b"\x00")
+        return header, chunk
+
+    def pop_finished_messages(self):
+        """
+        Walks the read buffer by offset and copies each message out once (the buffer gets reused)
+        """
+        messages = []
+        header = 1 + self.msg_size_len
+        offset = 0
+        with self.rx.view() as data:
+            while offset < len(data):
+                if self.incoming is not None:
+                    # In the middle of a message that's streamed to its reader, pass on as much as it has room for
+                    take = min(len(data) - offset, self.incoming_left, self.incoming.room)
+                    if take <= 0:
+                        break
+                    self.incoming.put(bytes(data[offset:offset + take]))
+                    offset += take
+                    self.incoming_left -= take
+                    if not self.incoming_left:
+                        self.incoming.finish()
+                        self.incoming = None
+                    continue
+                m_type = data[offset]
+                if m_type == 0:  # Heartbeats can show up between messages too
+                    offset += 1
+                    continue
+                if m_type != 5 and m_type != 17:  # 5 is a regular message, 17 a stream chunk
+                    break
+                # Enough for the header?
+                if len(data) - offset < header:
+                    break
+                current_len = int.from_bytes(data[offset + 1:offset + header], "big")
+                if m_type == 5 and self.stream_threshold is not None and current_len >= self.stream_threshold:
+                    self.incoming = IncomingMessage(self, None, current_len, current_len, self.stream_window)
+                    self.incoming.on_read = self.reader_made_room
+                    self.incoming_left = current_len
+                    if self.on_incoming:
+                        self.on_incoming(self.incoming)
+                    else:
+                        messages.append(self.incoming)
+                    offset += header
+                    continue
+                # Enough data to fulfill size promise?
+                if len(data) - offset - header < current_len:
+                    break
+                body = data[offset + header:offset + header + current_len]
+                if m_type == 17:
+                    # <stream id (2)><last chunk (1)><data>. Tcp keeps everything in order so there is nothing to sort
+                    lane = self.stream(int.from_bytes(body[:2], "big"))
+                    lane.chunks.append(bytes(body[3:]))
+                    if body[2]:
+                        lane.out_queue.put_nowait(lane.chunks[0] if len(lane.chunks) == 1 else b"".join(lane.chunks))
+                        lane.chunks = []
+                else:
+                    messages.append(bytes(body))
+                body.release()
+                offset += header + current_len
+        self.rx.consume(offset)
+        if messages:
+            log_txt(f"{self.src_port}: popped {len(messages)} messages", "tcp socket pop")
+        if self.incoming is None and len(self.rx) >= header and self.rx.buffer[self.rx.start] in (5, 17):
+            # Let the next read make room for all of the message that's coming in
+            self.rx.wanted = header + int.from_bytes(self.rx.buffer[self.rx.start + 1:self.rx.start + header], "big")
+        return messages
 
 
-class SocketConnectionTCP(threading.Thread):
+class SocketConnectionTCP(TCPConnectionBase, threading.Thread):
     """
     You are _looking at_ the thread. You are putting into and taking out of the thread/socket itself
     I guess this has kinda evolved to try to do tcp things
@@ -730,45 +3116,40 @@ class SocketConnectionTCP(threading.Thread):
     def __init__(self, src_port: int, target: tuple[str, int], in_queue: Queue = None, out_queue: Queue = None, acts_as: str = "client"):
         log_txt(f"{src_port}: start init", "tcp socket setup")
         # What if we could inherit a socket if it already exists?
-        super().__init__()
+        threading.Thread.__init__(self)
+        TCPConnectionBase.__init__(self, src_port, target, acts_as)
         self.daemon = True  # Self terminating
-        # Dest info
-        self.src_port = src_port
-        self.target = target
-        self.acts_as = acts_as
         # Init queue objects if needed
         if in_queue:
             self.in_queue = in_queue
         else:
-            self.in_queue = Queue()
+            self.in_queue = WakeupQueue()
         if out_queue:
             self.out_queue = out_queue
         else:
             self.out_queue = Queue()
 
-        self.last_action = 0
-        self.last_updated = 0
-        self.max_no_action_delay = 20
         # noinspection PyTypeChecker
         self.socket: socket.socket = None
+        self.selector: selectors.BaseSelector = None
+        self.timers = TimerHeap()  # "heartbeat" and "batch"
+        self.queue_poll_interval = .05  # How often a plain Queue (that can't wake us up) passed in as in_queue gets checked
         self.on_message = None  # out_queue message callback
-        self.msg_size_len = 5
-
-        self.alive = False
-        self.verified_connection = False
-        self.buffer_size = 1024
-        self.pre_parsed = b""
-
-        self.connect_try_limit = 100
-        self.connect_try_timeout = 2
+        self.stream_chunks_per_loop = 16
+        self.tx = SendQueue()  # Written without blocking, whatever the socket didn't take waits here
+        self.max_pending_writes = 1024 * 1024  # No more stream chunks get queued while this much is waiting
         log_txt(f"{src_port}: end init", "tcp socket setup")
 
     def run(self) -> None:
 
         self._setup_socket()
         self.last_action = time.time()
+        self.timers.set("heartbeat", self.last_action + self.max_no_action_delay)
         log_txt(f"{self.src_port}: setup done", "tcp socket run")
         while self.alive:
+            # Sleep until there is something to read, something queued, room to write or a timer is due
+            self.wait_for_events()
+
             log_txt(f"{self.src_port}: storing", "tcp socket run")
             self.store_incoming()
 
@@ -784,10 +3165,34 @@ class SocketConnectionTCP(threading.Thread):
                 if isinstance(val, str):
                     if val == "kill":
                         log_txt(f"{self.src_port}: starting kill", "tcp socket run")
+                        if self.write_batch:
+                            self.flush_batch()
+                        self.flush_writes(block=True)
                         self.alive = False
                         self._shutdown_socket()
-                elif isinstance(val, bytes):
-                    self.send_msg(val)
+                        return
+                elif isinstance(val, (bytes, bytearray, memoryview)):
+                    self.queue_message(val)
+                elif isinstance(val, tuple):  # (stream id, message[, delivery, handle]) from send()
+                    self.queue_message(val[1], val[0], *val[2:])
+
+            now = time.time()
+            for name in self.timers.pop_due(now):
+                self.on_timer(name, now)
+            if self.write_batch:
+                if self.batch_due(now):
+                    self.flush_batch()
+                else:
+                    self.timers.set("batch", self.batch_started + self.batch_delay)
+
+            # Stream chunks, a few per loop so new messages and reads get a look in between
+            for a in range(self.stream_chunks_per_loop):
+                if not self.alive or len(self.tx) >= self.max_pending_writes:
+                    break
+                chunk = self.next_stream_chunk()
+                if chunk is None:
+                    break
+                self.write_parts(chunk)
 
             while self.on_message and not self.out_queue.empty():
                 log_txt(f"{self.src_port}: callback start", "tcp socket run")
@@ -795,14 +3200,43 @@ class SocketConnectionTCP(threading.Thread):
                 self.out_queue.task_done()
                 log_txt(f"{self.src_port}: callback done", "tcp socket run")
 
-            if time.time() > self.last_action + self.max_no_action_delay:
-                self.send_heartbeat()
-
-            time.sleep(.01)
+            # Everything queued this loop (and whatever the socket didn't take last time) in as few calls as it takes
+            self.flush_writes()
 
-        time.sleep(.1)
         self._shutdown_socket()
 
+    def wait_for_events(self):
+        timeout = self.timers.timeout(time.time())
+        if self.stream_turns and len(self.tx) < self.max_pending_writes:
+            timeout = 0  # More chunks to queue
+        elif not isinstance(self.in_queue, WakeupQueue) and (timeout is None or timeout > self.queue_poll_interval):
+            timeout = self.queue_poll_interval
+        events = selectors.EVENT_WRITE if len(self.tx) else 0
+        if not self.reading_paused:
+            events |= selectors.EVENT_READ
+        key = self.selector.get_map().get(self.socket)
+        if key is None:
+            if events:
+                self.selector.register(self.socket, events)
+        elif not events:
+            self.selector.unregister(self.socket)  # Waiting on the IncomingMessage's reader (see reader_made_room)
+        elif key.events != events:
+            self.selector.modify(self.socket, events)
+        for key, mask in self.selector.select(timeout):
+            if key.fileobj is self.in_queue:
+                self.in_queue.drain()
+
+    def reader_made_room(self):
+        if isinstance(self.in_queue, WakeupQueue):
+            self.in_queue.poke()
+
+    def on_timer(self, name, now: float):
+        if name == "heartbeat":
+            if now >= self.last_action + self.max_no_action_delay:
+                self.send_heartbeat()
+            self.timers.set("heartbeat", self.last_action + self.max_no_action_delay)
+        # "batch" only has to wake the loop up, the batch is written right after
+
     def _setup_socket(self):
         log_txt(f"{self.src_port}: setup", "tcp socket setup")
         self.alive = True
@@ -814,25 +3248,29 @@ class SocketConnectionTCP(threading.Thread):
             tries = self.connect_try_limit
             try_timeout = self.connect_try_timeout
             try_delay = try_timeout / tries
-            while count < tries:
+            while True:
                 try:
                     self.socket.connect(self.target)
                     break
-                except ConnectionResetError:
+                except (ConnectionResetError, ConnectionRefusedError):  # The server isn't listening yet
                     count += 1
+                    if count >= tries:
+                        raise ConnectionNoResponse("Failed to connect to server")
                     time.sleep(try_delay)
             self.socket.sendall(b"\x01")
             log_txt(f"{self.src_port}: awaiting response", "tcp socket setup")
-            data = self.socket.recv(self.buffer_size)
+            data = self.socket.recv(1)  # Anything after it is already a message
             if data != b"\x02":
                 log_txt(f"{self.src_port}: received incorrect data", "tcp socket setup")
                 raise ConnectionIssue("Unable to verify server is correct class")
         else:  # May want to be more precise
             log_txt(f"{self.src_port}: as server", "tcp socket setup")
             self.socket.listen()
-            self.socket = self.socket.accept()[0]
+            listener = self.socket
+            self.socket = listener.accept()[0]
+            listener.close()  # Only the one client
             log_txt(f"{self.src_port}: accepted client")
-            data = self.socket.recv(self.buffer_size)
+            data = self.socket.recv(1)
             if data != b"\x01":
                 raise ConnectionIssue("Unable to verify client is correct class")
             log_txt(f"{self.src_port}: sending response")
@@ -840,98 +3278,105 @@ class SocketConnectionTCP(threading.Thread):
 
         log_txt(f"{self.src_port}: Verification done")
         self.socket.settimeout(0.0)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        if isinstance(self.in_queue, WakeupQueue):
+            self.selector.register(self.in_queue, selectors.EVENT_READ)
         self.verified_connection = True
 
     def _shutdown_socket(self):
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if isinstance(self.in_queue, WakeupQueue):
+            self.in_queue.close()
         self.socket.close()
         self.alive = False
+        self.fail_handles()
 
-    def send_msg(self, val: bytes, m_type: bytes = b"\x05"):  # 05 has been designated the standard message type byte
-        log_txt(f"{self.src_port}: sending message")
-        self.socket.setblocking(True)
-        self.socket.sendall(m_type)
-        self.socket.sendall(len(val).to_bytes(self.msg_size_len, "big"))
-        self.socket.sendall(val)
-        self.socket.settimeout(0)
-        self.last_action = time.time()
-
-    def send_heartbeat(self):
-        self.socket.send(b"\x00")
-        self.last_action = time.time()
+    def write_parts(self, parts, handles=()):
+        """
+        Queues the parts behind anything still waiting. Everything queued in a loop goes out together in flush_writes
+        """
+        self.tx.add(parts, handles)
 
-    def store_incoming(self):
-        temp_parts = [self.pre_parsed]
+    def flush_writes(self, block: bool = False):
+        if not len(self.tx) or not (self.alive or block):
+            return
+        if block:
+            self.socket.setblocking(True)
         try:
-            while True:
-                current = len(temp_parts)
-                temp_val = self.socket.recv(self.buffer_size)
-                if temp_val != "":
-                    temp_parts.append(temp_val)
-                log_txt(f"{self.src_port}: saved packet -> {temp_val}", "tcp socket store")
-                self.last_updated = time.time()
-                if len(temp_parts) == current:
-                    break
-        except socket.timeout:
-            pass
-        except BlockingIOError:
-            pass
-        except ConnectionResetError:
-            pass
-            # self.alive = False  # maybe?
-        except Exception as e:
-            log_txt(f"{self.src_port}: {e}")
-            raise e
-
-        if len(temp_parts) > 1:
-            self.pre_parsed = b"".join(temp_parts)
-            log_txt(f"{self.src_port}: joining parts -> {self.pre_parsed}", "tcp socket store")
+            if self.tx.write(self.socket):
+                self.last_action = time.time()
+        except (BrokenPipeError, ConnectionResetError, InvalidData) as e:
+            log_txt(f"{self.src_port}: write failed {e}", "tcp socket run")
+            self.alive = False
+        finally:
+            if block:
+                self.socket.settimeout(0)
+
+    def fail_handles(self):
+        super().fail_handles()
+        self.tx.fail_handles(ConnectionIssue("Connection closed before the message was written"))
+
+    def send(self, data: bytes, stream: int = 0, delivery: str = None) -> SendHandle:
+        """
+        Same as putting (stream, message, delivery, handle) in in_queue (a plain message works too)
+        The handle finishes once the message was written to the socket
+        """
+        handle = SendHandle(self.make_future(), len(data))
+        self.in_queue.put((stream, data, delivery, handle))
+        return handle
 
-    def pop_finished_messages(self):
+    def send_file(self, path, offset: int = 0, stream: int = 0) -> SendHandle:
+        """
+        Sends the file from offset on as one message without reading it in (so offset picks up a cut off download)
+        Regular messages are written with os.sendfile where there is one. Stream messages (and everything on
+        windows) are cut from an mmap of the file instead
+        """
+        if stream or not hasattr(os, "sendfile"):
+            return self.send(map_file(path, offset), stream)
+        return self.send(FileRange.open(path, offset))
 
-        messages = []
+    def flush_batch(self):
+        log_txt(f"{self.src_port}: writing {len(self.write_batch) // 2} batched messages", "tcp socket run")
+        super().flush_batch()
 
-        # Remove heartbeats
-        h_i = 0
-        while len(self.pre_parsed) > h_i and self.pre_parsed[h_i] == 0:
-            h_i += 1
-        if h_i != 0:
-            log_txt(f"{self.src_port}: removing {h_i} heartbeats", "tcp socket pop")
-            self.pre_parsed = self.pre_parsed[h_i:]
-
-        while len(self.pre_parsed) > 0:
-            if self.pre_parsed[0] == 5:  # Type implies it's a regular message
-                # Enough space for the header?
-                if len(self.pre_parsed) < 1 + self.msg_size_len:
-                    # log_txt(f"{self.src_port}: 1popping {messages}", "tcp socket pop")
-                    return messages
-                current_len = int.from_bytes(self.pre_parsed[1:1 + self.msg_size_len], "big")
-                # Enough data to fulfill size promise?
-                if len(self.pre_parsed) - self.msg_size_len - 1 < current_len:
-                    # log_txt(f"{self.src_port}: 2popping {messages}", "tcp socket pop")
-                    return messages
-
-                debug_val = self.pre_parsed[1 + self.msg_size_len:1 + self.msg_size_len + current_len]
-                messages.append(self.pre_parsed[1 + self.msg_size_len:1 + self.msg_size_len + current_len])
-                log_txt(f"{self.src_port}: added message of len={len(messages[-1])} to pop")
-                # log_txt(f"{self.src_port}: size={self.msg_size_len}, mlen={current_len}, source={self.pre_parsed}, out={debug_val}")
-                self.pre_parsed = self.pre_parsed[1 + self.msg_size_len + current_len:]
-            else:
-                return messages
+    def send_heartbeat(self):
+        self.write_parts((b"\x00",))
+        self.last_action = time.time()
 
-        return messages
+    def store_incoming(self):
+        """
+        Reads everything the socket has straight into rx, unless an IncomingMessage's reader has to catch up first
+        """
+        while not self.reading_paused:
+            try:
+                count = self.socket.recv_into(self.rx.space())
+            except (socket.timeout, BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                count = 0
+            if not count:
+                log_txt(f"{self.src_port}: other side closed the connection", "tcp socket store")
+                self.alive = False
+                return
+            self.rx.wrote(count)
+            log_txt(f"{self.src_port}: read {count} bytes", "tcp socket store")
+            self.last_updated = time.time()
+            if self.stream_threshold is not None and len(self.rx) >= self.rx.size:
+                return  # Let pop_finished_messages see if a message to stream started before reading on
 
     def block_until_message(self, timeout: int = 1) -> bytes:
-        sleep_len = .1
-        count = 0
         try:
-            while self.out_queue.empty() and count < timeout / sleep_len:
-                time.sleep(sleep_len)
-                count += 1
-            if count == int(timeout / sleep_len):
-                log_txt(f"{self.src_port}: block until timed out; queue always empty")
-                raise KeyboardInterrupt  # There's probably a better way to do this
+            temp = self.out_queue.get(timeout=timeout)
+            self.out_queue.task_done()
+            return temp
+        except Empty:
+            log_txt(f"{self.src_port}: block until timed out; queue always empty")
         except KeyboardInterrupt:
-            self.in_queue.put("kill")
+            pass
+        self.in_queue.put("kill")
         try:
             temp = self.out_queue.get(timeout=3)  # fixme This is likely what actually kills the thread
             self.out_queue.task_done()
@@ -0,0 +1,414 @@
+"""
+Ways of moving datagrams in and out of a UDP socket
+DatagramIO does one syscall per datagram and works everywhere. MmsgDatagramIO batches both directions with
+recvmmsg/sendmmsg through ctypes and only exists on linux. best_datagram_io() picks whichever is available
+
+Both switch the socket to non-blocking. Sends are queued when the socket would block and go out on flush()
+track_drops() turns on SO_RXQ_OVFL (linux) so kernel_drops counts datagrams the kernel threw away because the
+receive buffer was full
+
+recv_views() reads straight into pooled slabs (recv_into/recvmmsg) and hands back memoryviews of them instead of
+new bytes objects. The views stay good until release() puts the slabs back in the pool, so whatever needs the data
+longer has to copy it out first
+"""
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+from collections import deque
+
+SO_RXQ_OVFL = 40  # Not exported by the socket module
+CONTROL_LEN = socket.CMSG_SPACE(4) if hasattr(socket, "CMSG_SPACE") else 0
+
+
+class DatagramIO:
+    """
+    Per datagram recvfrom/sendto calls
+    """
+
+    def __init__(self, sock: socket.socket, batch_size: int = 64, buffer_size: int = 2048):
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.batch_size = batch_size  # Most datagrams read in one recv_many call
+        self.buffer_size = buffer_size  # Biggest datagram that can be received without getting cut
+        self.outgoing = deque()  # (bytes, address) that couldn't go out yet
+        # Counters for benchmarking
+        self.recv_calls = 0
+        self.send_calls = 0
+        self.datagrams_in = 0
+        self.datagrams_out = 0
+        self.kernel_drops: int = None  # Receive buffer overflow drops since the socket opened, None when not tracked
+        self.free_slabs = []  # Receive slabs ready to be filled
+        self.lent_slabs = []  # Slabs with views handed out by recv_views
+        self.max_free_slabs = 8  # A burst can check out lots of slabs, don't hang on to all of them after
+        self.slabs_made = 0
+
+    def track_drops(self) -> bool:
+        if not CONTROL_LEN or not sys.platform.startswith("linux"):
+            return False
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            return False
+        self.kernel_drops = 0
+        return True
+
+    def read_drops(self, ancdata):
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(value) >= 4:
+                # Only sent once there has been a drop, and it's a running total
+                self.kernel_drops = max(self.kernel_drops, int.from_bytes(value[:4], sys.byteorder))
+
+    def wait_readable(self, timeout: float) -> bool:
+        return bool(select.select([self.socket], [], [], timeout)[0])
+
+    def recvfrom_many(self, timeout: float = 0) -> list[tuple[bytes, tuple]]:
+        """
+        Whatever is waiting, up to batch_size datagrams. Waits up to timeout for the first one
+        """
+        if timeout and not self.wait_readable(timeout):
+            return []
+        out = []
+        try:
+            while len(out) < self.batch_size:
+                self.recv_calls += 1
+                if self.kernel_drops is None:
+                    out.append(self.socket.recvfrom(self.buffer_size))
+                else:
+                    data, ancdata, flags, address = self.socket.recvmsg(self.buffer_size, CONTROL_LEN)
+                    self.read_drops(ancdata)
+                    out.append((data, address))
+        except (BlockingIOError, ConnectionResetError):
+            pass  # Reset means an earlier send hit a closed port (windows)
+        self.datagrams_in += len(out)
+        return out
+
+    def recv_many(self, timeout: float = 0) -> list[bytes]:
+        return [a[0] for a in self.recvfrom_many(timeout)]
+
+    def new_slab(self):
+        self.slabs_made += 1
+        return memoryview(bytearray(self.batch_size * self.buffer_size))
+
+    def take_slab(self):
+        return self.free_slabs.pop() if self.free_slabs else self.new_slab()
+
+    def lend_slab(self, slab, used: bool):
+        if used:
+            self.lent_slabs.append(slab)
+        else:
+            self.free_slabs.append(slab)
+
+    def release(self):
+        """
+        Every view from recv_views is done with, their slabs can be filled again
+        """
+        self.free_slabs.extend(self.lent_slabs[:max(0, self.max_free_slabs - len(self.free_slabs))])
+        self.lent_slabs.clear()
+
+    def recv_views(self, timeout: float = 0) -> list[memoryview]:
+        """
+        Same as recv_many, but without a copy per datagram. Only valid until release()
+        """
+        if timeout and not self.wait_readable(timeout):
+            return []
+        slab = self.take_slab()
+        size = self.buffer_size
+        out = []
+        try:
+            while len(out) < self.batch_size:
+                slot = slab[len(out) * size:(len(out) + 1) * size]
+                self.recv_calls += 1
+                if self.kernel_drops is None:
+                    length = self.socket.recv_into(slot)
+                else:
+                    length, ancdata, flags, address = self.socket.recvmsg_into([slot], CONTROL_LEN)
+                    self.read_drops(ancdata)
+                out.append(slot[:length])
+        except (BlockingIOError, ConnectionResetError):
+            pass
+        self.datagrams_in += len(out)
+        self.lend_slab(slab, bool(out))
+        return out
+
+    def send(self, data, address: tuple, urgent: bool = False):
+        """
+        Sends now if nothing is queued ahead, otherwise it waits in order for flush()
+        urgent datagrams skip ahead of whatever is queued
+        """
+        if not self.outgoing or urgent:
+            try:
+                self.send_calls += 1
+                self.socket.sendto(data, address)
+                self.datagrams_out += 1
+                return
+            except BlockingIOError:
+                pass
+        if urgent:
+            self.outgoing.appendleft((bytes(data), address))
+        else:
+            self.outgoing.append((bytes(data), address))
+
+    def flush(self) -> bool:
+        """
+        Tries to send everything queued. False if the socket filled up first
+        """
+        while self.outgoing:
+            try:
+                self.send_calls += 1
+                self.socket.sendto(*self.outgoing[0])
+            except BlockingIOError:
+                return False
+            self.outgoing.popleft()
+            self.datagrams_out += 1
+        return True
+
+    @property
+    def pending(self) -> int:
+        return len(self.outgoing)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.c_void_p),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+SIZE_T = ctypes.sizeof(ctypes.c_size_t)
+MSG_DONTWAIT = 0x40
+NAME_LEN = 128  # sizeof(struct sockaddr_storage)
+
+
+class MmsgDatagramIO(DatagramIO):
+    """
+    Up to batch_size datagrams per recvmmsg/sendmmsg call
+    Received datagrams land in pooled MmsgSlab arenas, sends are copied into one arena until it's full or flush()
+    """
+    available = _libc is not None
+
+    def __init__(self, sock: socket.socket, batch_size: int = 64, buffer_size: int = 2048):
+        super().__init__(sock, batch_size, buffer_size)
+        if not self.available:
+            raise OSError("recvmmsg/sendmmsg are not available here")
+        self.fd = sock.fileno()
+        self.send_arena, self.send_names, self.send_iovs, self.send_hdrs = self._make_batch()
+        # Plain views over the ctypes arrays. Going through the Structure fields per datagram costs more than the syscalls saved
+        self.send_iov_lens = memoryview(self.send_iovs).cast("B").cast("N")[1::2]
+        self.send_namelens = memoryview(self.send_hdrs).cast("B").cast("I")[msghdr.msg_namelen.offset // 4::ctypes.sizeof(mmsghdr) // 4]
+        self.slot_names = [None] * self.batch_size  # What's already in each send_names slot
+        self.control_fill = None  # msg_controllen for every header, only set up by track_drops
+        self.send_count = 0  # Datagrams copied into the send arena
+        self.send_start = 0  # First of those that hasn't gone out yet
+        self.overflow = deque()  # Sends that didn't fit while the arena was waiting on a full socket
+        self.names = {}  # address -> packed sockaddr
+
+    def track_drops(self) -> bool:
+        if not super().track_drops():
+            return False
+        self.control_fill = memoryview(struct.pack(f"{self.batch_size}N", *[CONTROL_LEN] * self.batch_size)).cast("B").cast("N")
+        self.free_slabs.clear()  # Made without control slots
+        return True
+
+    def new_slab(self) -> "MmsgSlab":
+        self.slabs_made += 1
+        return MmsgSlab(self)
+
+    def _make_batch(self):
+        """
+        Arena, address slots, iovecs and headers for batch_size datagrams.
+        The headers only hold raw pointers to the rest so all of it has to be kept
+        """
+        arena = bytearray(self.batch_size * self.buffer_size)
+        arena_addr = ctypes.addressof((ctypes.c_char * len(arena)).from_buffer(arena))
+        names = ctypes.create_string_buffer(self.batch_size * NAME_LEN)
+        iovs = (iovec * self.batch_size)()
+        hdrs = (mmsghdr * self.batch_size)()
+        for a in range(self.batch_size):
+            iovs[a].iov_base = arena_addr + a * self.buffer_size
+            iovs[a].iov_len = self.buffer_size
+            hdrs[a].msg_hdr.msg_name = ctypes.addressof(names) + a * NAME_LEN
+            hdrs[a].msg_hdr.msg_namelen = NAME_LEN
+            hdrs[a].msg_hdr.msg_iov = ctypes.addressof(iovs[a])
+            hdrs[a].msg_hdr.msg_iovlen = 1
+        return arena, names, iovs, hdrs
+
+    def recvfrom_many(self, timeout: float = 0) -> list[tuple[bytes, tuple]]:
+        slab, count = self._recv_batch(timeout)
+        out = [(bytes(slab.datagram(a)), self._unpack_name(slab, a)) for a in range(count)]
+        self.free_slabs.append(slab)
+        return out
+
+    def recv_many(self, timeout: float = 0) -> list[bytes]:
+        slab, count = self._recv_batch(timeout)
+        out = [bytes(slab.datagram(a)) for a in range(count)]
+        self.free_slabs.append(slab)
+        return out
+
+    def recv_views(self, timeout: float = 0) -> list[memoryview]:
+        slab, count = self._recv_batch(timeout)
+        self.lend_slab(slab, count > 0)
+        return [slab.datagram(a) for a in range(count)]
+
+    def _recv_batch(self, timeout: float) -> tuple["MmsgSlab", int]:
+        slab = self.take_slab()
+        if timeout and not self.wait_readable(timeout):
+            return slab, 0
+        if slab.control is not None:
+            slab.control_lens[:] = self.control_fill
+        self.recv_calls += 1
+        # msg_namelen gets set to the family's address size which stays the same per socket
+        count = _libc.recvmmsg(self.fd, slab.hdrs, self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED, errno.EINTR):
+                return slab, 0
+            raise OSError(err, os.strerror(err))
+        self.datagrams_in += count
+        if slab.control is not None and count:
+            # The last datagram has the newest running total
+            last = count - 1
+            if slab.control_lens[last] >= socket.CMSG_LEN(4):
+                start = last * CONTROL_LEN
+                level, kind = struct.unpack_from("ii", slab.control, start + SIZE_T)  # After cmsg_len
+                data_start = start + socket.CMSG_LEN(0)
+                self.read_drops([(level, kind, slab.control[data_start:data_start + 4])])
+        return slab, count
+
+    def _unpack_name(self, slab: "MmsgSlab", index: int) -> tuple:
+        raw = ctypes.string_at(ctypes.addressof(slab.names) + index * NAME_LEN, 28)
+        family = struct.unpack_from("H", raw)[0]
+        port = struct.unpack_from(">H", raw, 2)[0]
+        if family == socket.AF_INET6:
+            flowinfo, = struct.unpack_from("I", raw, 4)
+            scope_id, = struct.unpack_from("I", raw, 24)
+            return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+
+    def _pack_name(self, address: tuple) -> bytes:
+        name = self.names.get(address)
+        if name is None:
+            if len(self.names) > 1024:
+                self.names.clear()
+            host = socket.getaddrinfo(address[0], address[1], self.socket.family, socket.SOCK_DGRAM)[0][4][0]
+            if self.socket.family == socket.AF_INET6:
+                flowinfo, scope_id = address[2:4] if len(address) == 4 else (0, 0)
+                name = struct.pack("H", socket.AF_INET6) + struct.pack(">H", address[1]) + struct.pack("I", flowinfo) + socket.inet_pton(socket.AF_INET6, host) + struct.pack("I", scope_id)
+            else:
+                name = struct.pack("H", socket.AF_INET) + struct.pack(">H", address[1]) + socket.inet_aton(host) + bytes(8)
+            self.names[address] = name
+        return name
+
+    def send(self, data, address: tuple, urgent: bool = False):
+        if urgent and (self.send_start < self.send_count or self.overflow):
+            super().send(data, address, urgent)  # flush() does these before the arena
+            return
+        if len(data) > self.buffer_size:
+            # Too big for an arena slot so it goes on its own (udp never promised ordering anyway)
+            self.flush()
+            super().send(data, address)
+            return
+        if self.overflow or self.send_count == self.batch_size:
+            if not self.flush():
+                self.overflow.append((bytes(data), address))
+                return
+        self._add(data, address)
+
+    def _add(self, data, address: tuple):
+        index = self.send_count
+        start = index * self.buffer_size
+        self.send_arena[start:start + len(data)] = data
+        self.send_iov_lens[index] = len(data)
+        name = self._pack_name(address)
+        if self.slot_names[index] is not name:
+            ctypes.memmove(ctypes.addressof(self.send_names) + index * NAME_LEN, name, len(name))
+            self.send_namelens[index] = len(name)
+            self.slot_names[index] = name
+        self.send_count += 1
+
+    def flush(self) -> bool:
+        if not super().flush():  # Anything that went out on its own
+            return False
+        while True:
+            while self.send_start < self.send_count:
+                self.send_calls += 1
+                sent = _libc.sendmmsg(self.fd, ctypes.byref(self.send_hdrs, self.send_start * ctypes.sizeof(mmsghdr)), self.send_count - self.send_start, MSG_DONTWAIT)
+                if sent < 0:
+                    err = ctypes.get_errno()
+                    if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return False
+                    if err in (errno.ECONNREFUSED, errno.EINTR):
+                        continue
+                    raise OSError(err, os.strerror(err))
+                self.send_start += sent
+                self.datagrams_out += sent
+            self.send_count = self.send_start = 0
+            if not self.overflow:
+                return True
+            while self.overflow and self.send_count < self.batch_size:
+                self._add(*self.overflow.popleft())
+
+    @property
+    def pending(self) -> int:
+        return len(self.outgoing) + self.send_count - self.send_start + len(self.overflow)
+
+
+class MmsgSlab:
+    """
+    One recvmmsg call worth of buffers. The headers only hold raw pointers to the rest so it's all kept together
+    """
+
+    def __init__(self, io: MmsgDatagramIO):
+        self.size = io.buffer_size
+        self.arena, self.names, self.iovs, self.hdrs = io._make_batch()
+        self.view = memoryview(self.arena)
+        self.lens = memoryview(self.hdrs).cast("B").cast("I")[mmsghdr.msg_len.offset // 4::ctypes.sizeof(mmsghdr) // 4]
+        self.control: ctypes.Array = None  # Ancillary data slots when drops are tracked
+        self.control_lens = None
+        if io.control_fill is not None:
+            self.control = ctypes.create_string_buffer(io.batch_size * CONTROL_LEN)
+            for a in range(io.batch_size):
+                self.hdrs[a].msg_hdr.msg_control = ctypes.addressof(self.control) + a * CONTROL_LEN
+            # The kernel writes back how much it used so msg_controllen has to be reset before every call
+            self.control_lens = memoryview(self.hdrs).cast("B").cast("N")[msghdr.msg_controllen.offset // SIZE_T::ctypes.sizeof(mmsghdr) // SIZE_T]
+
+    def datagram(self, index: int) -> memoryview:
+        start = index * self.size
+        return self.view[start:start + self.lens[index]]
+
+
+def best_datagram_io(sock: socket.socket, batch_size: int = 64, buffer_size: int = 2048) -> DatagramIO:
+    if MmsgDatagramIO.available:
+        return MmsgDatagramIO(sock, batch_size, buffer_size)
+    return DatagramIO(sock, batch_size, buffer_size)
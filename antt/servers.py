@@ -1,4 +1,5 @@
 import antt.data_structures as ds
+from antt.datagram_io import best_datagram_io
 from threading import Thread
 import socket
 
@@ -18,15 +19,13 @@ class EchoServer(Thread):
         self.timeout_len = .05
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(("", self.src_port))
+        self.io = best_datagram_io(self.socket, buffer_size=self.buffer_size)
 
     def run(self) -> None:
-        self.socket.settimeout(self.timeout_len)
         while self.alive:
-            try:
-                data, ip = self.socket.recvfrom(self.buffer_size)  # No overflow checks could crash
-                self.socket.sendto(data, ip)
-            except socket.timeout:
-                pass
+            for data, ip in self.io.recvfrom_many(self.timeout_len):  # Anything longer than buffer_size gets cut
+                self.io.send(data, ip)
+            self.io.flush()
 
 
 class LocateServer(Thread):
@@ -54,46 +53,37 @@ class LocateServer(Thread):
 
         self.info_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.info_socket.bind(("", self.info_port))
-        self.info_socket.settimeout(self.timeout_len)
+        self.info_io = best_datagram_io(self.info_socket, buffer_size=self.buffer_size)
         self.loc_a_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.loc_a_socket.bind(("", self.loc_port_a))
-        self.loc_a_socket.settimeout(self.timeout_len)
+        self.loc_a_io = best_datagram_io(self.loc_a_socket, buffer_size=self.buffer_size)
         self.loc_b_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.loc_b_socket.bind(("", self.loc_port_b))
-        self.loc_b_socket.settimeout(self.timeout_len)
+        self.loc_b_io = best_datagram_io(self.loc_b_socket, buffer_size=self.buffer_size)
         self.send_c_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.send_c_socket.bind(("", self.send_port_c))
-        self.send_c_socket.settimeout(self.timeout_len)
+        self.send_c_io = best_datagram_io(self.send_c_socket, buffer_size=self.buffer_size)
 
     def run(self):
         info_packet = ds.Packet(self.loc_port_a, self.loc_port_b)
         info_msg = info_packet.generate()
         while self.alive:
             # Tell client important server ports
-            try:
-                while True:
-                    data, ip = self.info_socket.recvfrom(self.buffer_size)
-                    self.info_socket.sendto(info_msg, ip)
-            except socket.timeout:
-                pass
+            for data, ip in self.info_io.recvfrom_many(self.timeout_len):
+                self.info_io.send(info_msg, ip)
 
             # Use as an echo for base location comparison + nat symmetric properties discovery
-            try:
-                while True:
-                    data, ip = self.loc_a_socket.recvfrom(self.buffer_size)
-                    self.info_socket.sendto(f"a {ip[0]} {ip[1]}".encode(), ip)
-            except socket.timeout:
-                pass
+            for data, ip in self.loc_a_io.recvfrom_many(self.timeout_len):
+                self.info_io.send(f"a {ip[0]} {ip[1]}".encode(), ip)
 
             # Extra echo to contrast different target location (port)
             # send_c_socket is to check nat cone status
-            try:
-                while True:
-                    data, ip = self.loc_b_socket.recvfrom(self.buffer_size)
-                    self.loc_b_socket.sendto(f"b {ip[0]} {ip[1]}".encode(), ip)
-                    self.send_c_socket.sendto(f"c {ip[0]} {ip[1]}".encode(), ip)
-            except socket.timeout:
-                pass
+            for data, ip in self.loc_b_io.recvfrom_many(self.timeout_len):
+                self.loc_b_io.send(f"b {ip[0]} {ip[1]}".encode(), ip)
+                self.send_c_io.send(f"c {ip[0]} {ip[1]}".encode(), ip)
+
+            for a in (self.info_io, self.loc_b_io, self.send_c_io):
+                a.flush()
 
 
 class RendezvousServer(Thread):
@@ -113,33 +103,30 @@ class RendezvousServer(Thread):
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(("", self.src_port))
-        self.socket.settimeout(self.timeout_len)
+        self.io = best_datagram_io(self.socket, buffer_size=self.buffer_size)
         self.alive = True
 
     def run(self) -> None:
         while self.alive:
-            try:
-                while True:
-                    data, ip = self.socket.recvfrom(self.buffer_size)
-                    packet = ds.Packet().parse(data)  # we assume {auth, channel_id, info_packet}
-                    if packet.type == "status":  # We're assuming that auth value can never be this
-                        if packet.value in self.collection:
-                            self.socket.sendto(ds.Packet(packet.value, "waiting").generate(), ip)
-                        else:
-                            self.socket.sendto(ds.Packet(packet.value, "missing").generate(), ip)
+            for data, ip in self.io.recvfrom_many(self.timeout_len):
+                packet = ds.Packet().parse(data)  # we assume {auth, channel_id, info_packet}
+                if packet.type == "status":  # We're assuming that auth value can never be this
+                    if packet.value in self.collection:
+                        self.io.send(ds.Packet(packet.value, "waiting").generate(), ip)
                     else:
-                        # We're going to assume that auth is taken care of
-                        if packet.value not in self.collection:  # New channel
-                            self.collection[packet.value] = (ip, packet.data)
-                        else:  # Previous channel found
-                            if ip != self.collection[packet.value][0]:  # if from a different source ip
-                                # We fire the exchange
-                                # Send to orig
-                                self.socket.sendto(ds.Packet(packet.value, packet.data).generate(), self.collection[packet.value][0])
-                                # Send to latest
-                                self.socket.sendto(ds.Packet(packet.value, self.collection[packet.value][1]).generate(), ip)
-                                # Remove entry from collection
-                                del self.collection[packet.value]
-            except socket.timeout:
-                # Do other stuff like maintenance
-                pass
+                        self.io.send(ds.Packet(packet.value, "missing").generate(), ip)
+                else:
+                    # We're going to assume that auth is taken care of
+                    if packet.value not in self.collection:  # New channel
+                        self.collection[packet.value] = (ip, packet.data)
+                    else:  # Previous channel found
+                        if ip != self.collection[packet.value][0]:  # if from a different source ip
+                            # We fire the exchange
+                            # Send to orig
+                            self.io.send(ds.Packet(packet.value, packet.data).generate(), self.collection[packet.value][0])
+                            # Send to latest
+                            self.io.send(ds.Packet(packet.value, self.collection[packet.value][1]).generate(), ip)
+                            # Remove entry from collection
+                            del self.collection[packet.value]
+            self.io.flush()
+            # Do other stuff like maintenance
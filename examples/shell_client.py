@@ -1,20 +1,56 @@
-import time
 import antt.data_structures as ds
 import code
+import os
+import threading
 from pprint import pprint
 
+shown = {}
+
+
+def show_progress(m_id, received, total):
+    # Called from the socket thread as parts come in, only worth showing for big messages
+    percent = received * 100 // total
+    if total > 1000 and percent >= shown.get(m_id, 0) + 10:
+        shown[m_id] = percent
+        print(f"[{m_id}] {percent}% ({received}/{total} parts)")
+
+
+def save_downloads(downloads):
+    # On its own thread so files get written out as they come in while the prompt waits on input
+    while True:
+        response = ds.Packet().parse(downloads.out_queue.get())
+        if response.type != "file":
+            print(response.value)
+            continue
+        name, offset = os.path.basename(response.value), int(response.data or 0)
+        incoming = downloads.out_queue.get()  # The file itself is the message right after
+        with open(name, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            if isinstance(incoming, ds.IncomingMessage):  # Big ones come in chunks as they arrive
+                for chunk in incoming:
+                    f.write(chunk)
+            else:
+                f.write(incoming)
+        print(f"{name} saved")
+
+
 if __name__ == '__main__':
     lport = 33553
     dport = 33773
     client = ds.SocketConnectionUDP(lport, ("127.0.0.1", dport))
+    client.stream_threshold = 1024 * 1024  # Anything bigger is written to disk as it comes in
 
     client.start()
     client.block_until_verify()
+    downloads = client.stream(1)  # dl answers come in on stream 1 so other commands can go on meanwhile
+    client.on_receive_progress = show_progress
+    threading.Thread(target=save_downloads, args=(downloads,), daemon=True).start()
 
     print("""Imagine a shell
 cd [dir name] - as expected
 ls - as expected
-dl [src name] - Download file""")
+dl [src name] - Download file
+resume [src name] - Download the rest of a file that was cut off""")
 
     while client.alive and client.verified_connection:
         command = input("> ")
@@ -23,38 +59,21 @@ dl [src name] - Download file""")
             code.interact(local=locals())
 
         parts = command.split()
-        if '"' in command:  # If there are quotes we assume that the spaces are all part of the same value
+        if parts and parts[0] == "resume":  # A dl that only asks for what the local copy is missing
+            name = " ".join(parts[1:]).strip('"')
+            have = os.path.getsize(os.path.basename(name)) if os.path.exists(os.path.basename(name)) else 0
+            command_packet = ds.Packet("dl", name, have).generate()
+        elif '"' in command:  # If there are quotes we assume that the spaces are all part of the same value
             command_packet = ds.Packet(parts[0], " ".join(parts[1:])[1:-1]).generate()
         else:
             command_packet = ds.Packet(*parts).generate()
         client.in_queue.put(command_packet)
+        if parts and parts[0] in ("dl", "resume"):
+            print("Downloading, it gets saved in the current directory")
+            continue
 
-        # show progress if transfer takes more than 5s (For UDP)
-        start_wait = time.time()
-        last_len = 0
-        while client.out_queue.empty():
-            time.sleep(.5)
-            if time.time() - start_wait > 5 and client.last_updated:
-                temp_data = client.get_message_status(client.last_updated)
-                if len(temp_data[0]) != last_len:
-                    print(len(temp_data[0]) - 1, temp_data[1])
-                    last_len = len(temp_data[0])
-        client.last_updated = None
-
-        # show progress if transfer takes more than 5s (For TCP)
-        # start_wait = time.time()
-        # last_len = 0
-        # while client.out_queue.empty():
-        #     time.sleep(.5)
-        #     if time.time() - start_wait > 5 and client.last_updated:
-        #         temp_len = len(client.pre_parsed)
-        #         if temp_len != last_len:
-        #             print(temp_len, client.last_updated)
-        #             last_len = temp_len
-        # client.last_updated = None
-
-        # Extract message from out_queue
-        response_raw = client.block_until_message()
+        # Extract message from out_queue, progress gets printed by show_progress meanwhile
+        response_raw = client.out_queue.get()
         response = ds.Packet().parse(response_raw)
 
         if response.type == "ls":
@@ -64,10 +83,5 @@ dl [src name] - Download file""")
             print(response.value)
         elif response.type == "text":
             print(response.value)
-        elif response.type == "file":
-            local_name = input("Save as name> ")
-            with open(local_name, "wb") as f:
-                f.write(response.value)
-            print("file received")
 
     print(client.alive, client.verified_connection)
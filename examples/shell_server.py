@@ -38,17 +38,17 @@ if __name__ == '__main__':
                 except FileNotFoundError:
                     server.in_queue.put(ds.Packet("text", f"Directory '{message.value}' was not found").generate())
             elif message.type == "dl":
-                try:
-                    with open(message.value, 'rb') as f:
-                        # Added a bunch of benchmark timing
-                        data = f.read()
-                        timer = time.time()
-                        gen_data = ds.Packet("file", data).generate()
-                        print(f"Generated packet in {time.time() - timer}s, len={len(gen_data)}")
-                        server.in_queue.put(gen_data)
-                        print("file inserted at", time.time())
-                except FileNotFoundError:
-                    server.in_queue.put(ds.Packet("text", f"File '{message.value}' was not found").generate())
+                offset = int(message.data or 0)  # How much of it the client already has
+                if os.path.isfile(message.value):
+                    # Downloads get their own stream so ls/cd answers don't wait on them. The "file" packet tells the
+                    # client what the raw message right behind it is
+                    server.send(ds.Packet("file", message.value, offset).generate(), stream=1)
+                    timer = time.time()
+                    handle = server.send_file(message.value, offset, stream=1)  # Framed straight from an mmap
+                    print(f"file queued, {handle.size} bytes")
+                    handle.future.add_done_callback(lambda f: print(f"file confirmed after {time.time() - timer}s"))
+                else:
+                    server.send(ds.Packet("text", f"File '{message.value}' was not found").generate(), stream=1)
 
         else:
             # So we don't just spin away at max speed
@@ -0,0 +1,42 @@
+"""
+Rough benchmark of the ways FrameGenerator can turn a message into datagrams
+Run with python tests/bench_frame_prep.py [message size in MB]
+"""
+import os
+import sys
+import time
+import antt.data_structures as ds
+
+
+def bench(name: str, func, frame_count: int):
+    start = time.perf_counter()
+    func()
+    took = time.perf_counter() - start
+    print(f"{name:<22} {took:7.3f}s  {frame_count / took:12,.0f} frames/s")
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1_000_000) if len(sys.argv) > 1 else 50_000_000
+    data = os.urandom(size)
+    gen = ds.FrameGenerator(1024)
+    frame_count = gen.part_count(size)
+    print(f"{size / 1_000_000}MB message -> {frame_count} frames")
+
+    def prep_generate():
+        for a in gen.prep(data):
+            a.generate()
+
+    def pack_frames():
+        gen.split_frames(gen.pack_frames(data))
+
+    def iter_frames():
+        for a in gen.iter_frames(data):
+            pass
+
+    bench("prep + generate", prep_generate, frame_count)
+    bench("pack_frames", pack_frames, frame_count)
+    bench("iter_frames", iter_frames, frame_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Rough benchmark of TCP message parsing, the old join + reslice way against ReceiveBuffer
+Run with python tests/bench_tcp_parse.py [big message size in MB]
+"""
+import os
+import sys
+import time
+import antt.data_structures as ds
+
+
+def old_parse(pieces, size_len: int = 5) -> int:
+    # What store_incoming + pop_finished_messages used to do, minus the heartbeats and logging
+    pre_parsed = b""
+    count = 0
+    for piece in pieces:
+        pre_parsed = b"".join([pre_parsed, piece])
+        while len(pre_parsed) >= 1 + size_len:
+            length = int.from_bytes(pre_parsed[1:1 + size_len], "big")
+            if len(pre_parsed) - 1 - size_len < length:
+                break
+            pre_parsed[1 + size_len:1 + size_len + length]
+            count += 1
+            pre_parsed = pre_parsed[1 + size_len + length:]
+    return count
+
+
+def new_parse(pieces) -> int:
+    conn = ds.SocketConnectionTCP(0, ("127.0.0.1", 0))
+    count = 0
+    for piece in pieces:
+        with conn.rx.space() as free:  # Stands in for recv_into
+            free[:len(piece)] = piece
+        conn.rx.wrote(len(piece))
+        count += len(conn.pop_finished_messages())
+    return count
+
+
+def bench(name: str, func, pieces, size: int):
+    start = time.perf_counter()
+    count = func(pieces)
+    took = time.perf_counter() - start
+    print(f"{name:<28} {took:7.3f}s {size / took / 1e6:9.2f}MB/s {count:8} messages")
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1_000_000) if len(sys.argv) > 1 else 20_000_000
+    conn = ds.SocketConnectionTCP(0, ("127.0.0.1", 0))
+
+    big = conn.message_header(size) + os.urandom(size)
+    big_pieces = [big[a:a + 1024] for a in range(0, len(big), 1024)]  # The old recv size
+    print(f"{size / 1_000_000}MB message in 1024 byte reads")
+    bench("join + reslice", old_parse, big_pieces, len(big))
+    bench("ReceiveBuffer", new_parse, big_pieces, len(big))
+
+    small = b"".join(conn.message_header(100) + bytes(100) for a in range(100_000))
+    small_pieces = [small[a:a + 64 * 1024] for a in range(0, len(small), 64 * 1024)]
+    print("100k 100 byte messages in 64KB reads")
+    bench("join + reslice", old_parse, small_pieces, len(small))
+    bench("ReceiveBuffer", new_parse, small_pieces, len(small))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Loopback transfer with each datagram io backend, counting the socket calls made on both sides
+Run with python tests/bench_udp_io.py [message size in MB]
+"""
+import os
+import sys
+import time
+import antt.data_structures as ds
+from antt.datagram_io import DatagramIO, MmsgDatagramIO
+
+
+def bench(backend, data: bytes, port: int):
+    port_a = ds.get_first_port_from(port)
+    port_b = ds.get_first_port_from(port_a + 1)
+    sender = ds.SocketConnectionUDP(port_a, ("127.0.0.1", port_b))
+    receiver = ds.SocketConnectionUDP(port_b, ("127.0.0.1", port_a))
+    sender.io_backend = receiver.io_backend = backend
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    start = time.perf_counter()
+    sender.in_queue.put(data)
+    message = receiver.out_queue.get(timeout=300)
+    took = time.perf_counter() - start
+    assert message == data
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    calls = sum(a.io.recv_calls + a.io.send_calls for a in (sender, receiver))
+    datagrams = sum(a.io.datagrams_in + a.io.datagrams_out for a in (sender, receiver))
+    slabs = sum(a.io.slabs_made for a in (sender, receiver))  # Receive buffers allocated, the rest were reused
+    print(f"{backend.__name__:<16} {took:7.3f}s {len(data) / took / 1e6:8.2f}MB/s {calls:10,} calls {datagrams:10,} datagrams {slabs:4} slabs")
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1_000_000) if len(sys.argv) > 1 else 50_000_000
+    data = os.urandom(size)
+    print(f"{size / 1_000_000}MB message")
+    bench(DatagramIO, data, 45000)
+    if MmsgDatagramIO.available:
+        bench(MmsgDatagramIO, data, 46000)
+    else:
+        print("recvmmsg/sendmmsg not available here")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import asyncio
+import pytest
+
+import antt.data_structures as ds
+import antt.async_connections as ac
+
+
+def test_async_udp_send_receive():
+    async def main():
+        port_a = ds.get_first_port_from(2700)
+        port_b = ds.get_first_port_from(3700)
+        a = await ac.AsyncConnectionUDP.open(port_a, ("127.0.0.1", port_b))
+        b = await ac.AsyncConnectionUDP.open(port_b, ("127.0.0.1", port_a))
+        await a.wait_verified(2)
+        await b.wait_verified(2)
+
+        data = bytes(range(256)) * 2000  # Lots of frames
+        await a.send(b"small")
+        await a.send(data)
+        received = []
+        async for msg in b:
+            received.append(msg)
+            if len(received) == 2:
+                break
+        a.close()
+        b.close()
+        return received
+
+    assert asyncio.run(asyncio.wait_for(main(), 10)) == [b"small", bytes(range(256)) * 2000]
+
+
+def test_async_udp_with_thread():
+    async def main():
+        port_a = ds.get_first_port_from(2800)
+        port_b = ds.get_first_port_from(3800)
+        thread_side = ds.SocketConnectionUDP(port_b, ("127.0.0.1", port_a))
+        thread_side.start()
+        a = await ac.AsyncConnectionUDP.open(port_a, ("127.0.0.1", port_b))
+        await a.wait_verified(2)
+
+        thread_side.in_queue.put(b"from thread")
+        from_thread = await a.recv(2)
+        await a.send(b"from loop")
+        from_loop = await asyncio.get_running_loop().run_in_executor(None, thread_side.out_queue.get, True, 2)
+        thread_side.in_queue.put("kill")
+        a.close()
+        return from_thread, from_loop
+
+    assert asyncio.run(asyncio.wait_for(main(), 10)) == (b"from thread", b"from loop")
+
+
+def test_async_tcp_send_receive():
+    async def main():
+        port_server = ds.get_first_port_from(2900)
+        port_client = ds.get_first_port_from(3900)
+        server = await ac.AsyncConnectionTCP.open(port_server, ("127.0.0.1", port_client), acts_as="server")
+        client = await ac.AsyncConnectionTCP.open(port_client, ("127.0.0.1", port_server))
+        await client.wait_verified(2)
+        await server.wait_verified(2)
+
+        data = bytes(range(256)) * 2000
+        await client.send(b"hello")
+        await client.send(data)
+        await server.send(b"back")
+        received = [await server.recv(2), await server.recv(2), await client.recv(2)]
+        client.close()
+        with pytest.raises(ds.ConnectionIssue):
+            await server.recv(2)  # Closing one side ends the other
+        server.close()
+        return received
+
+    assert asyncio.run(asyncio.wait_for(main(), 10)) == [b"hello", bytes(range(256)) * 2000, b"back"]
+
+
+def test_async_tcp_batching():
+    async def main():
+        port_server = ds.get_first_port_from(2950)
+        port_client = ds.get_first_port_from(3950)
+        server = await ac.AsyncConnectionTCP.open(port_server, ("127.0.0.1", port_client), acts_as="server")
+        client = await ac.AsyncConnectionTCP.open(port_client, ("127.0.0.1", port_server))
+        client.batch_delay = .02
+        await client.wait_verified(2)
+        await server.wait_verified(2)
+
+        sent = [f"line {a}".encode() for a in range(100)]
+        for msg in sent:
+            await client.send(msg)
+        assert client.write_batch  # Still waiting on the delay
+        received = [await server.recv(2) for a in sent]
+        client.close()
+        server.close()
+        return sent, received
+
+    sent, received = asyncio.run(asyncio.wait_for(main(), 10))
+    assert received == sent
+
+
+def test_async_tcp_streams():
+    async def main():
+        port_server = ds.get_first_port_from(2970)
+        port_client = ds.get_first_port_from(3970)
+        server = await ac.AsyncConnectionTCP.open(port_server, ("127.0.0.1", port_client), acts_as="server")
+        client = await ac.AsyncConnectionTCP.open(port_client, ("127.0.0.1", port_server))
+        await client.wait_verified(2)
+        await server.wait_verified(2)
+
+        big = bytes(range(256)) * 16000
+        bulk_task = asyncio.ensure_future(client.send(big, stream=1))
+        await client.stream(2).send(b"chat")
+        await client.send(b"plain")
+        await client.send(b"positional", 2)  # Stream is the second argument like on the other connections
+        assert await asyncio.wait_for(server.stream(2).out_queue.get(), 2) == b"chat"
+        assert await asyncio.wait_for(server.stream(2).out_queue.get(), 2) == b"positional"
+        assert server.stream(1).out_queue.empty()  # The big one is still coming in
+        received = [await asyncio.wait_for(server.stream(1).out_queue.get(), 5), await server.recv(2)]
+        await bulk_task
+        client.close()
+        server.close()
+        return big, received
+
+    big, received = asyncio.run(asyncio.wait_for(main(), 10))
+    assert received == [big, b"plain"]
+
+
+def test_async_udp_send_handles():
+    async def main():
+        port_a = ds.get_first_port_from(2990)
+        port_b = ds.get_first_port_from(3990)
+        a = await ac.AsyncConnectionUDP.open(port_a, ("127.0.0.1", port_b))
+        b = await ac.AsyncConnectionUDP.open(port_b, ("127.0.0.1", port_a))
+        await a.wait_verified(2)
+        await b.wait_verified(2)
+
+        handle = await a.send(bytes(100_000))
+        await asyncio.wait_for(handle, 5)  # Confirmed by the other side
+        assert handle.acked_bytes == 100_000
+        b.close()
+        unconfirmed = await a.send(bytes(100_000))
+        a.close()
+        with pytest.raises(ds.ConnectionIssue):
+            await unconfirmed
+        return await b.recv(2)
+
+    assert asyncio.run(asyncio.wait_for(main(), 10)) == bytes(100_000)
+
+
+def test_async_tcp_handles_wait_for_the_socket():
+    async def main():
+        port_server = ds.get_first_port_from(3050)
+        port_client = ds.get_first_port_from(4050)
+        server = await ac.AsyncConnectionTCP.open(port_server, ("127.0.0.1", port_client), acts_as="server")
+        client = await ac.AsyncConnectionTCP.open(port_client, ("127.0.0.1", port_server))
+        await client.wait_verified(2)
+        await server.wait_verified(2)
+
+        written = await client.send(b"small")
+        await asyncio.wait_for(written, 2)
+        server.transport.pause_reading()  # Once the os buffers are full the rest waits in the client's transport
+        stuck = ds.SendHandle(client.make_future(), 50_000_000)
+        client.send_msg(bytes(50_000_000), handle=stuck)
+        await asyncio.sleep(.2)
+        waiting = not stuck.done()
+        client.close()
+        with pytest.raises(ds.ConnectionIssue):
+            await stuck
+        server.close()
+        return waiting
+
+    assert asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_async_tcp_streamed_receive():
+    async def main():
+        port_server = ds.get_first_port_from(3010)
+        port_client = ds.get_first_port_from(4010)
+        server = await ac.AsyncConnectionTCP.open(port_server, ("127.0.0.1", port_client), acts_as="server")
+        client = await ac.AsyncConnectionTCP.open(port_client, ("127.0.0.1", port_server))
+        server.stream_threshold = 1_000_000
+        server.stream_window = 256 * 1024
+        await client.wait_verified(2)
+        await server.wait_verified(2)
+
+        big = bytes(range(256)) * 80_000
+        async def send_both():
+            await client.send(big)  # Waits on the transport, which waits on our slow reader
+            await client.send(b"after")
+        sending = asyncio.ensure_future(send_both())
+        incoming = await server.recv(2)
+        chunks = []
+        paused = False
+        async for chunk in incoming:
+            chunks.append(chunk)
+            paused = paused or server.read_paused
+            assert len(server.rx) <= server.stream_window + server.rx.size  # The rest waits in the os buffers
+            await asyncio.sleep(.001)
+        after = await server.recv(2)
+        await sending
+        client.close()
+        server.close()
+        return big, incoming, chunks, paused, after
+
+    big, incoming, chunks, paused, after = asyncio.run(asyncio.wait_for(main(), 20))
+    assert incoming.length == len(big)
+    assert b"".join(chunks) == big
+    assert paused  # The slow reader held the connection up
+    assert after == b"after"
+
+
+def test_async_tcp_send_file(tmp_path):
+    path = tmp_path / "file.bin"
+    data = bytes(range(256)) * 40_000
+    path.write_bytes(data)
+
+    async def main():
+        port_server = ds.get_first_port_from(3030)
+        port_client = ds.get_first_port_from(4030)
+        server = await ac.AsyncConnectionTCP.open(port_server, ("127.0.0.1", port_client), acts_as="server")
+        client = await ac.AsyncConnectionTCP.open(port_client, ("127.0.0.1", port_server))
+        await client.wait_verified(2)
+        await server.wait_verified(2)
+
+        sending = asyncio.ensure_future(client.send_file(path, offset=1000))
+        await asyncio.sleep(0)  # The file has the transport now
+        await client.send(b"after")  # Held back until the file is out
+        handle = await sending
+        received = [await server.recv(2), await server.recv(2)]
+        client.close()
+        server.close()
+        return handle, received
+
+    handle, received = asyncio.run(asyncio.wait_for(main(), 10))
+    assert handle.done() and handle.size == len(data) - 1000
+    assert received == [data[1000:], b"after"]
@@ -1,6 +1,10 @@
 import pytest
 
 import antt.data_structures as ds
+import os
+import socket
+import time
+from concurrent.futures import Future
 from time import sleep
 
 assert_timeout = 2
@@ -36,6 +40,29 @@ def test_packet_conversions():
     assert new_packet.extra == [1, 2, 3]
 
 
+def test_packet_binary_conversions():
+    packet = ds.Packet("file", b"\x00\xffraw bytes", {"size": 12}, [1, 2, 3])
+    packet_bytes = packet.generate(binary=True)
+    assert packet_bytes[:1] == ds.Packet.binary_magic
+    assert b"\x00\xffraw bytes" in packet_bytes  # Not hex encoded
+
+    new_packet = ds.Packet().parse(packet_bytes)  # Format is auto detected
+    assert isinstance(new_packet.value, memoryview)
+    assert new_packet == packet
+    assert new_packet.type == "file"
+    assert new_packet.data == {"size": 12}
+
+    # The json format can still be read and can still re-encode the memoryview
+    assert ds.Packet().parse(new_packet.generate()) == packet
+
+    packets = [ds.Packet("a", b"1"), ds.Packet("b", 2, b"3"), ds.Packet()]
+    batch = ds.Packet.generate_many(packets)
+    assert ds.Packet.parse_many(batch) == packets
+
+    with pytest.raises(ds.InvalidData):
+        ds.Packet().parse(packet_bytes[:-1])
+
+
 @pytest.mark.filterwarnings("error")
 def test_basic_socket_life():
     """
@@ -171,3 +198,728 @@ def test_basic_tcp_socket_send2():
 
 
 # test_basic_tcp_socket_send2()
+
+
+def test_tcp_in_queue_bytes_like():
+    sender_port = ds.get_first_port_from(22232)
+    receiver_port = ds.get_first_port_from(32232)
+    sender = ds.SocketConnectionTCP(sender_port, ("127.0.0.1", receiver_port))
+    receiver = ds.SocketConnectionTCP(receiver_port, ("127.0.0.1", sender_port), acts_as="server")
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+
+    sender.in_queue.put(bytearray(b"array"))
+    sender.in_queue.put(memoryview(b"a view of this")[2:6])
+    messages = [receiver.block_until_message() for a in range(2)]
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert messages == [b"array", b"view"]
+
+
+def test_tcp_receive_buffer_parsing():
+    conn = ds.SocketConnectionTCP(0, ("127.0.0.1", 0))  # Never started, only the framing is used
+    sent = [f"message {a}".encode() for a in range(1000)] + [bytes(range(256)) * 4000]  # The last is bigger than the buffer
+    wire = b"\x00".join(conn.message_header(len(a)) + a for a in sent)
+    received = []
+    for a in range(0, len(wire), 1000):  # Pieces that cut through headers and messages
+        conn.rx.extend(wire[a:a + 1000])
+        received.extend(conn.pop_finished_messages())
+    assert received == sent
+    assert len(conn.rx) == 0
+    assert len(conn.rx.buffer) <= len(sent[-1]) + 2 * conn.rx.min_free  # Grew to fit the big one, not more
+    conn.rx.space()
+    assert len(conn.rx.buffer) == conn.rx.size  # And went back once it was done
+
+
+class CountingSocket:
+    """
+    Counts sendmsg calls on a real socket
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+
+def test_tcp_send_queue():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    counted = CountingSocket(a)
+    queue = ds.SendQueue()
+    conn = ds.SocketConnectionTCP(0, ("127.0.0.1", 0))  # Never started, only the framing is used
+    small = [ds.SendHandle(Future(), 5) for i in range(20)]
+    for handle in small:
+        queue.add((conn.message_header(5), b"small"), (handle,))
+    queue.write(counted)
+    assert counted.calls == 1  # All 40 parts in one sendmsg
+    assert all(handle.done() for handle in small)
+
+    big = bytes(range(256)) * 40_000
+    handle = ds.SendHandle(Future(), len(big))
+    queue.add((conn.message_header(len(big)), big), (handle,))
+    received = bytearray()
+    while len(queue):
+        queue.write(counted)  # Only takes what fits in the socket buffer, then picks up where it stopped
+        assert handle.done() == (not len(queue))
+        received += b.recv(1 << 20)
+    while len(received) < 20 * 11 + 6 + len(big):
+        received += b.recv(1 << 20)
+    a.close()
+    b.close()
+    assert received[-len(big):] == big
+    assert handle.result(0).acked_bytes == len(big)
+
+
+def test_message_assembler():
+    data = bytes(range(256)) * 4
+    space = 100
+    chunks = [data[a:a + space] for a in range(0, len(data), space)]
+    assembler = ds.MessageAssembler(len(chunks), space)
+
+    # Insert out of order and leave some gaps
+    for a in [10, 0, 1, 2, 5, 9]:
+        assert assembler.insert(a, chunks[a])
+    assert not assembler.insert(5, chunks[5])  # Duplicate
+    assert assembler.missing_ranges() == [(3, 5), (6, 9)]
+    assert list(assembler.missing_parts()) == [3, 4, 6, 7, 8]
+    assert assembler.missing_ranges(4, 7) == [(4, 5), (6, 7)]
+    assert assembler.contiguous == 3
+    assert not assembler.done
+
+    for a in assembler.missing_parts():
+        assembler.insert(a, chunks[a])
+    assert assembler.done
+    assert assembler.missing_ranges() == []
+    popped = assembler.pop()
+    assert popped == data and type(popped) is bytes  # Same type as 0x0d messages, so it can be hashed
+    assert assembler.buffer is None
+
+    # A forged header can't make the receiver allocate whatever it claims
+    conn = ds.SocketConnectionUDP(0, ("127.0.0.1", 0))  # Never started
+    gen = conn.frame_generator
+    conn.rx_frame.parse(bytes(gen.header_template(b"\x05", 7, 1 << 32)) + bytes(gen.message_space))
+    conn.incoming_organizer(conn.rx_frame)
+    assert not conn.building_blocks
+
+
+def test_retransmission_store():
+    gen = ds.FrameGenerator(100)
+    store = ds.RetransmissionStore(gen, max_bytes=1000)
+    data = bytes(range(250))
+    stored = store.add(data)
+
+    # Frames built from the store match what the Frame class would generate
+    for num, frame in enumerate(gen.prep(data)):
+        frame.id = stored.id
+        assert store.frame(stored.id, num) == frame.generate()
+        assert stored.frame_len(num) == len(frame.generate())
+    assert stored.total_parts == 3
+
+    assert store.has_space(750)
+    assert not store.has_space(751)
+    store.remove(stored.id)
+    assert stored.id not in store
+    assert store.used_bytes == 0
+    assert store.has_space(5000)  # A lone message can always go out
+
+
+def test_frame_generator_batch():
+    gen = ds.FrameGenerator(100)
+    data = bytes(range(256)) * 3
+    frames = gen.prep(data)
+    expected = [a.generate() for a in frames]
+    m_id = frames[0].id
+
+    assert gen.split_frames(gen.pack_frames(data, m_id=m_id)) == expected
+    assert [bytes(a) for a in gen.iter_frames(data, m_id=m_id)] == expected
+
+    # Empty messages still get a single frame
+    assert len(gen.split_frames(gen.pack_frames(b""))) == 1
+
+
+def test_resend_requests():
+    gen = ds.FrameGenerator(100)
+    # A burst, lots of scattered single losses and a lone gap at the end
+    ranges = [(5, 2000)] + [(a, a + 1) for a in range(2100, 4000, 3)] + [(10000, 10002)]
+    requests = gen.resend_requests(42, ranges)
+    assert all(len(a) <= gen.buffer_size for a in requests)
+    assert {a[1 + gen.id_len] for a in requests} == {0, 1}  # Both encodings got used
+
+    found = []
+    for a in requests:
+        m_id, part_ranges = gen.read_resend_request(a)
+        assert m_id == 42
+        found.extend(part_ranges)
+    # Split ranges are fine as long as the same parts come back
+    assert sorted({b for start, end in found for b in range(start, end)}) == [b for start, end in ranges for b in range(start, end)]
+
+    assert gen.resend_requests(42, []) == []
+
+
+class LossyConnectionUDP(ds.SocketConnectionUDP):
+    """
+    Drops every 10th data frame it sends, including the ones that go out in 0x10 containers with control datagrams
+    """
+    sent_frames = 0
+
+    def send_bytes(self, data: bytes, urgent: bool = False):
+        inner = self.frame_generator.split_batch(data[1:]) if data[0] == 16 else [data]
+        kept = []
+        for a in inner:
+            if a[0] in (5, 6):
+                self.sent_frames += 1
+                if self.sent_frames % 10 == 0:
+                    continue
+            kept.append(a)
+        if len(kept) == len(inner):
+            super().send_bytes(data, urgent)
+        elif len(kept) == 1:
+            super().send_bytes(kept[0], urgent)
+        elif kept:
+            super().send_bytes(b"\x10" + self.frame_generator.pack_batch(kept), urgent)
+
+
+def test_send_scheduler():
+    gen = ds.FrameGenerator(1024)
+    store = ds.RetransmissionStore(gen)
+    scheduler = ds.SendScheduler()
+    bulk = store.add(bytes(10 * gen.message_space))
+    favored = store.add(bytes(10 * gen.message_space))
+    favored.weight = 3
+    scheduler.add(bulk)
+    scheduler.add(favored)
+    scheduler.resend.append((bulk.id, 0, 2))
+    scheduler.control.append(b"\x09")
+    assert scheduler.depths() == {"control": 1, "unreliable": 0, "resend": 2, "data": 20}
+
+    order = []
+    while (found := scheduler.next_frame(store)) is not None:
+        order.append((found[0].id, found[2]))
+    assert order[:2] == [(bulk.id, True), (bulk.id, True)]  # Resends first
+    assert order[2:10] == [(bulk.id, False)] + [(favored.id, False)] * 3 + [(bulk.id, False)] + [(favored.id, False)] * 3
+    assert len(order) == 22
+    assert list(scheduler.control)[1:] == [b"\x08" + ds.itob_format(a, gen.id_len) for a in (favored.id, bulk.id)]
+    assert scheduler.depths() == {"control": 3, "unreliable": 0, "resend": 0, "data": 0}
+
+
+def test_udp_window_recovers_from_loss():
+    port_sender = ds.get_first_port_from(2300)
+    port_receiver = ds.get_first_port_from(3400)
+    sender = LossyConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    data = bytes(range(256)) * 2000
+    sender.in_queue.put(data)
+    message = receiver.block_until_message(timeout=5)
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert message == data
+    assert sender.sent_frames > sender.frame_generator.part_count(len(data))  # Lost frames were sent again
+    assert sender.congestion.ssthresh < sender.congestion.max_window  # And the window backed off
+    assert sender.rtt_estimator.samples and sender.rto < 1
+    assert receiver.rtt_estimator.samples  # From probes since it only sent acks
+
+
+def test_fec_parity_repair():
+    gen = ds.FrameGenerator(1024)
+    store = ds.RetransmissionStore(gen)
+    data = bytes(range(256)) * 40
+    stored = store.add(data)
+    assembler = ds.MessageAssembler(stored.total_parts, gen.message_space)
+    for part in range(stored.total_parts):
+        if part != 3:
+            frame = gen.frame_template()
+            frame.parse(bytes(stored.frame(part)))
+            assembler.insert(frame.part, frame.data)
+    frame = gen.frame_template()
+    frame.parse(stored.parity_frame(0, stored.total_parts))
+    assert frame.part >> 32 == stored.total_parts
+    assert assembler.add_parity(frame.part & 0xFFFFFFFF, frame.part >> 32, frame.data)
+    assert assembler.done and assembler.repaired == 1
+    assert assembler.pop() == data
+
+
+def test_udp_fec_avoids_resends():
+    port_sender = ds.get_first_port_from(2400)
+    port_receiver = ds.get_first_port_from(3500)
+    sender = LossyConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    sender.fec_group_size = 8  # Never more than one loss per group
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    data = bytes(range(256)) * 2000
+    sender.in_queue.put(data)
+    message = receiver.block_until_message(timeout=5)
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert message == data
+    (assembler,) = receiver.building_blocks.values()
+    assert assembler.repaired == sender.sent_frames // 10  # Every dropped frame was rebuilt from parity
+    assert sender.sent_frames == sender.frame_generator.part_count(len(data))  # None of them had to be sent again
+
+
+class CountingConnectionUDP(ds.SocketConnectionUDP):
+    """
+    Counts datagrams by type (including the ones inside 0x10 containers) and drops the first 0x0d
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.sent_types = {}
+        self.sent_datagrams = 0
+        self.containers = 0
+
+    def send_bytes(self, data: bytes, urgent: bool = False):
+        self.sent_datagrams += 1
+        self.containers += data[0] == 16
+        inner = self.frame_generator.split_batch(data[1:]) if data[0] == 16 else [data]
+        for a in inner:
+            self.sent_types[a[0]] = self.sent_types.get(a[0], 0) + 1
+        if data[0] == 13 and self.sent_types[13] == 1:
+            return
+        super().send_bytes(data, urgent)
+
+
+def test_udp_single_datagram_messages():
+    port_sender = ds.get_first_port_from(2450)
+    port_receiver = ds.get_first_port_from(3550)
+    sender = CountingConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = CountingConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    sent = [f"chat {a}".encode() for a in range(20)] + [b"x" * sender.frame_generator.single_space]
+    for msg in sent:
+        sender.in_queue.put(msg)
+    received = [receiver.block_until_message(timeout=5) for a in sent]
+    time.sleep(.2)  # Let the last acks land
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert sorted(received) == sorted(sent)  # The dropped one came later, but only once
+    assert receiver.out_queue.empty()
+    assert sender.sent_types[13] > len(sent)  # The dropped one was sent again
+    assert 5 not in sender.sent_types and 8 not in sender.sent_types
+    assert 9 not in receiver.sent_types and not receiver.building_blocks
+    assert receiver.sent_types[14] < len(sent)  # Acks were shared
+    assert not sender.send_store.messages
+
+
+def test_udp_batches_small_messages():
+    port_sender = ds.get_first_port_from(2470)
+    port_receiver = ds.get_first_port_from(3570)
+    sender = CountingConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    sender.batch_delay = .05
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    sent = [f"chat {a}".encode() for a in range(60)] + [bytes(5000)]  # The big one can't be batched
+    for msg in sent:
+        sender.in_queue.put(msg)
+    received = [receiver.block_until_message(timeout=5) for a in sent]
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert received == sent
+    assert sender.sent_types[15] <= 3  # 60 messages in a few datagrams
+    assert 13 not in sender.sent_types
+
+
+def test_udp_streams():
+    port_sender = ds.get_first_port_from(2510)
+    port_receiver = ds.get_first_port_from(3610)
+    sender = ds.SocketConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    bulk = receiver.stream(1)
+    chat = receiver.stream(2)
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    big = [bytes([a]) * 2_000_000 for a in range(3)]
+    small = [f"chat {a}".encode() for a in range(10)]
+    for msg in big:
+        sender.send(msg, stream=1)
+    for msg in small:
+        sender.stream(2).send(msg)
+    sender.send(b"plain")
+    received_small = [chat.out_queue.get(timeout=5) for a in small]
+    assert bulk.out_queue.qsize() < len(big)  # The small ones didn't wait for all of the bulk stream
+    received_big = [bulk.out_queue.get(timeout=20) for a in big]
+    plain = receiver.block_until_message(timeout=5)
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert received_small == small
+    assert received_big == big  # In order on their stream
+    assert plain == b"plain"
+
+
+def test_udp_unreliable_delivery():
+    port_sender = ds.get_first_port_from(2530)
+    port_receiver = ds.get_first_port_from(3630)
+    sender = CountingConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    state = sender.stream(4, delivery="unreliable-latest")
+    for a in range(10):
+        sender.send(f"ping {a}".encode(), delivery="unreliable")
+        state.send(f"state {a}".encode())
+    sender.send(bytes(5000), delivery="unreliable")  # Too big for one datagram so it goes reliably
+    received = []
+    while (4, b"state 9") not in received or len([a for a in received if a[0] == 0]) < 10:
+        received.append(receiver.unreliable_queue.get(timeout=2))
+    big = receiver.block_until_message(timeout=5)
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert [a for a in received if a[0] == 0] == [(0, f"ping {a}".encode()) for a in range(10)]
+    states = [int(a[1].split()[1]) for a in received if a[0] == 4]
+    assert states == sorted(states) and states[-1] == 9  # Waiting ones can be replaced by newer ones, never reordered
+    assert big == bytes(5000)
+    assert sender.sent_types[18] + sender.scheduler.unreliable_dropped == 20
+    assert 13 not in sender.sent_types  # None of the small ones went through send_store
+
+    # An older update showing up after a newer one is dropped
+    receiver.incoming_unreliable(b"\x12" + ds.itob_format(4 << ds.STREAM_SEQ_BITS | 3, 5) + b"\x01old")
+    assert receiver.stale_dropped == 1 and receiver.unreliable_queue.empty()
+
+    # Queued behind control but never in it, and only the newest "unreliable-latest" one per stream waits
+    scheduler = ds.SendScheduler()
+    scheduler.unreliable_limit = 4
+    for a in range(3):
+        scheduler.add_unreliable(0, f"ping {a}".encode())
+    for a in range(3):
+        scheduler.add_unreliable(4, f"state {a}".encode(), latest=True)
+    scheduler.add_unreliable(0, b"ping 3")  # Over the limit, so ping 0 goes
+    assert not scheduler.control
+    assert [scheduler.next_unreliable() for a in range(4)] == [b"ping 1", b"ping 2", b"state 2", b"ping 3"]
+    assert scheduler.unreliable_dropped == 3
+
+
+def test_udp_send_handles():
+    port_sender = ds.get_first_port_from(2550)
+    port_receiver = ds.get_first_port_from(3650)
+    sender = LossyConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    received_progress = []
+    receiver.on_receive_progress = lambda m_id, got, total: received_progress.append((got, total))
+    data = bytes(range(256)) * 1000
+    handle = sender.send(data)
+    progress = []
+    handle.on_progress = lambda h: progress.append(h.acked_bytes)
+    small = sender.send(b"small")
+    assert handle.result(timeout=5) is handle and small.result(timeout=5) is small
+    assert sorted([receiver.block_until_message(), receiver.block_until_message()]) == sorted([data, b"small"])
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert handle.acked_bytes == len(data) and handle.resends > 0  # Every 10th frame was dropped
+    assert progress == sorted(progress) and progress[-1] == len(data)
+    assert received_progress[-1][0] == received_progress[-1][1]
+
+
+def test_udp_delayed_and_piggybacked_acks():
+    port_a = ds.get_first_port_from(2490)
+    port_b = ds.get_first_port_from(3590)
+    a = CountingConnectionUDP(port_a, ("127.0.0.1", port_b))
+    b = CountingConnectionUDP(port_b, ("127.0.0.1", port_a))
+    a.start()
+    b.start()
+    a.block_until_verify()
+    b.block_until_verify()
+
+    data = bytes(range(256)) * 4000
+    parts = a.frame_generator.part_count(len(data))
+    a.in_queue.put(data)
+    assert b.block_until_message(timeout=5) == data
+    assert 0 not in b.sent_types  # No heartbeat for every read
+    assert b.sent_datagrams < parts / 3  # Acks cover several frames each
+
+    # Both ways at once, so acks can go out inside the data
+    a.in_queue.put(data)
+    b.in_queue.put(data)
+    assert b.block_until_message(timeout=5) == data
+    assert a.block_until_message(timeout=5) == data
+    assert a.containers and b.containers
+    a.in_queue.put("kill")
+    b.in_queue.put("kill")
+
+
+def test_udp_idle_loop_sleeps():
+    port_a = ds.get_first_port_from(2500)
+    port_b = ds.get_first_port_from(3600)
+    a = ds.SocketConnectionUDP(port_a, ("127.0.0.1", port_b))
+    b = ds.SocketConnectionUDP(port_b, ("127.0.0.1", port_a))
+    a.start()
+    b.start()
+    a.block_until_verify()
+    b.block_until_verify()
+
+    start = time.process_time()
+    time.sleep(1)
+    assert time.process_time() - start < .2  # Both loops are blocked in select rather than spinning
+
+    sent_at = time.time()
+    a.in_queue.put(b"wake up")
+    assert b.block_until_message(timeout=1) == b"wake up"
+    assert time.time() - sent_at < .1  # The wakeup fd got the queued message out right away
+    a.in_queue.put("kill")
+    b.in_queue.put("kill")
+
+
+def test_tcp_loop_waits_on_events():
+    port_a = ds.get_first_port_from(2600)
+    port_b = ds.get_first_port_from(3700)
+    a = ds.SocketConnectionTCP(port_a, ("127.0.0.1", port_b))  # Started first, so it has to retry until b listens
+    b = ds.SocketConnectionTCP(port_b, ("127.0.0.1", port_a), acts_as="server")
+    b.on_message = b.in_queue.put  # Echo
+    a.start()
+    time.sleep(.1)
+    b.start()
+    a.block_until_verify()
+    b.block_until_verify()
+
+    start = time.process_time()
+    time.sleep(1)
+    assert time.process_time() - start < .2  # Both loops are blocked in select rather than spinning
+
+    start = time.perf_counter()
+    for i in range(200):
+        a.in_queue.put(b"ping")
+        assert a.out_queue.get(timeout=1) == b"ping"
+    assert time.perf_counter() - start < 1  # Was at least 20ms a round trip with the sleeping loop
+    a.in_queue.put("kill")
+    b.in_queue.put("kill")
+
+
+def test_rtt_estimator():
+    estimator = ds.RttEstimator(initial_rto=1, min_rto=.01)
+    assert estimator.rto == 1
+    estimator.sample(.1)
+    assert estimator.srtt == .1
+    assert abs(estimator.rto - .3) < 1e-9  # srtt + 4 * rttvar
+    for a in range(50):
+        estimator.sample(.02)
+    assert abs(estimator.srtt - .02) < .001
+    assert estimator.rto < .05
+
+    base = estimator.rto
+    estimator.on_timeout()
+    estimator.on_timeout()
+    assert abs(estimator.rto - 4 * base) < 1e-9
+    estimator.sample(.02)
+    assert estimator.rto < .05  # Fresh sample drops the backoff
+
+
+def test_udp_reports_kernel_drops():
+    port_a = ds.get_first_port_from(2550)
+    port_b = ds.get_first_port_from(3650)
+    a = ds.SocketConnectionUDP(port_a, ("127.0.0.1", port_b))
+    b = ds.SocketConnectionUDP(port_b, ("127.0.0.1", port_a))
+    b.min_socket_buffer = b.max_socket_buffer = 4096  # Tiny so a stalled receiver overflows
+    received = []
+
+    def slow_callback(msg):
+        received.append(msg)
+        time.sleep(.3)
+
+    b.on_message = slow_callback
+    a.start()
+    b.start()
+    a.block_until_verify()
+    b.block_until_verify()
+    assert a.socket_buffers[0] >= a.min_socket_buffer
+    request = a.socket_buffer_request
+    a.size_socket_buffers(None)  # Same rtt, so nothing is set again (None would fail if it was)
+    assert a.socket_buffer_request == request
+
+    data = bytes(range(256)) * 4000
+    a.in_queue.put(b"stall")
+    time.sleep(.05)
+    a.in_queue.put(data)
+    start = time.time()
+    while len(received) < 2 and time.time() - start < 10:
+        time.sleep(.05)
+    assert received == [b"stall", data]
+    if b.io.kernel_drops is not None:  # Only linux counts them
+        assert b.local_drops > 0
+        assert 0 < a.connection_stats()["peer_drops"] <= b.local_drops
+    a.in_queue.put("kill")
+    b.in_queue.put("kill")
+
+
+def test_udp_streamed_receive():
+    port_sender = ds.get_first_port_from(2550)
+    port_receiver = ds.get_first_port_from(3650)
+    sender = ds.SocketConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    receiver.stream_threshold = 100_000
+    receiver.stream_window = 64 * 1024
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    data = os.urandom(3_000_000)
+    handle = sender.send(data)
+    sender.send(b"small")
+    first = [receiver.block_until_message(timeout=5) for a in range(2)]
+    small = [a for a in first if isinstance(a, bytes)]
+    incoming = [a for a in first if isinstance(a, ds.IncomingMessage)][0]
+    chunks = []
+    held = 0
+    for chunk in incoming:
+        held = max(held, incoming.delivered - incoming.read + len(chunk))
+        chunks.append(chunk)
+        time.sleep(.001)  # Slow reader so the window actually fills up
+    handle.result(timeout=5)
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert b"".join(chunks) == data
+    assert incoming.length == len(data)
+    assert held <= receiver.stream_window + receiver.frame_generator.message_space  # Never more than the window waiting
+    assert small == [b"small"]
+
+
+def test_udp_streamed_receive_under_loss():
+    port_sender = ds.get_first_port_from(2560)
+    port_receiver = ds.get_first_port_from(3660)
+    sender = LossyConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    receiver.stream_threshold = 100_000
+    receiver.stream_window = 64 * 1024
+    chunks = []
+    held = []
+
+    def on_incoming(incoming: ds.IncomingMessage):
+        def on_chunk(chunk):
+            if chunk is not None:
+                held.append(incoming.delivered - incoming.read)
+                chunks.append(chunk)
+        incoming.on_chunk = on_chunk
+    receiver.on_incoming = on_incoming
+    made_room = []
+    receiver.reader_made_room = lambda: made_room.append(time.time())
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    data = os.urandom(2_000_000)
+    start = time.time()
+    sender.send(data).result(timeout=20)
+    took = time.time() - start
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert b"".join(chunks) == data
+    assert max(held) <= receiver.stream_window + receiver.frame_generator.message_space
+    assert len(made_room) >= len(data) // receiver.stream_window  # The callback's reads count as room too
+    assert took < 5  # The window kept moving even with gaps at its front
+
+
+def test_send_file(tmp_path):
+    path = tmp_path / "file.bin"
+    data = os.urandom(3_000_000)
+    path.write_bytes(data)
+    assert ds.map_file(path, 10)[:5] == data[10:15]
+    assert len(ds.map_file(path, len(data))) == 0
+
+    port_a = ds.get_first_port_from(2620)
+    port_b = ds.get_first_port_from(3720)
+    a = ds.SocketConnectionTCP(port_a, ("127.0.0.1", port_b))
+    b = ds.SocketConnectionTCP(port_b, ("127.0.0.1", port_a), acts_as="server")
+    b.start()
+    time.sleep(.1)
+    a.start()
+    a.block_until_verify()
+    b.block_until_verify()
+    a.send(b"before")
+    handle = a.send_file(path)
+    a.send_file(path, offset=1_000_000)  # Resuming after the first 1MB
+    a.send_file(path, offset=2_000_000, stream=3)
+    a.send(b"after")
+    tcp = [b.block_until_message(timeout=5) for i in range(4)]
+    tcp_stream = b.stream(3).out_queue.get(timeout=5)
+    assert handle.result(timeout=5).acked_bytes == len(data)
+    a.in_queue.put("kill")
+    b.in_queue.put("kill")
+    assert tcp == [b"before", data, data[1_000_000:], b"after"]
+    assert tcp_stream == data[2_000_000:]
+
+    port_a = ds.get_first_port_from(2640)
+    port_b = ds.get_first_port_from(3740)
+    a = ds.SocketConnectionUDP(port_a, ("127.0.0.1", port_b))
+    b = ds.SocketConnectionUDP(port_b, ("127.0.0.1", port_a))
+    a.start()
+    b.start()
+    a.block_until_verify()
+    b.block_until_verify()
+    handle = a.send_file(path, offset=1_000_000)
+    a.send_file(path, offset=2_000_000, stream=3)
+    udp = b.block_until_message(timeout=5)
+    udp_stream = b.stream(3).out_queue.get(timeout=5)
+    handle.result(timeout=5)
+    a.in_queue.put("kill")
+    b.in_queue.put("kill")
+    assert udp == data[1_000_000:]
+    assert udp_stream == data[2_000_000:]
+
+
+def test_udp_ids_wrap_around():
+    port_sender = ds.get_first_port_from(2660)
+    port_receiver = ds.get_first_port_from(3760)
+    sender = ds.SocketConnectionUDP(port_sender, ("127.0.0.1", port_receiver))
+    receiver = ds.SocketConnectionUDP(port_receiver, ("127.0.0.1", port_sender))
+    sender.single_datagram = False  # Frames only, 0x0d messages don't use building_blocks
+    receiver.done_marker_limit = 8
+    sender.start()
+    receiver.start()
+    sender.block_until_verify()
+    receiver.block_until_verify()
+
+    first = [bytes([a]) * 2000 for a in range(10)]  # Ids 1 to 10
+    for msg in first:
+        sender.send(msg).result(timeout=5)
+    received = [receiver.block_until_message(timeout=5) for a in first]
+    sender.frame_generator.latest_id = ds.STREAM_SEQ_MASK - 20
+    wrapped = [bytes([a]) * 2000 for a in range(10, 50)]  # Wraps around and uses 0 to 18 again
+    for msg in wrapped:
+        sender.send(msg).result(timeout=5)
+    received += [receiver.block_until_message(timeout=5) for a in wrapped]
+    markers = len(receiver.building_blocks)
+    sender.in_queue.put("kill")
+    receiver.in_queue.put("kill")
+
+    assert sorted(received) == first + wrapped
+    assert markers <= receiver.done_marker_limit
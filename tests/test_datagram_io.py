@@ -0,0 +1,59 @@
+import socket
+import time
+import pytest
+
+from antt.datagram_io import DatagramIO, MmsgDatagramIO
+
+
+@pytest.mark.parametrize("backend", [DatagramIO, pytest.param(MmsgDatagramIO, marks=pytest.mark.skipif(not MmsgDatagramIO.available, reason="linux only"))])
+def test_datagram_io_round_trip(backend):
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    a.bind(("127.0.0.1", 0))
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b.bind(("127.0.0.1", 0))
+    io_a = backend(a, batch_size=8, buffer_size=64)
+    io_b = backend(b, batch_size=8, buffer_size=64)
+
+    sent = [bytes([c]) * (c + 1) for c in range(20)] + [b"x" * 100]  # More than a batch, and one too big for a slot
+    for data in sent:
+        io_a.send(data, b.getsockname())
+    assert io_a.flush() and not io_a.pending
+
+    received = []
+    deadline = time.time() + 2
+    while len(received) < len(sent) and time.time() < deadline:
+        received.extend(io_b.recvfrom_many(.1))
+    assert sorted(a for a, _ in received) == sorted(a[:64] for a in sent)  # buffer_size cuts the long one
+    assert all(addr == a.getsockname() for _, addr in received)
+    assert io_b.recv_many() == []
+    if backend is MmsgDatagramIO:
+        assert io_a.send_calls < len(sent)
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize("backend", [DatagramIO, pytest.param(MmsgDatagramIO, marks=pytest.mark.skipif(not MmsgDatagramIO.available, reason="linux only"))])
+def test_datagram_io_recv_views_reuse_slabs(backend):
+    a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    a.bind(("127.0.0.1", 0))
+    b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    b.bind(("127.0.0.1", 0))
+    io_a = backend(a, batch_size=8, buffer_size=64)
+    io_b = backend(b, batch_size=8, buffer_size=64)
+    io_b.track_drops()
+
+    for round_num in range(5):
+        sent = [bytes([round_num, c]) * 3 for c in range(6)]
+        for data in sent:
+            io_a.send(data, b.getsockname())
+        io_a.flush()
+        views = []
+        deadline = time.time() + 2
+        while len(views) < len(sent) and time.time() < deadline:
+            views.extend(io_b.recv_views(.1))
+        assert all(isinstance(view, memoryview) for view in views)
+        assert [bytes(view) for view in views] == sent
+        io_b.release()
+    assert io_b.slabs_made <= 2  # Rounds reuse the released slabs (a second one only if a round came in two reads)
+    a.close()
+    b.close()